@@ -0,0 +1,806 @@
+#!/usr/bin/python2.7
+
+'''Local stand-in for the BigQuery v2 and Cloud Storage v1 JSON APIs.
+
+The server implements just enough of the REST surface used by bigquery_tools
+to run the readers end-to-end without network access or credentials:
+
+  BigQuery: tabledata.list, tables.get, tables.list, jobs.query,
+            jobs.getQueryResults, jobs.insert, jobs.get
+  Storage:  objects.get (metadata and alt=media with Range support),
+            objects.list
+
+It also serves minimal discovery documents, so clients are constructed the
+regular way (discovery_cache.build_client) pointed at the local server. Per-request
+latency, page sizes and table shapes are configurable, and every call is
+counted per method together with the number of response bytes.
+
+Usage:
+  server = FakeServer(latency=0.01, max_page_rows=10000)
+  server.add_table('bench', 'rows', num_rows=100000, num_columns=8)
+  server.add_object('bench-bucket', 'data/blob.bin', size=10 * 1024 * 1024)
+  server.start()
+  auth = FakeAuth(server.url)
+  ...
+  server.stop()
+'''
+
+import base64
+import BaseHTTPServer
+import gzip
+import hashlib
+import json
+import re
+import SocketServer
+import StringIO
+import threading
+import time
+import urlparse
+
+BIGQUERY_SERVICE_PATH = 'bigquery/v2/'
+STORAGE_SERVICE_PATH = 'storage/v1/'
+DISCOVERY_PATH = 'discovery/v1/apis/{api}/{apiVersion}/rest'
+
+# BigQuery caps a tabledata.list response at roughly 10MB regardless of maxResults.
+MAX_PAGE_BYTES = 10 * 1024 * 1024
+DEFAULT_PROJECT = 'bench-project'
+
+
+def _param(location='query', type='string', required=False, repeated=False):
+    param = {'type': type, 'location': location}
+    if required:
+        param['required'] = True
+    if repeated:
+        param['repeated'] = True
+    return param
+
+
+def _method(method_id, path, http_method='GET', path_params=(), query_params=None,
+            request=False, media_download=False):
+    parameters = dict((name, _param('path', required=True)) for name in path_params)
+    parameters.update(query_params or {})
+    method = {'id': method_id, 'path': path, 'httpMethod': http_method,
+              'parameters': parameters, 'parameterOrder': list(path_params)}
+    if request:
+        method['request'] = {'$ref': 'Object'}
+    method['response'] = {'$ref': 'Object'}
+    if media_download:
+        method['supportsMediaDownload'] = True
+    return method
+
+
+def _discovery_doc(name, version, root_url, service_path, resources):
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': '%s:%s' % (name, version),
+        'name': name,
+        'version': version,
+        'protocol': 'rest',
+        'rootUrl': root_url,
+        'servicePath': service_path,
+        'baseUrl': root_url + service_path,
+        'batchPath': 'batch',
+        'parameters': {
+            'alt': _param(),
+            'fields': _param(),
+            'prettyPrint': _param(type='boolean'),
+            'quotaUser': _param(),
+        },
+        'schemas': {'Object': {'id': 'Object', 'type': 'object'}},
+        'resources': resources,
+    }
+
+
+def bigquery_discovery(root_url):
+    '''Returns a discovery document for the subset of BigQuery v2 we serve.'''
+    table_path = ('projectId', 'datasetId', 'tableId')
+    paging = {'maxResults': _param(type='integer'), 'pageToken': _param(),
+              'startIndex': _param(), 'selectedFields': _param()}
+    resources = {
+        'tabledata': {'methods': {
+            'list': _method('bigquery.tabledata.list',
+                            'projects/{projectId}/datasets/{datasetId}/tables/{tableId}/data',
+                            path_params=table_path, query_params=paging)}},
+        'tables': {'methods': {
+            'get': _method('bigquery.tables.get',
+                           'projects/{projectId}/datasets/{datasetId}/tables/{tableId}',
+                           path_params=table_path, query_params={'selectedFields': _param()}),
+            'list': _method('bigquery.tables.list', 'projects/{projectId}/datasets/{datasetId}/tables',
+                            path_params=('projectId', 'datasetId'),
+                            query_params={'maxResults': _param(type='integer'), 'pageToken': _param()}),
+            'insert': _method('bigquery.tables.insert', 'projects/{projectId}/datasets/{datasetId}/tables',
+                              'POST', path_params=('projectId', 'datasetId'), request=True),
+            'delete': _method('bigquery.tables.delete',
+                              'projects/{projectId}/datasets/{datasetId}/tables/{tableId}',
+                              'DELETE', path_params=table_path)}},
+        'jobs': {'methods': {
+            'query': _method('bigquery.jobs.query', 'projects/{projectId}/queries', 'POST',
+                             path_params=('projectId',), request=True),
+            'getQueryResults': _method('bigquery.jobs.getQueryResults', 'projects/{projectId}/queries/{jobId}',
+                                       path_params=('projectId', 'jobId'),
+                                       query_params=dict(paging, timeoutMs=_param(type='integer'))),
+            'insert': _method('bigquery.jobs.insert', 'projects/{projectId}/jobs', 'POST',
+                              path_params=('projectId',), request=True),
+            'get': _method('bigquery.jobs.get', 'projects/{projectId}/jobs/{jobId}',
+                           path_params=('projectId', 'jobId'))}},
+    }
+    return _discovery_doc('bigquery', 'v2', root_url, BIGQUERY_SERVICE_PATH, resources)
+
+
+def storage_discovery(root_url):
+    '''Returns a discovery document for the subset of Storage v1 we serve.'''
+    listing = {'prefix': _param(), 'delimiter': _param(), 'pageToken': _param(),
+               'maxResults': _param(type='integer'), 'versions': _param(type='boolean')}
+    resources = {
+        'objects': {'methods': {
+            'get': _method('storage.objects.get', 'b/{bucket}/o/{object}',
+                           path_params=('bucket', 'object'), media_download=True),
+            'list': _method('storage.objects.list', 'b/{bucket}/o',
+                            path_params=('bucket',), query_params=listing)}},
+    }
+    return _discovery_doc('storage', 'v1', root_url, STORAGE_SERVICE_PATH, resources)
+
+
+def parse_field_mask(mask):
+    '''Parses a partial response mask such as "a,b/c,d(e,f)" into a nested dict.'''
+    tree = {}
+    position = _parse_fields(mask, 0, tree)
+    if position != len(mask):
+        raise ValueError('Invalid field mask %s' % (mask,))
+    return tree
+
+
+def _parse_fields(mask, position, tree):
+    while position < len(mask) and mask[position] != ')':
+        match = re.compile(r'[^,()/]+').match(mask, position)
+        if not match:
+            raise ValueError('Invalid field mask %s' % (mask,))
+        node = tree.setdefault(match.group(0).strip(), {})
+        position = match.end()
+        while position < len(mask) and mask[position] == '/':
+            match = re.compile(r'[^,()/]+').match(mask, position + 1)
+            node = node.setdefault(match.group(0).strip(), {})
+            position = match.end()
+        if position < len(mask) and mask[position] == '(':
+            position = _parse_fields(mask, position + 1, node) + 1
+        if position < len(mask) and mask[position] == ',':
+            position += 1
+    return position
+
+
+def apply_field_mask(value, tree):
+    '''Keeps only the fields of value selected by a parsed mask.'''
+    if not tree:
+        return value
+    if isinstance(value, list):
+        return [apply_field_mask(item, tree) for item in value]
+    if not isinstance(value, dict):
+        return value
+    return dict((key, apply_field_mask(value[key], subtree))
+                for key, subtree in tree.items() if key in value)
+
+
+class FakeTable:
+    '''A generated table. Row values are derived from the row index, so
+    pages can be served at any offset without materializing the table.'''
+
+    def __init__(self, project_id, dataset_id, table_id, num_rows, num_columns=4,
+                 value_width=12, last_modified=None, partitions=None):
+        self.project_id = project_id
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+        self.num_rows = num_rows
+        # partitions: optional list of (partition_id, row_count); the table's rows
+        # are laid out across them in order.
+        self.partitions = []
+        if partitions:
+            offset = 0
+            for partition_id, row_count in partitions:
+                self.partitions.append((partition_id, offset, row_count))
+                offset += row_count
+            self.num_rows = offset
+        self.value_width = value_width
+        self.last_modified = int(last_modified or time.time() * 1000)
+        self.fields = [{'name': 'id', 'type': 'INTEGER'}, {'name': 'ts', 'type': 'TIMESTAMP'}]
+        for index in range(max(num_columns - 2, 0)):
+            self.fields.append({'name': 'col_%d' % (index,),
+                                'type': 'FLOAT' if index % 3 == 2 else 'STRING'})
+
+    def make_row(self, index):
+        values = []
+        for position, field in enumerate(self.fields):
+            if field['name'] == 'id':
+                values.append(str(index))
+            elif field['type'] == 'TIMESTAMP':
+                values.append('%.1fE9' % (1.4 + (index % 100000) / 1e6,))
+            elif field['type'] == 'FLOAT':
+                values.append(repr(index * 0.5 + position))
+            else:
+                values.append(('v%d_%d' % (index, position)).ljust(self.value_width, 'x'))
+        return {'f': [{'v': value} for value in values]}
+
+    def select_columns(self, row, positions):
+        return {'f': [row['f'][position] for position in positions]}
+
+    def resource(self):
+        size = self.num_rows * len(self.fields) * (self.value_width + 8)
+        resource = {
+            'kind': 'bigquery#table',
+            'id': '%s:%s.%s' % (self.project_id, self.dataset_id, self.table_id),
+            'tableReference': {'projectId': self.project_id, 'datasetId': self.dataset_id,
+                               'tableId': self.table_id},
+            'schema': {'fields': self.fields},
+            'numRows': str(self.num_rows),
+            'numBytes': str(size),
+            'creationTime': str(self.last_modified),
+            'lastModifiedTime': str(self.last_modified),
+            'type': 'TABLE',
+        }
+        if self.partitions:
+            resource['timePartitioning'] = {'type': 'DAY'}
+        return resource
+
+
+class FakePartition:
+    '''A $YYYYMMDD view of a contiguous range of a FakeTable's rows.'''
+
+    def __init__(self, table, partition_id, offset, num_rows):
+        self.table = table
+        self.partition_id = partition_id
+        self.offset = offset
+        self.num_rows = num_rows
+        self.fields = table.fields
+        self.last_modified = table.last_modified
+
+    def make_row(self, index):
+        return self.table.make_row(self.offset + index)
+
+    def select_columns(self, row, positions):
+        return self.table.select_columns(row, positions)
+
+    def resource(self):
+        resource = self.table.resource()
+        resource['id'] = '%s$%s' % (resource['id'], self.partition_id)
+        resource['numRows'] = str(self.num_rows)
+        resource['numBytes'] = str(int(resource['numBytes']) * self.num_rows // max(self.table.num_rows, 1))
+        return resource
+
+
+class FakeResult:
+    '''A materialized query result.'''
+
+    def __init__(self, fields, rows):
+        self.fields = fields
+        self.rows = rows
+        self.num_rows = len(rows)
+        self.last_modified = int(time.time() * 1000)
+
+    def make_row(self, index):
+        return self.rows[index]
+
+    def select_columns(self, row, positions):
+        return {'f': [row['f'][position] for position in positions]}
+
+
+class FakeObject:
+    '''A Cloud Storage object held in memory.'''
+
+    def __init__(self, bucket, name, data, content_type='application/octet-stream'):
+        self.bucket = bucket
+        self.name = name
+        self.data = data
+        self.content_type = content_type
+        self.updated = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+
+    def resource(self):
+        return {
+            'kind': 'storage#object',
+            'id': '%s/%s' % (self.bucket, self.name),
+            'bucket': self.bucket,
+            'name': self.name,
+            'size': str(len(self.data)),
+            'contentType': self.content_type,
+            'md5Hash': base64.b64encode(hashlib.md5(self.data).digest()),
+            'updated': self.updated,
+        }
+
+
+class FakeJob:
+    '''A job that reaches the DONE state after a fixed duration.'''
+
+    def __init__(self, project_id, job_id, configuration, duration):
+        self.project_id = project_id
+        self.job_id = job_id
+        self.configuration = configuration
+        self.created = time.time()
+        self.duration = duration
+        self.completed = False
+        self.error = None
+
+    def state(self):
+        elapsed = time.time() - self.created
+        if elapsed >= self.duration:
+            return 'DONE'
+        return 'RUNNING' if elapsed > 0 else 'PENDING'
+
+    def resource(self):
+        status = {'state': self.state()}
+        if self.error and status['state'] == 'DONE':
+            status['errorResult'] = self.error
+        return {
+            'kind': 'bigquery#job',
+            'id': '%s:%s' % (self.project_id, self.job_id),
+            'jobReference': {'projectId': self.project_id, 'jobId': self.job_id},
+            'configuration': self.configuration,
+            'status': status,
+            'statistics': {'creationTime': str(int(self.created * 1000))},
+        }
+
+
+class ServerStats:
+    '''Thread-safe request and byte counters, keyed by API method.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.response_bytes = {}
+            self.rows = 0
+
+    def record(self, method, response_bytes, rows=0):
+        with self.lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            self.response_bytes[method] = self.response_bytes.get(method, 0) + response_bytes
+            self.rows += rows
+
+    def snapshot(self):
+        with self.lock:
+            return {'requests': dict(self.requests),
+                    'response_bytes': dict(self.response_bytes),
+                    'rows': self.rows,
+                    'total_requests': sum(self.requests.values()),
+                    'total_response_bytes': sum(self.response_bytes.values())}
+
+
+class FakeApiError(Exception):
+
+    def __init__(self, status, message, reason='invalid'):
+        Exception.__init__(self, message)
+        self.status = status
+        self.reason = reason
+
+
+class FakeServer:
+    '''In-memory BigQuery/GCS service bound to a local port.'''
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, latency_per_mb=0.0,
+                 max_page_rows=None, max_page_bytes=MAX_PAGE_BYTES, job_duration=0.5,
+                 shard_rows=100000):
+        self.latency = latency
+        self.latency_per_mb = latency_per_mb
+        self.max_page_rows = max_page_rows
+        self.max_page_bytes = max_page_bytes
+        self.job_duration = job_duration
+        self.shard_rows = shard_rows
+        self.tables = {}
+        self.buckets = {}
+        self.jobs = {}
+        self.queries = {}
+        self.stats = ServerStats()
+        self.lock = threading.Lock()
+        self.httpd = _ThreadedHTTPServer((host, port), _RequestHandler)
+        self.httpd.fake = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return 'http://%s:%d/' % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def add_table(self, dataset_id, table_id, num_rows, project_id=DEFAULT_PROJECT, **kwargs):
+        table = FakeTable(project_id, dataset_id, table_id, num_rows, **kwargs)
+        self.tables[(project_id, dataset_id, table_id)] = table
+        return table
+
+    def add_object(self, bucket, name, data=None, size=None, content_type='application/octet-stream'):
+        if data is None:
+            pattern = ''.join(chr(ord('a') + index % 26) for index in range(4096))
+            data = (pattern * (size // len(pattern) + 1))[:size]
+        obj = FakeObject(bucket, name, data, content_type)
+        with self.lock:
+            self.buckets.setdefault(bucket, {})[name] = obj
+        return obj
+
+    def get_table(self, project_id, dataset_id, table_id):
+        # Strip snapshot (@) and partition ($) decorators.
+        base_id = re.split(r'[@$]', table_id, 1)[0]
+        table = self.tables.get((project_id, dataset_id, base_id))
+        if table is None:
+            raise FakeApiError(404, 'Not found: Table %s:%s.%s' % (project_id, dataset_id, table_id),
+                               'notFound')
+        match = re.search(r'\$(\w+)', table_id)
+        if match:
+            for partition_id, offset, row_count in table.partitions:
+                if partition_id == match.group(1):
+                    return FakePartition(table, partition_id, offset, row_count)
+            return FakePartition(table, match.group(1), 0, 0)
+        return table
+
+    def get_object(self, bucket, name):
+        obj = self.buckets.get(bucket, {}).get(name)
+        if obj is None:
+            raise FakeApiError(404, 'No such object: %s/%s' % (bucket, name), 'notFound')
+        return obj
+
+    def delay(self, response_bytes=0):
+        delay = self.latency + self.latency_per_mb * response_bytes / (1024.0 * 1024.0)
+        if delay > 0:
+            time.sleep(delay)
+
+    # BigQuery
+
+    def list_rows(self, table, params):
+        '''Serves one page of rows, honoring startIndex, pageToken and maxResults.'''
+        if params.get('pageToken'):
+            start = int(params['pageToken'])
+        else:
+            start = int(params.get('startIndex') or 0)
+        max_results = int(params.get('maxResults') or table.num_rows)
+        if self.max_page_rows:
+            max_results = min(max_results, self.max_page_rows)
+        positions = None
+        if params.get('selectedFields'):
+            names = [name.strip() for name in params['selectedFields'].split(',')]
+            index_by_name = dict((field['name'], position) for position, field in enumerate(table.fields))
+            positions = [index_by_name[name] for name in names if name in index_by_name]
+        rows = []
+        size = 0
+        end = min(start + max_results, table.num_rows)
+        for index in xrange(start, end):
+            row = table.make_row(index)
+            if positions is not None:
+                row = table.select_columns(row, positions)
+            size += sum(len(field['v']) + 8 for field in row['f']) + 8
+            if rows and size > self.max_page_bytes:
+                break
+            rows.append(row)
+        next_index = start + len(rows)
+        response = {'kind': 'bigquery#tableDataList', 'totalRows': str(table.num_rows),
+                    'etag': '"%d"' % (table.last_modified,)}
+        if rows:
+            response['rows'] = rows
+        if next_index < table.num_rows:
+            response['pageToken'] = str(next_index)
+        return response
+
+    def start_query(self, project_id, body):
+        '''Runs a query synchronously. Any query against a registered table
+        returns that table's rows; otherwise the first registered table is used.'''
+        query = body.get('query', '')
+        table = None
+        if '$__PARTITIONS_SUMMARY__' in query:
+            table = self.partitions_summary(query)
+        for key in sorted(self.tables):
+            if table is not None:
+                break
+            if key[2] in query:
+                table = self.tables[key]
+                break
+        if table is None:
+            if not self.tables:
+                raise FakeApiError(400, 'No tables registered with the fake server')
+            table = self.tables[sorted(self.tables)[0]]
+        with self.lock:
+            job_id = 'query_%d' % (len(self.queries) + len(self.jobs),)
+            self.queries[job_id] = table
+        # Like the real service, the response carries the first page of rows.
+        response = self.list_rows(table, {'maxResults': body.get('maxResults')})
+        response.update({'kind': 'bigquery#queryResponse',
+                         'jobReference': {'projectId': project_id, 'jobId': job_id},
+                         'schema': {'fields': table.fields},
+                         'jobComplete': True,
+                         'cacheHit': False})
+        return response
+
+    def partitions_summary(self, query):
+        '''Answers a query against the [table$__PARTITIONS_SUMMARY__] meta-table.'''
+        match = re.search(r'\[(?:([^:\]]+):)?([^.\]]+)\.([^$\]]+)\$__PARTITIONS_SUMMARY__\]', query)
+        if not match:
+            raise FakeApiError(400, 'Invalid partitions summary query: %s' % (query,))
+        table = self.get_table(match.group(1) or DEFAULT_PROJECT, match.group(2), match.group(3))
+        fields = [{'name': 'partition_id', 'type': 'STRING'}, {'name': 'last_modified_time', 'type': 'INTEGER'}]
+        rows = [{'f': [{'v': partition_id}, {'v': str(table.last_modified)}]}
+                for partition_id, _, _ in table.partitions]
+        return FakeResult(fields, rows)
+
+    def query_results(self, project_id, job_id, params):
+        table = self.queries.get(job_id)
+        if table is None:
+            raise FakeApiError(404, 'Not found: Job %s:%s' % (project_id, job_id), 'notFound')
+        response = self.list_rows(table, params)
+        response.update({'kind': 'bigquery#getQueryResultsResponse', 'jobComplete': True,
+                         'schema': {'fields': table.fields},
+                         'jobReference': {'projectId': project_id, 'jobId': job_id}})
+        return response
+
+    def insert_job(self, project_id, body):
+        job_ref = body.get('jobReference') or {}
+        job_id = job_ref.get('jobId') or 'job_%d' % (len(self.jobs),)
+        with self.lock:
+            if job_id in self.jobs:
+                raise FakeApiError(409, 'Already Exists: Job %s:%s' % (project_id, job_id), 'duplicate')
+            job = FakeJob(project_id, job_id, body.get('configuration', {}), self.job_duration)
+            self.jobs[job_id] = job
+        return job.resource()
+
+    def get_job(self, project_id, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise FakeApiError(404, 'Not found: Job %s:%s' % (project_id, job_id), 'notFound')
+        if job.state() == 'DONE' and not job.completed:
+            self.complete_job(job)
+        return job.resource()
+
+    def complete_job(self, job):
+        '''Materializes the outputs of a finished job.'''
+        with self.lock:
+            if job.completed:
+                return
+            job.completed = True
+        extract = job.configuration.get('extract')
+        if extract:
+            source = extract['sourceTable']
+            try:
+                table = self.get_table(source['projectId'], source['datasetId'], source['tableId'])
+            except FakeApiError as err:
+                job.error = {'reason': err.reason, 'message': str(err)}
+                return
+            self.write_extract(table, extract['destinationUris'])
+
+    def write_extract(self, table, destination_uris):
+        '''Writes newline-delimited JSON shards for an extract job.'''
+        names = [field['name'] for field in table.fields]
+        shard_count = max(1, -(-table.num_rows // self.shard_rows))
+        for shard in range(shard_count):
+            uri = destination_uris[shard % len(destination_uris)]
+            bucket, name = uri[len('gs://'):].split('/', 1)
+            start = shard * self.shard_rows
+            lines = []
+            for index in xrange(start, min(start + self.shard_rows, table.num_rows)):
+                row = table.make_row(index)
+                lines.append(json.dumps(dict(zip(names, [field['v'] for field in row['f']]))))
+            if '*' in name:
+                name = name.replace('*', '%012d' % (shard // len(destination_uris),))
+            elif shard > 0:
+                break
+            self.add_object(bucket, name, data='\n'.join(lines) + '\n')
+
+    # Cloud Storage
+
+    def list_objects(self, bucket, params):
+        prefix = params.get('prefix') or ''
+        delimiter = params.get('delimiter')
+        max_results = int(params.get('maxResults') or 1000)
+        page_token = params.get('pageToken') or ''
+        names = sorted(name for name in self.buckets.get(bucket, {})
+                       if name.startswith(prefix) and name > page_token)
+        items = []
+        prefixes = set()
+        last_name = None
+        for name in names:
+            if len(items) + len(prefixes) >= max_results:
+                break
+            last_name = name
+            if delimiter:
+                position = name.find(delimiter, len(prefix))
+                if position >= 0:
+                    prefixes.add(name[:position + len(delimiter)])
+                    continue
+            items.append(self.buckets[bucket][name].resource())
+        response = {'kind': 'storage#objects', 'items': items}
+        if prefixes:
+            response['prefixes'] = sorted(prefixes)
+        if last_name is not None and last_name != names[-1]:
+            response['nextPageToken'] = last_name
+        return response
+
+
+class _ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Routes REST calls to the FakeServer.'''
+
+    protocol_version = 'HTTP/1.1'
+
+    routes = [
+        ('GET', r'discovery/v1/apis/bigquery/v2/rest', 'discovery.bigquery'),
+        ('GET', r'discovery/v1/apis/storage/v1/rest', 'discovery.storage'),
+        ('GET', BIGQUERY_SERVICE_PATH + r'projects/([^/]+)/datasets/([^/]+)/tables/([^/]+)/data',
+         'tabledata.list'),
+        ('GET', BIGQUERY_SERVICE_PATH + r'projects/([^/]+)/datasets/([^/]+)/tables/([^/]+)', 'tables.get'),
+        ('GET', BIGQUERY_SERVICE_PATH + r'projects/([^/]+)/datasets/([^/]+)/tables', 'tables.list'),
+        ('POST', BIGQUERY_SERVICE_PATH + r'projects/([^/]+)/datasets/([^/]+)/tables', 'tables.insert'),
+        ('DELETE', BIGQUERY_SERVICE_PATH + r'projects/([^/]+)/datasets/([^/]+)/tables/([^/]+)',
+         'tables.delete'),
+        ('POST', BIGQUERY_SERVICE_PATH + r'projects/([^/]+)/queries', 'jobs.query'),
+        ('GET', BIGQUERY_SERVICE_PATH + r'projects/([^/]+)/queries/([^/]+)', 'jobs.getQueryResults'),
+        ('POST', BIGQUERY_SERVICE_PATH + r'projects/([^/]+)/jobs', 'jobs.insert'),
+        ('GET', BIGQUERY_SERVICE_PATH + r'projects/([^/]+)/jobs/([^/]+)', 'jobs.get'),
+        ('GET', STORAGE_SERVICE_PATH + r'b/([^/]+)/o/(.+)', 'objects.get'),
+        ('GET', STORAGE_SERVICE_PATH + r'b/([^/]+)/o', 'objects.list'),
+    ]
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def route(self, http_method, path):
+        for route_method, pattern, name in self.routes:
+            if route_method != http_method:
+                continue
+            match = re.match('^/' + pattern + '$', path)
+            if match:
+                return name, [urlparse.unquote(group) for group in match.groups()]
+        return None, None
+
+    def read_body(self):
+        length = int(self.headers.get('content-length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length))
+
+    def dispatch(self, http_method):
+        fake = self.server.fake
+        parsed = urlparse.urlparse(self.path)
+        params = dict((key, values[-1]) for key, values in urlparse.parse_qs(parsed.query).items())
+        name, args = self.route(http_method, parsed.path)
+        if name is None:
+            return self.send_json(404, {'error': {'code': 404, 'message': 'Unknown path %s' % (parsed.path,)}},
+                                  'unknown')
+        try:
+            if name == 'objects.get' and params.get('alt') == 'media':
+                return self.send_media(fake.get_object(*args))
+            response = self.handle_call(fake, name, args, params, http_method)
+        except FakeApiError as err:
+            error = {'code': err.status, 'message': str(err),
+                     'errors': [{'reason': err.reason, 'message': str(err)}]}
+            return self.send_json(err.status, {'error': error}, name)
+        if params.get('fields'):
+            response = apply_field_mask(response, parse_field_mask(params['fields']))
+        self.send_json(200, response, name)
+
+    def handle_call(self, fake, name, args, params, http_method):
+        root_url = 'http://%s/' % (self.headers.get('host'),)
+        if name == 'discovery.bigquery':
+            return bigquery_discovery(root_url)
+        if name == 'discovery.storage':
+            return storage_discovery(root_url)
+        if name == 'tabledata.list':
+            return fake.list_rows(fake.get_table(*args), params)
+        if name == 'tables.get':
+            return fake.get_table(*args).resource()
+        if name == 'tables.list':
+            tables = [table.resource() for key, table in sorted(fake.tables.items())
+                      if key[:2] == tuple(args)]
+            return {'kind': 'bigquery#tableList', 'tables': tables, 'totalItems': len(tables)}
+        if name == 'tables.insert':
+            body = self.read_body()
+            ref = body['tableReference']
+            table = fake.add_table(ref['datasetId'], ref['tableId'], 0, project_id=ref.get('projectId') or args[0])
+            return table.resource()
+        if name == 'tables.delete':
+            table = fake.get_table(*args)
+            del fake.tables[(table.project_id, table.dataset_id, table.table_id)]
+            return {}
+        if name == 'jobs.query':
+            return fake.start_query(args[0], self.read_body())
+        if name == 'jobs.getQueryResults':
+            return fake.query_results(args[0], args[1], params)
+        if name == 'jobs.insert':
+            return fake.insert_job(args[0], self.read_body())
+        if name == 'jobs.get':
+            return fake.get_job(*args)
+        if name == 'objects.get':
+            return fake.get_object(*args).resource()
+        if name == 'objects.list':
+            return fake.list_objects(args[0], params)
+        raise FakeApiError(400, 'Unsupported method %s' % (name,))
+
+    def accepts_gzip(self):
+        # Like the Google front ends, only compress for clients that ask for
+        # gzip both in Accept-Encoding and in the User-Agent.
+        return ('gzip' in (self.headers.get('accept-encoding') or '') and
+                'gzip' in (self.headers.get('user-agent') or ''))
+
+    def send_json(self, status, response, name):
+        body = json.dumps(response)
+        encoding = None
+        if self.accepts_gzip():
+            buf = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+                f.write(body)
+            body = buf.getvalue()
+            encoding = 'gzip'
+        self.server.fake.delay(len(body))
+        self.server.fake.stats.record(name, len(body), len(response.get('rows', ())))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_media(self, obj):
+        '''Serves object bytes, honoring a single "bytes=start-end" Range header.'''
+        data = obj.data
+        total = len(data)
+        status = 200
+        start, end = 0, total - 1
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('range') or '')
+        if match and total > 0:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else total - 1, total - 1)
+            status = 206
+        body = data[start:end + 1] if total > 0 else ''
+        self.server.fake.delay(len(body))
+        self.server.fake.stats.record('objects.get_media', len(body))
+        self.send_response(status)
+        self.send_header('Content-Type', obj.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, total))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeAuth:
+    '''Drop-in replacement for BigQuery_Auth that builds unauthenticated
+    clients against a FakeServer.'''
+
+    def __init__(self, server_url, transport=None):
+        from transport import get_transport
+        self.server_url = server_url
+        self.discovery_url = server_url + DISCOVERY_PATH
+        self.transport = transport if transport is not None else get_transport()
+
+    def build_http(self):
+        import httplib2
+        return self.transport.build_http(httplib2.Http())
+
+    def build_bq_client(self):
+        from discovery_cache import build_client
+        # The documents of a fake server are only cached in memory; its port changes every run.
+        return build_client('bigquery', 'v2', self.build_http(), discovery_url=self.discovery_url,
+                            disk_cache=False)
+
+    def build_gcs_client(self):
+        from discovery_cache import build_client
+        return build_client('storage', 'v1', self.build_http(), discovery_url=self.discovery_url,
+                            disk_cache=False)
@@ -0,0 +1,289 @@
+#!/usr/bin/python2.7
+
+'''Runs the bigquery_tools readers against the local fake BigQuery/GCS server.
+
+Each benchmark case runs in its own child process so that peak RSS is
+measured per case. The fake server runs in the parent process and records
+request counts, rows and response bytes per API method. Results are written
+as JSON lines, one per case and repetition, so separate runs can be compared:
+
+python run_benchmarks.py --rows 200000 --latency 0.005 -o before.jsonl
+python run_benchmarks.py --rows 200000 --latency 0.005 -o after.jsonl --compare before.jsonl
+'''
+
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_DIR = os.path.join(os.path.dirname(HERE), 'bigquery_tools')
+
+DATASET_ID = 'bench'
+TABLE_ID = 'rows'
+BUCKET = 'bench-bucket'
+GCS_OBJECT = 'objects/blob.bin'
+
+CASES = ['table_read_null', 'table_read_file', 'table_read_csv', 'table_read_json',
+         'parallel_indexed_read', 'partition_discovery_read', 'query_read', 'gcs_download', 'startup']
+# Command line tools whose start-up time the startup case measures.
+STARTUP_TOOLS = ['table_reader', 'query_reader', 'gcs_reader', 'gcs_extract_read', 'metadata_reader',
+                 'dataset_export']
+
+
+def _package_imports():
+    # The package modules use implicit relative imports, so they are
+    # imported from their own directory, the same way the CLIs run.
+    if PACKAGE_DIR not in sys.path:
+        sys.path.insert(0, PACKAGE_DIR)
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def _make_handler(kind, output_file_name):
+    from output_handler import ResultHandler, FileResultHandler, CSVResultHandler, JSONResultHandler
+    if kind == 'null':
+        return ResultHandler()
+    if kind == 'file':
+        return FileResultHandler(output_file_name)
+    if kind == 'csv':
+        return CSVResultHandler(output_file_name)
+    if kind == 'json':
+        return JSONResultHandler(output_file_name)
+    raise ValueError('Unknown handler %s' % (kind,))
+
+
+def measure_startup(auth):
+    '''Times "TOOL.py --help" of every command line tool and building a client twice.'''
+    startup_seconds = {}
+    with open(os.devnull, 'w') as devnull:
+        for tool in STARTUP_TOOLS:
+            start = time.time()
+            subprocess.call([sys.executable, os.path.join(PACKAGE_DIR, tool + '.py'), '--help'],
+                            stdout=devnull, stderr=devnull)
+            startup_seconds[tool] = time.time() - start
+    client_seconds = []
+    for _ in range(2):
+        start = time.time()
+        auth.build_bq_client()
+        client_seconds.append(time.time() - start)
+    return {'startup_seconds': startup_seconds, 'client_seconds': client_seconds}
+
+
+def run_case(case, server_url, workdir, args):
+    '''Runs one benchmark case in the current process; returns extra result fields or None.'''
+    _package_imports()
+    from fake_server import FakeAuth, DEFAULT_PROJECT
+    from transport import transport_from_args
+    auth = FakeAuth(server_url, transport=transport_from_args(args))
+    output_file_name = os.path.join(workdir, 'output')
+    if case.startswith('table_read_'):
+        from table_reader import TableReader
+        reader = TableReader(auth, project_id=DEFAULT_PROJECT, dataset_id=DATASET_ID, table_id=TABLE_ID)
+        reader.read(_make_handler(case[len('table_read_'):], output_file_name))
+    elif case == 'parallel_indexed_read':
+        from table_reader import TableReader
+        reader = TableReader(auth, project_id=DEFAULT_PROJECT, dataset_id=DATASET_ID, table_id=TABLE_ID)
+        reader.parallel_indexed_read(partition_count=args.partition_count, output_dir=workdir,
+                                     output_format='csv')
+    elif case == 'partition_discovery_read':
+        from table_reader import TableReader
+        reader = TableReader(auth, project_id=DEFAULT_PROJECT, dataset_id=DATASET_ID, table_id=TABLE_ID)
+        reader.partition_discovery_read(output_dir=workdir, max_workers=args.partition_count,
+                                        output_format='csv')
+    elif case == 'query_read':
+        from query_reader import QueryReader
+        reader = QueryReader(auth, project_id=DEFAULT_PROJECT)
+        reader.read(_make_handler('csv', output_file_name),
+                    'SELECT * FROM [%s.%s]' % (DATASET_ID, TABLE_ID))
+    elif case == 'gcs_download':
+        from gcs_reader import GcsReader
+        reader = GcsReader(auth, BUCKET, download_dir=workdir)
+        reader.download_file(GCS_OBJECT)
+    elif case == 'startup':
+        return measure_startup(auth)
+    else:
+        raise ValueError('Unknown benchmark case %s' % (case,))
+
+
+def child_main(args):
+    '''Entry point of the child process: runs a case and reports its timings.'''
+    result = {'error': None}
+    start = time.time()
+    try:
+        result.update(run_case(args.child_case, args.server_url, args.workdir, args) or {})
+    except Exception as err:
+        result['error'] = '%s: %s' % (type(err).__name__, err)
+    result['wall_seconds'] = time.time() - start
+    # ru_maxrss is reported in kilobytes on Linux.
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['output_bytes'] = _dir_size(args.workdir)
+    with open(args.result_file, 'w') as f:
+        json.dump(result, f)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_partitions(rows, partition_count):
+    '''Splits rows over daily partitions with Zipf-like skew: partition i gets a share of 1/(i+1).'''
+    weights = [1.0 / (index + 1) for index in range(partition_count)]
+    partitions = []
+    for index, weight in enumerate(weights):
+        day = time.strftime('%Y%m%d', time.gmtime(1451606400 + index * 86400))
+        partitions.append((day, int(rows * weight / sum(weights))))
+    return partitions
+
+
+def make_server(args):
+    _package_imports()
+    from fake_server import FakeServer
+    server = FakeServer(latency=args.latency, latency_per_mb=args.latency_per_mb,
+                        max_page_rows=args.page_rows, job_duration=args.job_duration)
+    server.add_table(DATASET_ID, TABLE_ID, num_rows=args.rows, num_columns=args.columns,
+                     value_width=args.value_width, partitions=make_partitions(args.rows, args.partitions))
+    server.add_object(BUCKET, GCS_OBJECT, size=args.object_size)
+    return server.start()
+
+
+def run_in_child(case, server, args, passthrough):
+    workdir = tempfile.mkdtemp(prefix='bqbench_')
+    handle, result_file = tempfile.mkstemp(prefix='bqbench_', suffix='.json')
+    os.close(handle)
+    command = [sys.executable, os.path.abspath(__file__), '--child-case', case,
+               '--server-url', server.url, '--workdir', workdir, '--result-file', result_file] + passthrough
+    server.stats.reset()
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = None if args.verbose else devnull
+            status = subprocess.call(command, stdout=output, stderr=output)
+        with open(result_file) as f:
+            content = f.read()
+        if content:
+            result = json.loads(content)
+        else:
+            result = {'error': 'Benchmark process exited with status %d' % (status,),
+                      'wall_seconds': None, 'peak_rss_kb': None, 'output_bytes': None}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if os.path.exists(result_file):
+            os.remove(result_file)
+    stats = server.stats.snapshot()
+    seconds = result['wall_seconds'] or float('nan')
+    result.update({
+        'case': case,
+        'rows': stats['rows'],
+        'rows_per_second': stats['rows'] / seconds,
+        'response_bytes': stats['total_response_bytes'],
+        'mb_per_second': stats['total_response_bytes'] / (1024.0 * 1024.0) / seconds,
+        'total_requests': stats['total_requests'],
+        'requests': stats['requests'],
+    })
+    return result
+
+
+def compare(results, baseline_file):
+    '''Prints the wall-clock speedup of each case against the best previous run.'''
+    baseline = {}
+    with open(baseline_file) as f:
+        for line in f:
+            if line.strip():
+                previous = json.loads(line)
+                baseline.setdefault(previous['case'], []).append(previous)
+    print '%-24s %14s %14s %10s' % ('case', 'rows/s', 'MB/s', 'speedup')
+    for result in results:
+        previous = baseline.get(result['case'])
+        if not previous:
+            continue
+        previous = [r for r in previous if r['wall_seconds'] and not r['error']]
+        if not previous or not result['wall_seconds']:
+            continue
+        best = min(previous, key=lambda r: r['wall_seconds'])
+        ratio = best['wall_seconds'] / result['wall_seconds']
+        print '%-24s %14.0f %14.2f %9.2fx' % (result['case'], result['rows_per_second'],
+                                               result['mb_per_second'], ratio)
+
+
+def make_parser():
+    _package_imports()
+    from transport import add_transport_arguments
+    parser = ArgumentParser(description='Benchmark bigquery_tools against a local fake BigQuery/GCS server')
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=CASES, help='Benchmark cases to run')
+    parser.add_argument('--rows', type=int, default=100000, help='Number of rows in the benchmark table')
+    parser.add_argument('--columns', type=int, default=8, help='Number of columns in the benchmark table')
+    parser.add_argument('--value_width', type=int, default=12, help='Width of generated string values')
+    parser.add_argument('--page_rows', type=int, help='Server-side cap on rows per page')
+    parser.add_argument('--latency', type=float, default=0.0, help='Added latency per request, in seconds')
+    parser.add_argument('--latency_per_mb', type=float, default=0.0,
+                        help='Added latency per MB of response, in seconds')
+    parser.add_argument('--job_duration', type=float, default=0.5, help='Seconds until a fake job is DONE')
+    parser.add_argument('--object_size', type=int, default=32 * 1024 * 1024, help='Size of the GCS object')
+    parser.add_argument('--partition_count', type=int, default=4, help='Partitions or workers for parallel reads')
+    parser.add_argument('--partitions', type=int, default=30, help='Number of daily partitions of the table')
+    parser.add_argument('--repeat', type=int, default=1, help='Repetitions of every case')
+    parser.add_argument('-o', '--output', help='File the JSON lines results are appended to')
+    parser.add_argument('--compare', help='Previous results file to compare against')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the output of the readers')
+    add_transport_arguments(parser)
+    parser.add_argument('--child-case', dest='child_case', help='Internal: run a single case')
+    parser.add_argument('--server-url', dest='server_url', help='Internal: fake server URL')
+    parser.add_argument('--workdir', help='Internal: output directory of a case')
+    parser.add_argument('--result-file', dest='result_file', help='Internal: child result file')
+    return parser
+
+
+def main(argv):
+    args = make_parser().parse_args(argv)
+    if args.child_case:
+        child_main(args)
+        return
+    passthrough = ['--partition_count', str(args.partition_count),
+                   '--transport_report', str(args.transport_report)]
+    if args.full_responses:
+        passthrough.append('--full_responses')
+    if args.no_gzip:
+        passthrough.append('--no_gzip')
+    server = make_server(args)
+    params = dict((key, getattr(args, key)) for key in
+                  ['rows', 'columns', 'value_width', 'page_rows', 'latency', 'latency_per_mb',
+                   'object_size', 'partition_count', 'partitions', 'full_responses', 'no_gzip'])
+    revision = git_revision()
+    results = []
+    try:
+        for case in args.cases:
+            for repetition in range(args.repeat):
+                result = run_in_child(case, server, args, passthrough)
+                result.update({'repetition': repetition, 'params': params, 'revision': revision,
+                               'timestamp': int(time.time())})
+                results.append(result)
+                line = json.dumps(result, sort_keys=True)
+                if args.output:
+                    with open(args.output, 'a') as f:
+                        f.write(line + '\n')
+                print line
+    finally:
+        server.stop()
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -9,28 +9,45 @@ generating authorized clients. The module can also be run directly
 to print out the HTTP authorization header for use in curl commands.
 Note that the first time this module is run (either directly or via
 a sample script) it will trigger the OAuth authorization process.
+
+httplib2 and oauth2client are imported when credentials are first needed,
+and clients are built from cached discovery documents (discovery_cache.py),
+so importing the CLIs and building clients stays fast.
+
+All clients of a BigQuery_Auth (and of other BigQuery_Auth objects with the
+same credentials, also in other processes) share one access token through a
+TokenBroker (token_broker.py), which refreshes it once before it expires.
 '''
 
 from argparse import ArgumentParser
 import sys
+import hashlib
 import json
 import os
-import httplib2
-from apiclient import discovery
-from oauth2client.client import flow_from_clientsecrets
-from oauth2client import tools
-from oauth2client.file import Storage
-from oauth2client.client import GoogleCredentials
-
-HAS_CRYPTO = False
-try:
-    # Some systems may not have OpenSSL installed so can't use SignedJwtAssertionCredentials.
-    from oauth2client.client import SignedJwtAssertionCredentials
-    HAS_CRYPTO = True
-except ImportError:
-    pass
+import threading
+from discovery_cache import DEFAULT_CACHE_DIR, build_client
+from token_broker import BrokeredHttp, get_token_broker
+from transport import get_transport
 
 BIGQUERY_SCOPE = 'https://www.googleapis.com/auth/bigquery'
+ADC_FILE_NAME = 'application_default_credentials.json'
+
+
+def get_application_default_file():
+    '''Returns the file the application default credentials are loaded from, as
+    oauth2client resolves it, or None if they come from the metadata server.'''
+    file_name = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
+    if file_name:
+        return os.path.abspath(os.path.expanduser(file_name))
+    if os.environ.get('CLOUDSDK_CONFIG'):
+        config_dir = os.environ['CLOUDSDK_CONFIG']
+    elif os.name == 'nt':
+        config_dir = os.path.join(os.environ.get('APPDATA', ''), 'gcloud')
+    else:
+        config_dir = os.path.join(os.path.expanduser('~'), '.config', 'gcloud')
+    file_name = os.path.join(config_dir, ADC_FILE_NAME)
+    return os.path.abspath(file_name) if os.path.exists(file_name) else None
+
 
 class BigQuery_Auth:
     """
@@ -41,11 +58,37 @@ class BigQuery_Auth:
     credentials = 'bigquery_credentials.dat'
     """
 
-    def __init__(self, service_acc, client_secrets = None, credentials=None, key_file=None):
+    def __init__(self, service_acc, client_secrets = None, credentials=None, key_file=None, transport=None,
+                 token_cache=True):
         self.SERVICE_ACCT = service_acc
         self.CLIENT_SECRETS = client_secrets
         self.CREDENTIALS_FILE = credentials
         self.KEY_FILE = key_file
+        self.transport = transport if transport is not None else get_transport()
+        # Credentials are loaded once and shared by all clients.
+        self.credentials = None
+        self.credentials_lock = threading.Lock()
+        cache_file = None
+        if token_cache:
+            cache_file = os.path.join(os.environ.get('BIGQUERY_TOOLS_CACHE', DEFAULT_CACHE_DIR), 'tokens.json')
+        self.token_broker = get_token_broker(self.get_token_key(), cache_file=cache_file)
+
+    def get_token_key(self):
+        '''Identifies the credentials in the token cache.'''
+        if self.CLIENT_SECRETS is None:
+            file_name = get_application_default_file()
+            source = 'application-default'
+            if file_name is not None and os.path.exists(file_name):
+                # The contents tell accounts apart, e.g. after gcloud auth application-default login.
+                with open(file_name, 'rb') as f:
+                    source = '%s:%s:%s' % (source, file_name, hashlib.md5(f.read()).hexdigest())
+            elif file_name is not None:
+                source = '%s:%s' % (source, file_name)
+        elif self.KEY_FILE is not None and os.path.exists(self.KEY_FILE):
+            source = os.path.abspath(self.KEY_FILE)
+        else:
+            source = os.path.abspath(os.path.expanduser(self.CREDENTIALS_FILE or ''))
+        return hashlib.md5(json.dumps([self.SERVICE_ACCT, source, BIGQUERY_SCOPE])).hexdigest()
 
     def get_creds(self):
         '''Get credentials for use in API requests.
@@ -64,6 +107,9 @@ class BigQuery_Auth:
         Will prompt the user to authorize the client when run the first time.
         Saves the credentials in self.CREDENTIALS_FILE.
         '''
+        from oauth2client.client import flow_from_clientsecrets
+        from oauth2client import tools
+        from oauth2client.file import Storage
         assert (self.CLIENT_SECRETS is not None)
         flow = flow_from_clientsecrets(self.CLIENT_SECRETS, scope=BIGQUERY_SCOPE)
         storage = Storage(os.path.expanduser(self.CREDENTIALS_FILE))
@@ -71,9 +117,7 @@ class BigQuery_Auth:
         if credentials is None or credentials.invalid:
             flags = tools.argparser.parse_args([])
             credentials = tools.run_flow(flow, storage, flags)
-        else:
-            # Make sure we have an up-to-date copy of the credentials
-            credentials.refresh(httplib2.Http())
+        # The access token is refreshed by the token broker when it is needed.
         return credentials
 
 
@@ -82,7 +126,10 @@ class BigQuery_Auth:
         service_acct: service account ID.
         key_file: path to file containing private key.
         '''
-        if not HAS_CRYPTO:
+        try:
+            # Some systems may not have OpenSSL installed so can't use SignedJwtAssertionCredentials.
+            from oauth2client.client import SignedJwtAssertionCredentials
+        except ImportError:
             raise Exception("Unable to use cryptographic functions. Try installing OpenSSL")
         with open(key_file, 'rb') as f:
             key = f.read()
@@ -91,6 +138,7 @@ class BigQuery_Auth:
 
     def authorize(self, credentials):
         '''Construct a HTTP client that uses the supplied credentials.'''
+        import httplib2
         return credentials.authorize(httplib2.Http())
 
     def print_creds(self, credentials):
@@ -101,16 +149,39 @@ class BigQuery_Auth:
         else:
             print 'Credentials: %s' % (cred_dict,)
 
+    def get_client_creds(self):
+        '''Returns the credentials of the clients, loading them on the first call.
+
+        Without client secrets the application default credentials are used.
+        '''
+        with self.credentials_lock:
+            if self.credentials is None:
+                if self.CLIENT_SECRETS is not None:
+                    self.credentials = self.get_creds()
+                else:
+                    from oauth2client.client import GoogleCredentials
+                    credentials = GoogleCredentials.get_application_default()
+                    if credentials.create_scoped_required():
+                        credentials = credentials.create_scoped(BIGQUERY_SCOPE)
+                    self.credentials = credentials
+            return self.credentials
+
+    def get_access_token(self):
+        '''Returns a valid access token from the token broker.'''
+        return self.token_broker.get_token(self.get_client_creds())
+
+    def build_http(self):
+        '''Constructs a HTTP client authorized with the shared access token.'''
+        import httplib2
+        return self.transport.build_http(BrokeredHttp(self.token_broker, self.get_client_creds(), httplib2.Http()))
+
     def build_bq_client(self):
         '''Constructs a bigquery client object.'''
-        if self.CLIENT_SECRETS is not None:
-            return discovery.build('bigquery', 'v2', http=self.get_creds().authorize(httplib2.Http()))
-        else:
-            return discovery.build('bigquery', 'v2', credentials=GoogleCredentials.get_application_default())
+        return build_client('bigquery', 'v2', self.build_http())
 
     def build_gcs_client(self):
         '''Constructs a Google Cloud Storage client object.'''
-        return discovery.build('storage', 'v1', http=self.get_creds().authorize(httplib2.Http()))
+        return build_client('storage', 'v1', self.build_http())
 
 
 def main(argv):
@@ -126,7 +197,7 @@ def main(argv):
 
     auth = BigQuery_Auth(service_acc=args.service_account, client_secrets=args.client_secret,
                          credentials=args.credentials, key_file=args.keyfile)
-    auth.print_creds(auth.get_creds())
+    print 'Authorization: Bearer %s' % (auth.get_access_token(),)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,149 @@
+#!/usr/bin/python2.7
+
+'''Checksums of downloaded GCS objects.
+
+GCS object metadata carries the base64 encoded MD5 (not for composite
+objects) and CRC32C of the content. An ObjectHasher computes both while a
+download is written, so the result can be verified without reading the file
+again. CRC32C requires crcmod; without it only MD5 is checked.
+
+A HashIndex remembers the size, modification time and hashes of every file
+downloaded into a directory, so a later sync can tell that a local file is
+up to date from its size and mtime alone, without re-reading it.
+'''
+
+import base64
+import hashlib
+import json
+import os
+import threading
+
+HAS_CRCMOD = False
+try:
+    import crcmod.predefined
+    HAS_CRCMOD = True
+except ImportError:
+    pass
+
+# Name of the hash index file kept in a download directory.
+INDEX_FILE_NAME = '.gcs_hash_index.json'
+# Block size used to hash existing files.
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class ChecksumMismatch(Exception):
+    '''Raised when downloaded content does not match the object metadata.'''
+    pass
+
+
+class ObjectHasher:
+    '''Incrementally computes the MD5 and CRC32C of object content.'''
+
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.crc32c = crcmod.predefined.Crc('crc-32c') if HAS_CRCMOD else None
+        self.size = 0
+
+    def update(self, data):
+        self.md5.update(data)
+        if self.crc32c is not None:
+            self.crc32c.update(data)
+        self.size += len(data)
+
+    def hashes(self):
+        '''Returns the hashes base64 encoded like the md5Hash and crc32c metadata fields.'''
+        hashes = {'md5Hash': base64.b64encode(self.md5.digest())}
+        if self.crc32c is not None:
+            hashes['crc32c'] = base64.b64encode(self.crc32c.digest())
+        return hashes
+
+
+def compare_hashes(hashes, metadata):
+    '''Returns True if all hashes present in both match, False on a mismatch and
+    None if there is nothing to compare.'''
+    compared = [key for key in ('crc32c', 'md5Hash') if hashes.get(key) and metadata.get(key)]
+    if not compared:
+        return None
+    return all(hashes[key] == metadata[key] for key in compared)
+
+
+class HashingWriter:
+    '''A file wrapper that hashes everything written to it.'''
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.hasher = ObjectHasher()
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.output_file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.output_file, name)
+
+
+def hash_file(file_name):
+    '''Hashes an existing file.'''
+    hasher = ObjectHasher()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), ''):
+            hasher.update(block)
+    return hasher.hashes()
+
+
+class HashIndex:
+    '''Maps file names (relative to a directory) to their size, mtime and hashes.'''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.file_name = os.path.join(directory, INDEX_FILE_NAME)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.file_name):
+            with open(self.file_name) as f:
+                self.entries = json.load(f)
+
+    def get_hashes(self, name):
+        '''Returns the hashes of a local file, re-hashing it only if it changed since it was indexed.'''
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry['hashes']
+        hashes = hash_file(path)
+        self.set_hashes(name, hashes)
+        return hashes
+
+    def set_hashes(self, name, hashes):
+        stat = os.stat(os.path.join(self.directory, name))
+        with self.lock:
+            self.entries[name] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hashes': hashes}
+
+    def remove(self, name):
+        with self.lock:
+            self.entries.pop(name, None)
+
+    def save(self):
+        '''Writes the index to a temporary file and renames it over the old one.'''
+        with self.lock:
+            content = json.dumps(self.entries, indent=2, sort_keys=True)
+            temp_file_name = '%s.%d.%s.tmp' % (self.file_name, os.getpid(), threading.current_thread().ident)
+            with open(temp_file_name, 'w') as f:
+                f.write(content)
+            os.rename(temp_file_name, self.file_name)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_hash_index(directory):
+    '''Returns the HashIndex of a directory, shared by all readers in the process.'''
+    directory = os.path.abspath(directory)
+    with _indexes_lock:
+        if directory not in _indexes:
+            _indexes[directory] = HashIndex(directory)
+        return _indexes[directory]
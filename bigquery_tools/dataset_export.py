@@ -0,0 +1,218 @@
+#!/usr/bin/python2.7
+
+'''Exports all tables of a dataset on one shared pool of reader threads.
+
+The export runs in two phases. First every table of the dataset is planned
+(concurrently): its size and schema are looked up and tables with more than
+split_rows rows are split into index ranges of a snapshot. Then all work
+units of all tables run on one WorkerPool. The units are scheduled fairly:
+round robin over the tables, so the first unit of every table is started
+before the second unit of any table, and large tables do not starve small
+ones. max_workers bounds the number of concurrent reads and
+--max_requests_per_second the rate of API calls of the whole export.
+
+The outputs, their row counts and failed units are recorded in a manifest
+(<output_directory>/<dataset_id>.manifest.json, see manifest.py).
+
+Usage from the command line:
+python dataset_export.py [options]
+'''
+
+import os
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from auth import BigQuery_Auth
+from manifest import ExportManifest
+from metadata_reader import MetadataReader
+from metrics import get_metrics, add_metrics_arguments, metrics_from_args
+from output_writer import add_writer_arguments, writer_options_from_args
+from output_handler import add_rotation_arguments
+from table_reader import TableReader, TableReadThread
+from transport import add_transport_arguments, transport_from_args
+from worker_pool import WorkerPool
+
+DEFAULT_SPLIT_ROWS = 1000000
+
+
+class WorkUnit:
+    '''An index range (or all) of one table, written to one output file.'''
+
+    def __init__(self, table_id, file_name, row_count, columns, start_index=None, read_count=None,
+                 snapshot_time=None):
+        self.table_id = table_id
+        self.file_name = file_name
+        self.row_count = row_count
+        self.columns = columns
+        self.start_index = start_index
+        self.read_count = read_count
+        self.snapshot_time = snapshot_time
+
+    def size(self):
+        return self.read_count if self.read_count is not None else self.row_count
+
+
+class DatasetExporter:
+    '''Plans and exports all tables of a dataset.'''
+
+    def __init__(self, auth, project_id, dataset_id, output_dir, output_format='csv', sep=';',
+                 max_workers=10, split_rows=DEFAULT_SPLIT_ROWS, tables=None, max_file_rows=None,
+                 max_file_bytes=None, metrics=None, verbose=False):
+        self.auth = auth
+        self.project_id = project_id
+        self.dataset_id = dataset_id
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.sep = sep
+        self.max_workers = max_workers
+        self.split_rows = split_rows
+        self.tables = tables
+        self.max_file_rows = max_file_rows
+        self.max_file_bytes = max_file_bytes
+        self.metrics = metrics if metrics is not None else get_metrics()
+        self.verbose = verbose
+        self.manifest = ExportManifest(os.path.join(output_dir, '%s.manifest.json' % (dataset_id,)),
+                                       source='%s:%s' % (project_id, dataset_id))
+        # Serializes manifest saves, which are made from the worker threads.
+        self.save_lock = threading.Lock()
+        self.failed = []
+
+    def list_tables(self):
+        '''Returns the ids of the tables to export; views are skipped.'''
+        tables = [table['tableReference']['tableId']
+                  for table in MetadataReader(self.auth).iter_tables(self.project_id, self.dataset_id)
+                  if table.get('type', 'TABLE') == 'TABLE']
+        if self.tables is not None:
+            tables = [table_id for table_id in tables if table_id in self.tables]
+        return sorted(tables)
+
+    def make_file_name(self, table_id, index=None):
+        base_name = os.path.join(self.output_dir, table_id)
+        if index is not None:
+            base_name = '%s.%d' % (base_name, index)
+        return '%s.%s' % (base_name, self.output_format)
+
+    def plan_table(self, table_id):
+        '''Returns the work units of one table.'''
+        reader = TableReader(self.auth, self.project_id, self.dataset_id, table_id, metrics=self.metrics)
+        _, row_count, columns, _ = reader.get_table_info()
+        pieces = max(1, -(-row_count // self.split_rows))
+        if pieces == 1:
+            return [WorkUnit(table_id, self.make_file_name(table_id), row_count, columns)]
+        # The ranges of a split table are read from the same snapshot.
+        snapshot_time = int(time.time() * 1000)
+        stride = -(-row_count // pieces)
+        return [WorkUnit(table_id, self.make_file_name(table_id, index), row_count, columns,
+                         start_index=index * stride, read_count=min(stride, row_count - index * stride),
+                         snapshot_time=snapshot_time)
+                for index in range(pieces)]
+
+    def plan(self, pool):
+        '''Plans all tables concurrently and returns their work units in fair order.'''
+        plans = {}
+
+        def plan_table(table_id):
+            plans[table_id] = self.plan_table(table_id)
+
+        table_ids = self.list_tables()
+        for table_id in table_ids:
+            pool.submit(0, plan_table, table_id)
+        pool.join()
+        units = []
+        for round_index in range(max([len(table_units) for table_units in plans.values()] or [0])):
+            # Within a round, larger units start first.
+            round_units = [plans[table_id][round_index] for table_id in table_ids
+                           if round_index < len(plans[table_id])]
+            units.extend(sorted(round_units, key=lambda unit: -unit.size()))
+        print 'Exporting %d rows of %d tables in %d units' % (
+            sum(table_units[0].row_count for table_units in plans.values()), len(plans), len(units))
+        return units
+
+    def run_unit(self, unit):
+        table_id = unit.table_id
+        if unit.snapshot_time is not None:
+            table_id = '%s@%d' % (table_id, unit.snapshot_time)
+        reader = TableReader(self.auth, self.project_id, self.dataset_id, table_id,
+                             start_index=unit.start_index, read_count=unit.read_count,
+                             metrics=self.metrics, verbose=self.verbose)
+        thread_id = unit.table_id
+        if unit.start_index is not None:
+            thread_id = '%s[%d-%d)' % (unit.table_id, unit.start_index, unit.start_index + unit.read_count)
+        thread = TableReadThread(reader, unit.file_name, thread_id=thread_id, output_format=self.output_format,
+                                 sep=self.sep, columns=unit.columns, row_count=unit.size(),
+                                 max_file_rows=self.max_file_rows, max_file_bytes=self.max_file_bytes)
+        try:
+            thread.run()
+        except Exception as err:
+            print '%s failed: %s' % (thread_id, err)
+            self.failed.append(thread_id)
+            self.manifest.remove_output(unit.file_name)
+        else:
+            self.manifest.set_output(unit.file_name, table=unit.table_id, rows=reader.rows_read,
+                                     start_index=unit.start_index, snapshot_time=unit.snapshot_time)
+        with self.save_lock:
+            self.manifest.save()
+
+    def export(self):
+        '''Exports the dataset and returns the ids of the failed work units.'''
+        if not (os.path.exists(self.output_dir) and os.path.isdir(self.output_dir)):
+            os.makedirs(self.output_dir)
+        pool = WorkerPool(self.max_workers, metrics=self.metrics, name='dataset_export')
+        units = self.plan(pool)
+        for position, unit in enumerate(units):
+            # The pool runs the largest size first; the sizes keep the fair order.
+            pool.submit(len(units) - position, self.run_unit, unit)
+        pool.join()
+        self.manifest.set_state('failed', list(self.failed))
+        self.manifest.set_state('finished', int(time.time()))
+        self.manifest.save()
+        return self.failed
+
+
+def main(argv):
+    parser = ArgumentParser(description='Export all tables of a BigQuery dataset into text files')
+    parser.add_argument('-a', '--service_account', required=True, help='Big Query service account name')
+    parser.add_argument('-s', '--client_secret', required=True,
+                        help='Path to client_secrets.json file required for API login')
+    parser.add_argument('-c', '--credentials',
+                        help='Path to credentials file (e.g. bigquery_credentials.dat) required for API login. '
+                             'If the file is not present, the browser window will be shown and you will be asked to authenticate')
+    parser.add_argument('-k', '--keyfile', help='Path to the key file (e.g., key.p12)')
+    parser.add_argument('-p', '--project_id', required=True, help='BigQuery project ID')
+    parser.add_argument('-d', '--dataset_id', required=True, help='BigQuery dataset ID')
+    parser.add_argument('-t', '--tables', help='Comma separated list of tables to export (default: all tables)')
+    parser.add_argument('-o', '--output_directory', default='.', help='The directory where the output will be exported')
+    parser.add_argument('-f', '--format', default='csv', choices=['json', 'csv'], help='The output format')
+    parser.add_argument('--separator', help='Separator in CSV', default=';')
+    parser.add_argument('--max_workers', type=int, default=10, help='Number of concurrent reads')
+    parser.add_argument('--split_rows', type=int, default=DEFAULT_SPLIT_ROWS,
+                        help='Split tables larger than this into index ranges')
+    add_rotation_arguments(parser)
+    add_writer_arguments(parser)
+    add_metrics_arguments(parser)
+    add_transport_arguments(parser)
+    args = parser.parse_args()
+    metrics = metrics_from_args(args)
+    writer_options_from_args(args)
+    transport = transport_from_args(args)
+
+    auth = BigQuery_Auth(service_acc=args.service_account, client_secrets=args.client_secret,
+                         credentials=args.credentials, key_file=args.keyfile, transport=transport)
+    exporter = DatasetExporter(auth, args.project_id, args.dataset_id, args.output_directory,
+                               output_format=args.format, sep=args.separator, max_workers=args.max_workers,
+                               split_rows=args.split_rows, max_file_rows=args.max_file_rows,
+                               max_file_bytes=args.max_file_bytes,
+                               tables=[table.strip() for table in args.tables.split(',')] if args.tables else None,
+                               metrics=metrics, verbose=args.verbose)
+    failed = exporter.export()
+    metrics.close()
+    if args.transport_report:
+        print transport.format_report()
+    if failed:
+        print '%d work units failed: %s' % (len(failed), ', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
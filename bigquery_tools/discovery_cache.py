@@ -0,0 +1,83 @@
+#!/usr/bin/python2.7
+
+'''Cached API discovery documents.
+
+discovery.build fetches the discovery document of an API over the network
+every time a client is built. build_client builds clients from a cached
+copy instead: documents are kept in memory for the life of the process and
+on disk (in ~/.cache/bigquery_tools/discovery, or $BIGQUERY_TOOLS_CACHE)
+for MAX_AGE seconds, so only the first run after that fetches them again.
+If the refresh fails, the stale copy is used. The clients decode responses
+with the codec selected by json_codec.
+'''
+
+import hashlib
+import os
+import threading
+import time
+
+DISCOVERY_URI = 'https://www.googleapis.com/discovery/v1/apis/{api}/{apiVersion}/rest'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'bigquery_tools')
+# Seconds a cached discovery document is used before it is fetched again.
+MAX_AGE = 24 * 3600
+
+_documents = {}
+_documents_lock = threading.Lock()
+
+
+def get_cache_dir():
+    return os.path.join(os.environ.get('BIGQUERY_TOOLS_CACHE', DEFAULT_CACHE_DIR), 'discovery')
+
+
+def fetch_document(url):
+    import httplib2
+    resp, content = httplib2.Http().request(url)
+    if resp.status >= 400:
+        raise Exception('Unable to fetch the discovery document %s: HTTP %s' % (url, resp.status))
+    return content
+
+
+def get_discovery_document(api, version, discovery_url=DISCOVERY_URI, disk_cache=True):
+    '''Returns the discovery document of an API, from memory, the disk cache or the network.'''
+    url = discovery_url.replace('{api}', api).replace('{apiVersion}', version)
+    with _documents_lock:
+        if url in _documents:
+            return _documents[url]
+    file_name = os.path.join(get_cache_dir(), '%s.%s.%s.json' % (api, version, hashlib.md5(url).hexdigest()[:8]))
+    document = None
+    if disk_cache and os.path.exists(file_name) and time.time() - os.path.getmtime(file_name) < MAX_AGE:
+        with open(file_name) as f:
+            document = f.read()
+    if document is None:
+        try:
+            document = fetch_document(url)
+        except Exception:
+            if not (disk_cache and os.path.exists(file_name)):
+                raise
+            with open(file_name) as f:
+                document = f.read()
+        else:
+            if disk_cache:
+                save_document(file_name, document)
+    with _documents_lock:
+        _documents[url] = document
+    return document
+
+
+def save_document(file_name, document):
+    '''Writes a document to a temporary file and renames it over the old one.'''
+    directory = os.path.dirname(file_name)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp_file_name = '%s.%d.%s.tmp' % (file_name, os.getpid(), threading.current_thread().ident)
+    with open(temp_file_name, 'w') as f:
+        f.write(document)
+    os.rename(temp_file_name, file_name)
+
+
+def build_client(api, version, http, discovery_url=DISCOVERY_URI, disk_cache=True):
+    '''Builds an API client from the cached discovery document.'''
+    from googleapiclient import discovery
+    from json_codec import make_json_model
+    return discovery.build_from_document(get_discovery_document(api, version, discovery_url, disk_cache),
+                                         http=http, model=make_json_model())
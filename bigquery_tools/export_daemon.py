@@ -0,0 +1,424 @@
+#!/usr/bin/python2.7
+
+'''Runs exports as a long-lived service.
+
+Every command line export pays for starting Python, loading credentials
+and building clients. The daemon does this once: it keeps one
+authenticated BigQuery_Auth whose BigQuery and GCS clients are cached per
+worker thread (so their HTTP connections stay open between jobs), together
+with the shared access token and the discovery documents. Jobs are queued
+on one WorkerPool; jobs with a higher priority run first.
+
+The API is JSON over HTTP on 127.0.0.1 (--port) or on a Unix socket
+(--socket), which only the user can connect to. Requests on the port must
+be addressed to 127.0.0.1 or localhost (Host header) and jobs must be
+posted as application/json, so web pages cannot submit jobs:
+
+  POST /jobs        submit a job, e.g.
+                    {"type": "table", "project_id": "p", "dataset_id": "d",
+                     "table_id": "t", "output_dir": "/data/t", "format": "csv"}
+                    returns {"id": "..."}
+  GET  /jobs        all known jobs
+  GET  /jobs/ID     the state, timings, result or error of one job
+  GET  /status      workers, queue depth, job counts and uptime
+  GET  /metrics     request totals and gauges (see metrics.py) and token broker counts
+
+Job types and their parameters (besides "priority"):
+  table    project_id, dataset_id, table_id, output_dir[, format, separator,
+           strategy (auto, single-thread, parallel-indexed, partition-discovery),
+           max_workers, gcs_bucket, max_file_rows, max_file_bytes]
+  dataset  project_id, dataset_id, output_dir[, format, separator, tables,
+           max_workers, split_rows, max_file_rows, max_file_bytes]
+  query    project_id, query, output_dir[, result_name, format, separator,
+           temp_dataset (runs read_large), strategy, max_workers, gcs_bucket]
+  extract  project_id, dataset_id, table_id, gcs_bucket, output_dir[,
+           extract_format (json, csv, avro), compression, output_format]
+
+Usage from the command line:
+python export_daemon.py [options]
+'''
+
+import BaseHTTPServer
+import SocketServer
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+from argparse import ArgumentParser
+from auth import BigQuery_Auth
+from metrics import get_metrics, add_metrics_arguments, metrics_from_args
+from output_handler import close_idle_sqlite_writers, make_result_handler
+from transport import add_transport_arguments, transport_from_args
+from worker_pool import WorkerPool
+
+DEFAULT_PORT = 8765
+# Host headers accepted on the HTTP port.
+ALLOWED_HOSTS = ('127.0.0.1', 'localhost')
+# Finished jobs kept for GET /jobs; older ones are forgotten.
+MAX_FINISHED_JOBS = 1000
+
+REQUIRED_PARAMS = {
+    'table': ['project_id', 'dataset_id', 'table_id', 'output_dir'],
+    'dataset': ['project_id', 'dataset_id', 'output_dir'],
+    'query': ['project_id', 'query', 'output_dir'],
+    'extract': ['project_id', 'dataset_id', 'table_id', 'gcs_bucket', 'output_dir'],
+}
+
+
+class WarmAuth(BigQuery_Auth):
+    '''A BigQuery_Auth that keeps one BigQuery and one GCS client per thread.
+
+    API clients are not thread-safe, but the worker threads of the daemon
+    live as long as the daemon, so each reuses its clients and their
+    connections for all of its jobs.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        BigQuery_Auth.__init__(self, *args, **kwargs)
+        self.clients = threading.local()
+
+    def build_bq_client(self):
+        client = getattr(self.clients, 'bq_client', None)
+        if client is None:
+            client = self.clients.bq_client = BigQuery_Auth.build_bq_client(self)
+        return client
+
+    def build_gcs_client(self):
+        client = getattr(self.clients, 'gcs_client', None)
+        if client is None:
+            client = self.clients.gcs_client = BigQuery_Auth.build_gcs_client(self)
+        return client
+
+
+class ExportJob:
+    '''A submitted job and its state: QUEUED, RUNNING, DONE or FAILED.'''
+
+    def __init__(self, job_id, job_type, params):
+        self.job_id = job_id
+        self.job_type = job_type
+        self.params = params
+        self.state = 'QUEUED'
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+
+    def to_dict(self):
+        return {'id': self.job_id, 'type': self.job_type, 'params': self.params, 'state': self.state,
+                'submitted': self.submitted, 'started': self.started, 'finished': self.finished,
+                'result': self.result, 'error': self.error}
+
+
+class ExportDaemon:
+    '''Queues jobs on a shared worker pool and runs them with warm clients.'''
+
+    def __init__(self, auth, max_workers=4, metrics=None, verbose=False):
+        self.auth = auth
+        self.max_workers = max_workers
+        self.metrics = metrics if metrics is not None else get_metrics()
+        self.verbose = verbose
+        self.pool = WorkerPool(max_workers, metrics=self.metrics, name='daemon')
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.counter = itertools.count(1)
+        self.started = time.time()
+
+    def submit(self, request):
+        '''Validates a job request (a dict) and queues it; returns the ExportJob.'''
+        params = dict(request)
+        job_type = params.pop('type', None)
+        if job_type not in REQUIRED_PARAMS:
+            raise ValueError('Unknown job type %s, expected one of %s' % (
+                job_type, ', '.join(sorted(REQUIRED_PARAMS))))
+        missing = [name for name in REQUIRED_PARAMS[job_type] if name not in params]
+        if missing:
+            raise ValueError('Missing parameters for a %s job: %s' % (job_type, ', '.join(missing)))
+        priority = int(params.pop('priority', 0))
+        job = ExportJob('%s-%d' % (job_type, next(self.counter)), job_type, params)
+        with self.lock:
+            self.jobs[job.job_id] = job
+            self.forget_finished()
+        self.pool.submit(priority, self.run_job, job)
+        return job
+
+    def forget_finished(self):
+        '''Drops the oldest finished jobs beyond MAX_FINISHED_JOBS; called with the lock held.'''
+        finished = sorted((job for job in self.jobs.values() if job.finished is not None),
+                          key=lambda job: job.finished)
+        for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[job.job_id]
+
+    def get_job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda job: job.submitted)
+
+    def run_job(self, job):
+        self.metrics.add_gauge('daemon_jobs_running', 1)
+        job.state = 'RUNNING'
+        job.started = time.time()
+        print 'Running %s' % (job.job_id,)
+        try:
+            job.result = getattr(self, 'run_%s' % (job.job_type,))(job.params)
+            job.state = 'DONE'
+        except Exception as err:
+            job.error = '%s: %s' % (type(err).__name__, err)
+            job.state = 'FAILED'
+            if self.verbose:
+                traceback.print_exc()
+        finally:
+            # The next job into the same SQLite file replaces its tables.
+            close_idle_sqlite_writers()
+            job.finished = time.time()
+            self.metrics.add_gauge('daemon_jobs_running', -1)
+            self.metrics.emit('daemon_job', job_id=job.job_id, type=job.job_type, state=job.state,
+                              elapsed=job.finished - job.started)
+        print '%s %s in %.1fs' % (job.job_id, job.state, job.finished - job.started)
+
+    def make_output_dir(self, output_dir):
+        if not (os.path.exists(output_dir) and os.path.isdir(output_dir)):
+            os.makedirs(output_dir)
+
+    def run_table(self, params):
+        from table_reader import TableReader, TableReadThread
+        output_dir = params['output_dir']
+        output_format = params.get('format', 'csv')
+        sep = params.get('separator', ';')
+        max_workers = int(params.get('max_workers', self.max_workers))
+        reader = TableReader(self.auth, params['project_id'], params['dataset_id'], params['table_id'],
+                             metrics=self.metrics, verbose=self.verbose)
+        strategy = params.get('strategy', 'auto')
+        self.make_output_dir(output_dir)
+        if strategy == 'auto':
+            plan = reader.auto_read(output_dir, output_format=output_format, sep=sep,
+                                    gcs_bucket=params.get('gcs_bucket'), max_workers=max_workers)
+            return {'strategy': plan.strategy, 'workers': plan.workers}
+        elif strategy == 'single-thread':
+            _, row_count, columns, _ = reader.get_table_info()
+            TableReadThread(reader, os.path.join(output_dir, '%s.%s' % (params['table_id'], output_format)),
+                            output_format=output_format, sep=sep, columns=columns, row_count=row_count,
+                            max_file_rows=params.get('max_file_rows'),
+                            max_file_bytes=params.get('max_file_bytes')).run()
+        elif strategy == 'parallel-indexed':
+            reader.parallel_indexed_read(max_workers, output_dir, output_format=output_format, sep=sep)
+        elif strategy == 'partition-discovery':
+            reader.partition_discovery_read(output_dir, max_workers=max_workers, output_format=output_format,
+                                            sep=sep)
+        else:
+            raise ValueError('Unknown strategy %s' % (strategy,))
+        return {'strategy': strategy, 'rows': reader.rows_read}
+
+    def run_dataset(self, params):
+        from dataset_export import DEFAULT_SPLIT_ROWS, DatasetExporter
+        exporter = DatasetExporter(self.auth, params['project_id'], params['dataset_id'], params['output_dir'],
+                                   output_format=params.get('format', 'csv'), sep=params.get('separator', ';'),
+                                   max_workers=int(params.get('max_workers', self.max_workers)),
+                                   tables=params.get('tables'), max_file_rows=params.get('max_file_rows'),
+                                   split_rows=int(params.get('split_rows', DEFAULT_SPLIT_ROWS)),
+                                   max_file_bytes=params.get('max_file_bytes'), metrics=self.metrics,
+                                   verbose=self.verbose)
+        failed = exporter.export()
+        if failed:
+            raise Exception('%d work units failed: %s' % (len(failed), ', '.join(failed)))
+        return {'manifest': exporter.manifest.file_name}
+
+    def run_query(self, params):
+        from query_reader import QueryReader
+        reader = QueryReader(self.auth, params['project_id'], metrics=self.metrics, verbose=self.verbose)
+        output_dir = params['output_dir']
+        output_format = params.get('format', 'csv')
+        result_name = params.get('result_name', 'query_result')
+        self.make_output_dir(output_dir)
+        if params.get('temp_dataset'):
+            table_id = reader.read_large(params['query'], params['temp_dataset'], output_dir, result_name=result_name,
+                                         output_format=output_format, sep=params.get('separator', ';'),
+                                         strategy=params.get('strategy', 'parallel-indexed'),
+                                         partition_count=int(params.get('max_workers', self.max_workers)),
+                                         gcs_bucket=params.get('gcs_bucket'))
+            return {'job_id': reader.job_reference['jobId'], 'table_id': table_id}
+        output_file_name = os.path.join(output_dir, '%s.%s' % (result_name, output_format))
+        reader.read(make_result_handler(output_file_name, output_format, sep=params.get('separator', ';')),
+                    params['query'])
+        return {'job_id': reader.job_reference['jobId'] if reader.job_reference else None,
+                'output': output_file_name}
+
+    def run_extract(self, params):
+        from gcs_extract_read import EXTRACT_FORMATS, SimpleReader
+        from gcs_reader import GcsReader
+        from job_runner import JobRunner
+        from shard_decoder import ShardDecoder
+        from table_reader import TableReader
+        destination_format = EXTRACT_FORMATS[params.get('extract_format', 'json')]
+        compression = params.get('compression')
+        output_dir = params['output_dir']
+        decoder = None
+        if params.get('output_format'):
+            _, _, columns, column_types = TableReader(self.auth, params['project_id'], params['dataset_id'],
+                                                      params['table_id'], metrics=self.metrics).get_table_info()
+            decoder = ShardDecoder(destination_format, params['output_format'], columns=columns,
+                                   metrics=self.metrics, column_types=column_types)
+        job_runner = JobRunner(self.auth, params['project_id'], metrics=self.metrics, verbose=self.verbose)
+        gcs_reader = GcsReader(self.auth, params['gcs_bucket'], download_dir=output_dir, metrics=self.metrics)
+        try:
+            SimpleReader().run_extract_job(job_runner, gcs_reader, params['project_id'], params['dataset_id'],
+                                           params['table_id'], destination_format=destination_format,
+                                           compression=compression.upper() if compression else None,
+                                           decoder=decoder)
+        finally:
+            outputs = decoder.close() if decoder is not None else None
+        return {'job_id': job_runner.job_id, 'outputs': outputs}
+
+    def status(self):
+        jobs = self.list_jobs()
+        states = {}
+        for job in jobs:
+            states[job.state] = states.get(job.state, 0) + 1
+        return {'uptime': time.time() - self.started, 'workers': self.max_workers,
+                'queue_depth': self.pool.queue.qsize(), 'jobs': states}
+
+    def metrics_report(self):
+        report = self.metrics.summary()
+        report['token_broker'] = dict(self.auth.token_broker.stats)
+        return report
+
+
+class DaemonRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Routes the JSON API to the ExportDaemon of the server.'''
+
+    def log_message(self, format, *args):
+        if self.server.export_daemon.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        return self.client_address[0] if self.client_address else 'local'
+
+    def send_json(self, status, content):
+        body = json.dumps(content, sort_keys=True)
+        self.send_response(status)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def check_request(self):
+        '''Rejects requests a web page could make: a foreign Host (DNS rebinding) or a POST that is not JSON.'''
+        if not isinstance(self.server, DaemonUnixServer):
+            host = (self.headers.get('host') or '').strip().lower()
+            if re.sub(r':\d+$', '', host) not in ALLOWED_HOSTS:
+                self.send_json(403, {'error': 'Host %s is not allowed' % (host,)})
+                return False
+        if self.command == 'POST':
+            content_type = (self.headers.get('content-type') or '').split(';')[0].strip().lower()
+            if content_type != 'application/json':
+                self.send_json(415, {'error': 'Content-Type must be application/json'})
+                return False
+        return True
+
+    def do_GET(self):
+        if not self.check_request():
+            return
+        daemon = self.server.export_daemon
+        path = self.path.split('?')[0].rstrip('/')
+        match = re.match(r'^/jobs/([^/]+)$', path)
+        if path == '/jobs':
+            self.send_json(200, [job.to_dict() for job in daemon.list_jobs()])
+        elif match:
+            job = daemon.get_job(match.group(1))
+            if job is None:
+                self.send_json(404, {'error': 'Unknown job %s' % (match.group(1),)})
+            else:
+                self.send_json(200, job.to_dict())
+        elif path == '/status':
+            self.send_json(200, daemon.status())
+        elif path == '/metrics':
+            self.send_json(200, daemon.metrics_report())
+        else:
+            self.send_json(404, {'error': 'Unknown path %s' % (path,)})
+
+    def do_POST(self):
+        if not self.check_request():
+            return
+        if self.path.split('?')[0].rstrip('/') != '/jobs':
+            return self.send_json(404, {'error': 'Unknown path %s' % (self.path,)})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('content-length') or 0)) or 'null')
+            if not isinstance(request, dict):
+                raise ValueError('Expected a JSON object')
+            job = self.server.export_daemon.submit(request)
+        except ValueError as err:
+            return self.send_json(400, {'error': str(err)})
+        self.send_json(202, {'id': job.job_id})
+
+
+class DaemonHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class DaemonUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(daemon, port=DEFAULT_PORT, socket_path=None):
+    '''Creates the API server on 127.0.0.1:port or on a Unix socket.'''
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        # Only the user may connect; the socket is created without access for others.
+        umask = os.umask(0177)
+        try:
+            server = DaemonUnixServer(socket_path, DaemonRequestHandler)
+        finally:
+            os.umask(umask)
+        os.chmod(socket_path, 0600)
+    else:
+        server = DaemonHTTPServer(('127.0.0.1', port), DaemonRequestHandler)
+    server.export_daemon = daemon
+    return server
+
+
+def main(argv):
+    parser = ArgumentParser(description='Run exports submitted over a local HTTP API')
+    parser.add_argument('-a', '--service_account', required=True, help='Big Query service account name')
+    parser.add_argument('-s', '--client_secret', required=True,
+                        help='Path to client_secrets.json file required for API login')
+    parser.add_argument('-c', '--credentials',
+                        help='Path to credentials file (e.g. bigquery_credentials.dat) required for API login. '
+                             'If the file is not present, the browser window will be shown and you will be asked to authenticate')
+    parser.add_argument('-k', '--keyfile', help='Path to the key file (e.g., key.p12)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='Port of the API on 127.0.0.1')
+    parser.add_argument('--socket', help='Serve the API on this Unix socket instead of a port')
+    parser.add_argument('--max_workers', type=int, default=4, help='Number of jobs run at the same time')
+    add_metrics_arguments(parser)
+    add_transport_arguments(parser)
+    args = parser.parse_args()
+    metrics = metrics_from_args(args)
+    transport = transport_from_args(args)
+
+    auth = WarmAuth(service_acc=args.service_account, client_secrets=args.client_secret,
+                    credentials=args.credentials, key_file=args.keyfile, transport=transport)
+    daemon = ExportDaemon(auth, max_workers=args.max_workers, metrics=metrics, verbose=args.verbose)
+    server = make_server(daemon, port=args.port, socket_path=args.socket)
+    print 'Serving on %s' % (args.socket or '127.0.0.1:%d' % (args.port,),)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+        metrics.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
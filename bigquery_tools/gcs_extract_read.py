@@ -20,6 +20,7 @@ in GCS.
 The extract job will run in the project specified by project_id.
 '''
 
+import os
 import sys
 import threading
 import time
@@ -29,47 +30,69 @@ from argparse import ArgumentParser
 from gcs_reader import GcsReader
 from job_runner import JobRunner
 from auth import BigQuery_Auth
+from manifest import ExportManifest
+from table_reader import TableReader
+from metrics import add_metrics_arguments, metrics_from_args
+from output_writer import add_writer_arguments, writer_options_from_args
+from transport import add_transport_arguments, transport_from_args
+from shard_decoder import ShardDecoder, shard_suffix
+from output_handler import make_result_handler
+
+# --extract_format values and the destination formats of the extract API.
+EXTRACT_FORMATS = {'json': 'NEWLINE_DELIMITED_JSON', 'csv': 'CSV', 'avro': 'AVRO'}
 
 
 class SimpleReader:
 
     def make_extract_config(self, source_project_id, source_dataset_id,
-                            source_table_id, destination_uris):
+                            source_table_id, destination_uris,
+                            destination_format='NEWLINE_DELIMITED_JSON', compression=None):
         '''Creates a dict containing an export job configuration.'''
-        source_table_ref = {
-            'projectId': source_project_id,
-            'datasetId': source_dataset_id,
-            'tableId': source_table_id}
-        extract_config = {
-            'sourceTable': source_table_ref,
-            'destinationFormat': 'NEWLINE_DELIMITED_JSON',
-            'destinationUris': destination_uris}
-        return {'extract': extract_config}
+        return make_extract_config(source_project_id, source_dataset_id, source_table_id,
+                                   destination_uris, destination_format, compression)
 
 
     def run_extract_job(self, job_runner, gcs_reader, source_project_id,
-                        source_dataset_id, source_table_id):
-        '''Runs a BigQuery extract job and reads the results.'''
+                        source_dataset_id, source_table_id,
+                        destination_format='NEWLINE_DELIMITED_JSON', compression=None, decoder=None,
+                        result_handler=None, columns=None):
+        '''Runs a BigQuery extract job and reads the results.
+
+        If a result_handler is given, the output is streamed into it instead of being downloaded.
+        '''
         timestamp = int(time.time())
-        gcs_object = 'output/%s.%s_%d.json' % (source_dataset_id, source_table_id, timestamp)
+        gcs_object = 'output/%s.%s_%d.%s' % (source_dataset_id, source_table_id, timestamp,
+                                             shard_suffix(destination_format, compression))
         destination_uri = gcs_reader.make_uri(gcs_object)
-        job_config = make_extract_config(source_project_id, source_dataset_id, source_table_id, [destination_uri])
+        job_config = make_extract_config(source_project_id, source_dataset_id, source_table_id, [destination_uri],
+                                         destination_format, compression)
         if not job_runner.start_job(job_config):
             return
         print json.dumps(job_runner.get_job(), indent=2)
         job_runner.wait_for_complete()
-        gcs_reader.read(gcs_object)
+        if result_handler is not None:
+            gcs_reader.stream(gcs_object, result_handler, source_format=destination_format, columns=columns)
+            return
+        file_size = gcs_reader.read(gcs_object)
+        if file_size is not None and decoder is not None and gcs_reader.download_dir is not None:
+            decoder.submit(os.path.join(gcs_reader.download_dir, gcs_object))
 
 
 class PartitionReader(threading.Thread):
     '''Reads output files from a partitioned BigQuery extract job.'''
 
-    def __init__(self, job_runner, gcs_reader, partition_id):
+    def __init__(self, job_runner, gcs_reader, partition_id, decoder=None, result_handler=None,
+                 source_format='NEWLINE_DELIMITED_JSON', columns=None):
         threading.Thread.__init__(self)
+        self.result_handler = result_handler
+        self.source_format = source_format
+        self.columns = columns
         self.job_runner = job_runner
         self.partition_id = partition_id
         self.gcs_reader = gcs_reader
+        self.decoder = decoder
         self.gcs_object_glob = None
+        self.downloaded_files = []
 
     def resolve_shard_path(self, path, index):
         '''Turns a glob path and an index into the expected filename.'''
@@ -80,7 +103,17 @@ class PartitionReader(threading.Thread):
         '''Reads the file if the file is present or returns None.'''
         resolved_object = self.resolve_shard_path(self.gcs_object_glob,
                                                   shard)
-        return self.gcs_reader.read(resolved_object)
+        if self.result_handler is not None:
+            return self.gcs_reader.stream(resolved_object, self.result_handler,
+                                          source_format=self.source_format, columns=self.columns)
+        file_size = self.gcs_reader.read(resolved_object)
+        if file_size is not None and self.gcs_reader.download_dir is not None:
+            file_name = os.path.join(self.gcs_reader.download_dir, resolved_object)
+            self.downloaded_files.append(file_name)
+            if self.decoder is not None:
+                # Hand the shard to the decoder and go on downloading the next one.
+                self.decoder.submit(file_name)
+        return file_size
 
     def start(self, gcs_object_glob):
         ''' Starts the thread, reading a GCS object pattern.'''
@@ -122,37 +155,54 @@ class PartitionReader(threading.Thread):
 
 
 def make_extract_config(source_project_id, source_dataset_id,
-                        source_table_id, destination_uris):
-    '''Creates a dict containing an export job configuration.'''
+                        source_table_id, destination_uris,
+                        destination_format='NEWLINE_DELIMITED_JSON', compression=None):
+    '''Creates a dict containing an export job configuration.
+
+    destination_format: NEWLINE_DELIMITED_JSON, CSV or AVRO.
+    compression: GZIP for CSV and JSON, DEFLATE or SNAPPY for AVRO, or None.
+    '''
     source_table_ref = {
         'projectId': source_project_id,
         'datasetId': source_dataset_id,
         'tableId': source_table_id}
     extract_config = {
         'sourceTable': source_table_ref,
-        'destinationFormat': 'NEWLINE_DELIMITED_JSON',
+        'destinationFormat': destination_format,
         'destinationUris': destination_uris}
+    if compression:
+        extract_config['compression'] = compression
     return {'extract': extract_config}
 
 
 def run_partitioned_extract_job(job_runner, gcs_readers,
-                                source_project_id, source_dataset_id, source_table_id):
-    '''Runs a BigQuery extract job and reads the results.'''
+                                source_project_id, source_dataset_id, source_table_id,
+                                destination_format='NEWLINE_DELIMITED_JSON', compression=None, decoder=None,
+                                result_handlers=None, columns=None):
+    '''Runs a BigQuery extract job and reads the results.
+
+    If a ShardDecoder is given, every shard is converted as soon as it has been downloaded.
+    If result_handlers (one per GCS reader) are given, the shards are streamed
+    into them instead of being downloaded.
+    '''
     destination_uris = []
     gcs_objects = []
     timestamp = int(time.time())
     partition_readers = []
     for index in range(len(gcs_readers)):
-        gcs_object = 'output/%s.%s_%d.%d.*.json' % (source_dataset_id, source_table_id, timestamp, index)
+        gcs_object = 'output/%s.%s_%d.%d.*.%s' % (source_dataset_id, source_table_id, timestamp, index,
+                                                  shard_suffix(destination_format, compression))
         gcs_objects.append(gcs_object)
         destination_uris.append(gcs_readers[index].make_uri(gcs_object))
 
         # Create the reader thread for this partition.
         partition_readers.append(PartitionReader(job_runner=job_runner, gcs_reader=gcs_readers[index],
-                                                 partition_id=index))
+                                                 partition_id=index, decoder=decoder,
+                                                 result_handler=result_handlers[index] if result_handlers else None,
+                                                 source_format=destination_format, columns=columns))
 
     job_config = make_extract_config(source_project_id, source_dataset_id,
-                                     source_table_id, destination_uris)
+                                     source_table_id, destination_uris, destination_format, compression)
     if not job_runner.start_job(job_config):
         return
 
@@ -164,6 +214,58 @@ def run_partitioned_extract_job(job_runner, gcs_readers,
         partition_readers[index].wait_for_complete()
 
 
+def run_incremental_extract_job(auth, gcs_bucket, download_dir, manifest, source_project_id,
+                                source_dataset_id, source_table_id, max_jobs=10, metrics=None,
+                                destination_format='NEWLINE_DELIMITED_JSON', compression=None, decoder=None):
+    '''Extracts only the partitions that changed since the export recorded in the manifest.
+
+    Each changed partition is extracted by its own job; its downloaded shards
+    (or, with a ShardDecoder, their converted files) replace the outputs of
+    the previous export of that partition.
+    '''
+    table_reader = TableReader(auth, source_project_id, source_dataset_id, source_table_id, metrics=metrics)
+    changed = manifest.changed_partitions(table_reader.list_partitions())
+    print '%d partitions changed since the last export' % (len(changed),)
+    timestamp = int(time.time())
+    for batch_start in range(0, len(changed), max_jobs):
+        batch = []
+        for index, (partition_id, last_modified) in enumerate(changed[batch_start:batch_start + max_jobs]):
+            gcs_object = 'output/%s.%s.%s_%d.*.%s' % (source_dataset_id, source_table_id, partition_id,
+                                                      timestamp, shard_suffix(destination_format, compression))
+            # Note: a separate GCS reader is required per partition.
+            gcs_reader = GcsReader(auth=auth, gcs_bucket=gcs_bucket, download_dir=download_dir, metrics=metrics)
+            job_runner = JobRunner(auth, project_id=source_project_id, metrics=metrics,
+                                   job_id='extract_%s_%s_%s_%d' % (source_dataset_id, source_table_id,
+                                                                   partition_id, timestamp))
+            job_config = make_extract_config(source_project_id, source_dataset_id,
+                                             '%s$%s' % (source_table_id, partition_id),
+                                             [gcs_reader.make_uri(gcs_object)], destination_format, compression)
+            if not job_runner.start_job(job_config):
+                continue
+            partition_reader = PartitionReader(job_runner=job_runner, gcs_reader=gcs_reader,
+                                               partition_id=batch_start + index, decoder=decoder)
+            partition_reader.start(gcs_object)
+            batch.append((partition_id, last_modified, job_runner, partition_reader))
+        for _, _, _, partition_reader in batch:
+            partition_reader.wait_for_complete()
+        if decoder is not None:
+            # The outputs of the batch must exist before they are recorded.
+            decoder.wait()
+        for partition_id, last_modified, job_runner, partition_reader in batch:
+            job = job_runner.get_job()
+            if job is None or 'errorResult' in job['status']:
+                print 'Extract of partition %s failed, keeping the previous export' % (partition_id,)
+                continue
+            file_names = partition_reader.downloaded_files
+            if decoder is not None:
+                file_names = decoder.get_output_file_names(file_names)
+            outputs = dict((file_name, {'bytes': os.path.getsize(file_name),
+                                        'last_modified': str(last_modified)})
+                           for file_name in file_names)
+            manifest.replace_partition(partition_id, last_modified, outputs)
+        manifest.save()
+
+
 def main(argv):
     logging.basicConfig()
     parser = ArgumentParser(description='Read BigQuery table into a text file')
@@ -182,25 +284,98 @@ def main(argv):
     parser.add_argument('-n', '--partition_count', help='Partition count for partitioned reader', type=int)
     parser.add_argument('--partitioned', dest="partitioned", help='Use partitioned reader',
                         required=False, action='store_true')
-    parser.set_defaults(partitioned=False)
+    parser.add_argument('--incremental', dest="incremental",
+                        help='Only extract the table partitions changed since the last export',
+                        required=False, action='store_true')
+    parser.add_argument('-m', '--manifest', help='Manifest file of incremental exports '
+                                                 '(default: <download_dir>/<table_id>.manifest.json)')
+    parser.add_argument('--extract_format', default='json', choices=sorted(EXTRACT_FORMATS.keys()),
+                        help='Format of the extracted shards')
+    parser.add_argument('--compression', default='none', choices=['none', 'gzip', 'deflate', 'snappy'],
+                        help='Compression of the extracted shards (deflate and snappy only apply to avro)')
+    parser.add_argument('--output_format', choices=['csv', 'json', 'parquet'],
+                        help='Convert the downloaded shards into this format')
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        help='Stream the shards into --output_format (csv or json) files instead of downloading them')
+    parser.add_argument('--decoder_threads', type=int, default=2, help='Number of shard decoder threads')
+    parser.add_argument('--keep_shards', dest='keep_shards', action='store_true',
+                        help='Keep the downloaded shards after converting them')
+    parser.set_defaults(partitioned=False, incremental=False, keep_shards=False, stream=False)
+    add_writer_arguments(parser)
+    add_metrics_arguments(parser)
+    add_transport_arguments(parser)
     args = parser.parse_args()
+    if args.stream and (args.output_format not in ['csv', 'json'] or args.incremental):
+        parser.error('--stream requires --output_format csv or json and is not supported with --incremental')
+    metrics = metrics_from_args(args)
+    writer_options_from_args(args)
+    transport = transport_from_args(args)
 
-    job_runner = JobRunner(project_id=args.project_id)
     auth = BigQuery_Auth(service_acc=args.service_account, client_secrets=args.client_secret,
-                         credentials=args.credentials, key_file=args.keyfile)
-    if args.partitioned:
+                         credentials=args.credentials, key_file=args.keyfile, transport=transport)
+    job_runner = JobRunner(auth, project_id=args.project_id, metrics=metrics, verbose=args.verbose)
+    destination_format = EXTRACT_FORMATS[args.extract_format]
+    compression = args.compression.upper() if args.compression != 'none' else None
+    decoder = None
+    columns = None
+    if args.output_format:
+        # JSON shards omit null fields, so take the columns from the table schema. The column
+        # types give the Parquet schema.
+        _, _, columns, column_types = TableReader(auth, args.project_id, args.dataset_id, args.table_id,
+                                                  metrics=metrics).get_table_info()
+    if args.output_format and not args.stream:
+        decoder = ShardDecoder(destination_format, args.output_format, columns=columns,
+                               num_threads=args.decoder_threads, keep_shards=args.keep_shards, metrics=metrics,
+                               column_types=column_types)
+    if args.incremental:
+        manifest = ExportManifest(args.manifest or os.path.join(args.download_dir, '%s.manifest.json' % (args.table_id,)),
+                                  source='%s:%s.%s' % (args.project_id, args.dataset_id, args.table_id))
+        run_incremental_extract_job(auth, args.gcs_bucket, args.download_dir, manifest,
+                                    source_project_id=args.project_id,
+                                    source_dataset_id=args.dataset_id, source_table_id=args.table_id,
+                                    metrics=metrics, destination_format=destination_format,
+                                    compression=compression, decoder=decoder)
+    elif args.partitioned:
         gcs_readers = []
         for index in range(int(args.partition_count)):
             # Note: a separate GCS reader is required per partition.
             gcs_readers.append(GcsReader(auth=auth, gcs_bucket=args.gcs_bucket,
-                                   download_dir=args.download_dir))
-        run_partitioned_extract_job(job_runner, gcs_readers, source_project_id=args.project_id,
-                                    source_dataset_id=args.dataset_id, source_table_id=args.table_id)
+                                   download_dir=args.download_dir, metrics=metrics))
+        result_handlers = None
+        if args.stream:
+            result_handlers = [make_result_handler(os.path.join(args.download_dir, '%s.%d.%s' % (
+                args.table_id, index, args.output_format)), args.output_format, columns=columns)
+                               for index in range(len(gcs_readers))]
+        try:
+            run_partitioned_extract_job(job_runner, gcs_readers, source_project_id=args.project_id,
+                                        source_dataset_id=args.dataset_id, source_table_id=args.table_id,
+                                        destination_format=destination_format, compression=compression,
+                                        decoder=decoder, result_handlers=result_handlers, columns=columns)
+        finally:
+            for result_handler in result_handlers or []:
+                result_handler.finish()
     else:
-        reader = SimpleReader
-        gcs_reader = GcsReader(auth=auth, gcs_bucket=args.gcs_bucket, download_dir=args.download_dir)
-        reader.run_extract_job(job_runner, gcs_reader, source_project_id=args.project_id,
-                                    source_dataset_id=args.dataset_id, source_table_id=args.table_id)
+        reader = SimpleReader()
+        gcs_reader = GcsReader(auth=auth, gcs_bucket=args.gcs_bucket, download_dir=args.download_dir,
+                               metrics=metrics)
+        result_handler = None
+        if args.stream:
+            result_handler = make_result_handler(os.path.join(args.download_dir, '%s.%s' % (
+                args.table_id, args.output_format)), args.output_format, columns=columns)
+        try:
+            reader.run_extract_job(job_runner, gcs_reader, source_project_id=args.project_id,
+                                   source_dataset_id=args.dataset_id, source_table_id=args.table_id,
+                                   destination_format=destination_format, compression=compression,
+                                   decoder=decoder, result_handler=result_handler, columns=columns)
+        finally:
+            if result_handler is not None:
+                result_handler.finish()
+    if decoder is not None:
+        outputs = decoder.close()
+        print 'Decoded %d shards into %s' % (len(outputs), args.output_format)
+    metrics.close()
+    if args.transport_report:
+        print transport.format_report()
 
 
 if __name__ == "__main__":
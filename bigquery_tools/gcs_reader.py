@@ -11,20 +11,157 @@ it to the directory download_dir. If download_dir is not specified,
 the file will just be checked for existence and not actually downloaded.
 auth is the BigQuery_Auth object used to connect BQ
 
+GcsReader.stream reads an extract shard (newline-delimited JSON, CSV or
+Avro, optionally gzip compressed) without writing it to disk: the chunks
+are downloaded into a bounded in-memory queue on a separate thread while
+the calling thread splits them into records and passes the records to a
+ResultHandler as table rows.
+
+Downloads are hashed while they are written and verified against the MD5
+and CRC32C of the object metadata. In sync mode (sync=True) objects whose
+local copy already matches by size and hash are skipped; the hashes of the
+local files are kept in a hash index in download_dir (see checksums.py).
+
+GcsReader.iter_objects lists a bucket page by page as a generator, and
+GcsReader.iter_objects_parallel shards the listing by prefix ("directory")
+over a pool of threads, so listing millions of objects neither holds them
+all in memory nor waits for one page after the other.
+
 Usage from the command line:
 python gcs_reader.py [options]
 '''
 
+import csv
+import json
 import os
+import Queue
 import sys
+import threading
+import time
+import zlib
 from argparse import ArgumentParser
 # Imports from the Google API client:
-from apiclient.errors import HttpError
-from apiclient.http import MediaIoBaseDownload
+from googleapiclient.errors import HttpError
 from auth import BigQuery_Auth
+from metrics import get_metrics, add_metrics_arguments, metrics_from_args
+from transport import add_transport_arguments, transport_from_args
+from output_handler import ColumnarResultHandler, make_result_handler
+from worker_pool import WorkerPool
+from checksums import ChecksumMismatch, HashingWriter, compare_hashes, get_hash_index
 
 # Number of bytes to download per request.
 CHUNKSIZE = 1024 * 1024
+# Number of downloaded chunks buffered in memory while streaming.
+MAX_BUFFERED_CHUNKS = 4
+# Number of rows passed to the result handler at a time while streaming.
+STREAM_BATCH_SIZE = 10000
+# Number of objects requested per objects.list page.
+LIST_PAGE_SIZE = 1000
+# Number of listed objects buffered between the listing threads and the caller.
+MAX_BUFFERED_OBJECTS = 10000
+
+
+class ChunkStream:
+    '''A bounded queue of downloaded chunks.
+
+    The downloading thread uses it as the file of a MediaIoBaseDownload; the
+    reading thread iterates over the chunks or reads it as a file.
+    '''
+
+    def __init__(self, max_chunks=MAX_BUFFERED_CHUNKS, decompress=False):
+        self.queue = Queue.Queue(maxsize=max_chunks)
+        self.closed = False
+        self.buffer = ''
+        self.finished = False
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if decompress else None
+
+    def put(self, item):
+        # Gives up when the reader has stopped, so the downloading thread does not block forever.
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+    def write(self, data):
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+        if data:
+            self.put(data)
+
+    def end(self, error=None):
+        '''Called by the downloading thread when the download has finished or failed.'''
+        if self.decompressor is not None:
+            data = self.decompressor.flush()
+            if data:
+                self.put(data)
+        self.put(error)
+
+    def close(self):
+        self.closed = True
+
+    def next_chunk(self):
+        '''Returns the next downloaded chunk or None at the end of the object.'''
+        if self.finished:
+            return None
+        item = self.queue.get()
+        if item is None or isinstance(item, Exception):
+            self.finished = True
+            if item is not None:
+                raise item
+        return item
+
+    def __iter__(self):
+        return iter(self.next_chunk, None)
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            data = self.next_chunk()
+            if data is None:
+                break
+            self.buffer += data
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def iter_lines(chunks):
+    '''Yields the lines of a sequence of chunks, joining lines split across chunk boundaries.'''
+    partial = ''
+    for chunk in chunks:
+        lines = (partial + chunk).split('\n')
+        partial = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if partial:
+        yield partial
+
+
+def format_field(value):
+    '''Formats a decoded extract value as a tabledata.list cell value.
+
+    Only scalar values other than TIMESTAMP come out as tabledata.list returns
+    them. Extracts write TIMESTAMPs as text ("2020-01-01 12:00:00 UTC"), not
+    as epoch seconds ("1.5778800E9"), and RECORD and REPEATED values are
+    formatted as the JSON of the extracted object or array rather than nested
+    {"f": [...]} and [{"v": ...}] cells.
+    '''
+    if value is None or isinstance(value, basestring):
+        return value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+
+def make_row(record, columns):
+    '''Turns a record dict into a table row in the layout of tabledata.list (values as by format_field).'''
+    return {'f': [{'v': format_field(record.get(column))} for column in columns]}
 
 
 class GcsReader:
@@ -33,28 +170,45 @@ class GcsReader:
     the files as well if download_dir is not None.
     '''
 
-    def __init__(self, auth, gcs_bucket, download_dir=None):
+    def __init__(self, auth, gcs_bucket, download_dir=None, metrics=None, sync=False):
         self.gcs_service = auth.build_gcs_client()
         self.auth = auth
+        self.transport = auth.transport
         self.gcs_bucket = gcs_bucket
         self.download_dir = download_dir
+        self.metrics = metrics if metrics is not None else get_metrics()
+        self.sync = sync
+        self.hash_index = get_hash_index(download_dir) if sync and download_dir is not None else None
 
     def make_uri(self, gcs_object):
         '''Turn a bucket and object into a Google Cloud Storage path.'''
         return 'gs://%s/%s' % (self.gcs_bucket, gcs_object)
 
-    def check_gcs_file(self, gcs_object):
-        '''Returns a tuple of (GCS URI, size) if the file is present.'''
+    def get_metadata(self, gcs_object):
+        '''Returns the object metadata (size, hashes, ...) or None if the object is not present.'''
         try:
-            metadata = self.gcs_service.objects().get(
-                bucket=self.gcs_bucket, object=gcs_object).execute()
-            uri = self.make_uri(gcs_object)
-            return (uri, int(metadata.get('size', 0)))
+            return self.metrics.execute(self.gcs_service.objects().get(
+                bucket=self.gcs_bucket, object=gcs_object, fields=self.transport.fields('objects.get')),
+                'objects.get', object=gcs_object)
         except HttpError as err:
             # If the error is anything except a 'Not Found' print the error.
             if err.resp.status <> 404:
                 print err
+            return None
+
+    def check_gcs_file(self, gcs_object):
+        '''Returns a tuple of (GCS URI, size) if the file is present.'''
+        metadata = self.get_metadata(gcs_object)
+        if metadata is None:
             return (None, None)
+        return (self.make_uri(gcs_object), int(metadata.get('size', 0)))
+
+    def is_up_to_date(self, gcs_object, metadata):
+        '''Checks whether the local copy of an object matches its metadata by size and hash.'''
+        output_file_name = os.path.join(self.download_dir, gcs_object)
+        if not os.path.exists(output_file_name) or os.path.getsize(output_file_name) != int(metadata.get('size', 0)):
+            return False
+        return compare_hashes(self.hash_index.get_hashes(gcs_object), metadata) is True
 
     def make_output_dir(self, output_file):
         '''Creates an output directory for the downloaded results.'''
@@ -64,49 +218,233 @@ class GcsReader:
             return
         os.makedirs(output_dir)
 
-    def complete_download(self, media):
+    def complete_download(self, media, gcs_object=None):
+        downloaded = 0
         while True:
             # Download the next chunk, allowing 3 retries.
-            _, done = media.next_chunk(num_retries=3)
+            start = time.time()
+            progress, done = media.next_chunk(num_retries=3)
+            received = progress.resumable_progress - downloaded
+            downloaded = progress.resumable_progress
+            self.metrics.record_request('objects.get_media', time.time() - start,
+                                        bytes=received, object=gcs_object)
             if done: return
 
-    def download_file(self, gcs_object):
-        '''Downloads a GCS object to directory download_dir.'''
+    def download_file(self, gcs_object, metadata=None):
+        '''Downloads a GCS object to directory download_dir.
+
+        If the object metadata is given, the size and hashes of the download
+        are verified against it; a mismatching file is removed and
+        ChecksumMismatch is raised.
+        '''
+        from googleapiclient.http import MediaIoBaseDownload
         output_file_name = os.path.join(self.download_dir, gcs_object)
         self.make_output_dir(output_file_name)
-        with open(output_file_name, 'w') as out_file:
+        with open(output_file_name, 'wb') as out_file:
+            hashing_file = HashingWriter(out_file)
             request = self.gcs_service.objects().get_media(
                 bucket=self.gcs_bucket, object=gcs_object)
-            media = MediaIoBaseDownload(out_file, request, chunksize=CHUNKSIZE)
+            media = MediaIoBaseDownload(hashing_file, request, chunksize=CHUNKSIZE)
 
             print 'Downloading:\n%s to\n%s' % (
                 self.make_uri(gcs_object), output_file_name)
-            self.complete_download(media)
+            self.complete_download(media, gcs_object)
+        if metadata is None:
+            return
+        hasher = hashing_file.hasher
+        hashes = hasher.hashes()
+        if hasher.size != int(metadata.get('size', 0)) or compare_hashes(hashes, metadata) is False:
+            os.remove(output_file_name)
+            if self.hash_index is not None:
+                self.hash_index.remove(gcs_object)
+                self.hash_index.save()
+            raise ChecksumMismatch('%s: downloaded %d bytes with hashes %s, expected %s bytes with %s' % (
+                self.make_uri(gcs_object), hasher.size, hashes, metadata.get('size'),
+                dict((key, metadata.get(key)) for key in ('md5Hash', 'crc32c'))))
+        if self.hash_index is not None:
+            self.hash_index.set_hashes(gcs_object, hashes)
+            self.hash_index.save()
 
     def read(self, gcs_object):
         '''Read the file and returns the file size or None if not found.'''
-        uri, file_size = self.check_gcs_file(gcs_object)
-        if uri is None:
+        metadata = self.get_metadata(gcs_object)
+        if metadata is None:
             return None
+        uri, file_size = self.make_uri(gcs_object), int(metadata.get('size', 0))
         print '%s size: %d' % (uri, file_size)
         if self.download_dir is not None:
-            self.download_file(gcs_object)
+            if self.sync and self.is_up_to_date(gcs_object, metadata):
+                print '%s is up to date, skipping' % (uri,)
+                self.metrics.emit('sync_skip', object=gcs_object, bytes=file_size)
+                return file_size
+            self.download_file(gcs_object, metadata)
         return file_size
 
+    def iter_records(self, stream, source_format, sep=','):
+        '''Yields (columns, record) pairs decoded from a ChunkStream.'''
+        if source_format == 'AVRO':
+            import fastavro
+            for record in fastavro.reader(stream):
+                yield None, record
+        elif source_format == 'CSV':
+            reader = csv.reader(iter_lines(stream), delimiter=sep)
+            header = next(reader, None)
+            for values in reader:
+                yield header, dict(zip(header, [value if value != '' else None for value in values]))
+        else:
+            for line in iter_lines(stream):
+                if line.strip():
+                    yield None, json.loads(line)
+
+    def stream(self, gcs_object, result_handler, source_format='NEWLINE_DELIMITED_JSON', columns=None,
+               sep=',', max_buffered_chunks=MAX_BUFFERED_CHUNKS):
+        '''Streams an extract shard into a result handler without saving it to disk.
+
+        columns: the columns of the rows; required for complete rows from
+        newline-delimited JSON, which omits null values. Otherwise they are
+        taken from the CSV header or the first record.
+        Returns the file size or None if not found.
+        '''
+        uri, file_size = self.check_gcs_file(gcs_object)
+        if uri is None:
+            return None
+        print 'Streaming %s (%d bytes)' % (uri, file_size)
+        stream = ChunkStream(max_buffered_chunks, decompress=gcs_object.endswith('.gz'))
+        thread = threading.Thread(target=self.download_to_stream, args=(gcs_object, stream),
+                                  name='stream-%s' % (gcs_object,))
+        thread.daemon = True
+        thread.start()
+        try:
+            batch = []
+            for record_columns, record in self.iter_records(stream, source_format, sep):
+                if columns is None:
+                    columns = record_columns or list(record.keys())
+                    if isinstance(result_handler, ColumnarResultHandler) and not result_handler.columns:
+                        result_handler.set_columns(columns)
+                batch.append(make_row(record, columns))
+                if len(batch) >= STREAM_BATCH_SIZE:
+                    result_handler.handle_rows(batch)
+                    batch = []
+            if batch:
+                result_handler.handle_rows(batch)
+        finally:
+            stream.close()
+        thread.join()
+        return file_size
+
+    def download_to_stream(self, gcs_object, stream):
+        from googleapiclient.http import MediaIoBaseDownload
+        try:
+            request = self.gcs_service.objects().get_media(bucket=self.gcs_bucket, object=gcs_object)
+            self.complete_download(MediaIoBaseDownload(stream, request, chunksize=CHUNKSIZE), gcs_object)
+            stream.end()
+        except Exception as error:
+            stream.end(error)
+
     def list_bucket(self):
         """Returns a list of metadata of the objects within the given bucket."""
+        return list(self.iter_objects(fields='name,size,contentType,metadata(my-key)'))
+
+    def list_fields(self, fields):
+        '''Returns the objects.list fields mask for a selection of object fields.'''
+        if fields is None:
+            return self.transport.fields('objects.list')
+        return 'nextPageToken,prefixes,items(%s)' % (fields,)
 
-        # Create a request to objects.list to retrieve a list of objects.
-        fields_to_return = 'nextPageToken,items(name,size,contentType,metadata(my-key))'
-        req = self.gcs_service.objects().list(bucket=self.gcs_bucket, fields=fields_to_return)
-        all_objects = []
+    def list_pages(self, prefix=None, delimiter=None, fields=None, gcs_service=None):
+        '''Yields (objects, prefixes) for every page of an objects.list call.
+
+        fields: comma separated object fields to return, e.g. "name,size"
+        (default: the objects.list mask of the transport).
+        '''
+        objects = (gcs_service or self.gcs_service).objects()
         # If you have too many items to list in one request, list_next() will
         # automatically handle paging with the pageToken.
+        req = objects.list(bucket=self.gcs_bucket, prefix=prefix, delimiter=delimiter,
+                           maxResults=LIST_PAGE_SIZE, fields=self.list_fields(fields))
         while req:
-            resp = req.execute()
-            all_objects.extend(resp.get('items', []))
-            req = self.gcs_service.objects().list_next(req, resp)
-        return all_objects
+            resp = self.metrics.execute(req, 'objects.list', prefix=prefix)
+            yield resp.get('items', []), resp.get('prefixes', [])
+            req = objects.list_next(req, resp)
+
+    def iter_objects(self, prefix=None, delimiter=None, fields=None):
+        '''Yields the metadata of the objects in the bucket, one page in memory at a time.
+
+        With a delimiter, only objects directly under prefix are returned; see list_prefixes.
+        '''
+        for items, _ in self.list_pages(prefix, delimiter, fields):
+            for item in items:
+                yield item
+
+    def list_prefixes(self, prefix=None, delimiter='/'):
+        '''Returns the "subdirectories" directly under a prefix.'''
+        prefixes = []
+        for _, page_prefixes in self.list_pages(prefix, delimiter, fields='name'):
+            prefixes.extend(page_prefixes)
+        return prefixes
+
+    def iter_objects_parallel(self, prefix='', delimiter='/', fields=None, max_workers=8, max_depth=3):
+        '''Yields the metadata of all objects under prefix, listing prefix shards in parallel.
+
+        The prefix is expanded by delimiter level by level (objects found on
+        the way are yielded directly) until there are at least 2 * max_workers
+        shards or max_depth levels were expanded. The shards are then listed
+        on max_workers threads, each with its own client; objects are yielded
+        in no particular order. Memory is bounded by MAX_BUFFERED_OBJECTS.
+        '''
+        shards = [prefix]
+        for _ in range(max_depth):
+            if len(shards) >= 2 * max_workers:
+                break
+            expanded = []
+            for shard in shards:
+                for items, prefixes in self.list_pages(shard, delimiter, fields):
+                    for item in items:
+                        yield item
+                    expanded.extend(prefixes)
+            shards = expanded
+            if not shards:
+                return
+
+        results = Queue.Queue(maxsize=MAX_BUFFERED_OBJECTS)
+        stopped = threading.Event()
+        clients = threading.local()
+
+        def put(item):
+            # Gives up when the caller stopped iterating, so the workers do not block forever.
+            while not stopped.is_set():
+                try:
+                    results.put(item, timeout=1)
+                    return
+                except Queue.Full:
+                    pass
+
+        def list_shard(shard):
+            try:
+                if not hasattr(clients, 'gcs_service'):
+                    clients.gcs_service = self.auth.build_gcs_client()
+                for items, _ in self.list_pages(shard, fields=fields, gcs_service=clients.gcs_service):
+                    if stopped.is_set():
+                        return
+                    for item in items:
+                        put(item)
+            finally:
+                put(None)
+
+        pool = WorkerPool(max_workers, metrics=self.metrics, name='bucket_lister')
+        for shard in shards:
+            pool.submit(0, list_shard, shard)
+        try:
+            remaining = len(shards)
+            while remaining:
+                item = results.get()
+                if item is None:
+                    remaining -= 1
+                else:
+                    yield item
+        finally:
+            stopped.set()
+            pool.join()
 
 
 def main(argv):
@@ -115,18 +453,56 @@ def main(argv):
     parser.add_argument('-s', '--client_secret', required=True,
                         help='Path to client_secrets.json file required for API login')
     parser.add_argument('-c', '--credentials',
-                        help=('Path to credentials file (e.g. bigquery_credentials.dat) required for API login. ',
-                             'If the file is not present, the browser window will be shown and you will be asked to authenticate'))
+                        help='Path to credentials file (e.g. bigquery_credentials.dat) required for API login. '
+                             'If the file is not present, the browser window will be shown and you will be asked to authenticate')
     parser.add_argument('-k', '--keyfile', help='Path to the key file (e.g., key.p12)')
     parser.add_argument('-o', '--download_dir', default='.', help='The directory where the output will be exported')
     parser.add_argument('-b', '--gcs_bucket', help='Google Cloud Service bucket where the object is put')
     parser.add_argument('-f', '--gcs_object', help='The object to be downloaded')
+    parser.add_argument('--sync', action='store_true',
+                        help='Skip the download if the local copy matches the object by size and hash')
+    parser.add_argument('--stream_to', help='Stream the object (an extract shard) into this file '
+                                            'instead of downloading it')
+    parser.add_argument('--source_format', default='NEWLINE_DELIMITED_JSON',
+                        choices=['NEWLINE_DELIMITED_JSON', 'CSV', 'AVRO'], help='Format of the streamed object')
+    parser.add_argument('--output_format', default='csv', choices=['csv', 'json'],
+                        help='Output format of the streamed rows')
+    parser.add_argument('--list', action='store_true', help='List the objects of the bucket as JSON lines')
+    parser.add_argument('--prefix', default='', help='Only list objects under this prefix')
+    parser.add_argument('--delimiter', help='Only list objects directly under --prefix')
+    parser.add_argument('--fields', help='Comma separated object fields to list (e.g. name,size)')
+    parser.add_argument('--list_workers', type=int, default=0,
+                        help='List prefix shards on this many threads (0: list sequentially)')
+    add_metrics_arguments(parser)
+    add_transport_arguments(parser)
     args = parser.parse_args()
+    metrics = metrics_from_args(args)
+    transport = transport_from_args(args)
 
     gcs_reader = GcsReader(auth=BigQuery_Auth(service_acc=args.service_account, client_secrets=args.client_secret,
-                                              credentials=args.credentials, key_file=args.keyfile),
-                           gcs_bucket=args.gcs_bucket, download_dir=args.download_dir)
-    gcs_reader.read(args.gcs_object)
+                                              credentials=args.credentials, key_file=args.keyfile,
+                                              transport=transport),
+                           gcs_bucket=args.gcs_bucket, download_dir=args.download_dir, metrics=metrics,
+                           sync=args.sync)
+    if args.list:
+        if args.list_workers:
+            objects = gcs_reader.iter_objects_parallel(args.prefix, fields=args.fields,
+                                                       max_workers=args.list_workers)
+        else:
+            objects = gcs_reader.iter_objects(args.prefix or None, args.delimiter, fields=args.fields)
+        for gcs_object in objects:
+            print json.dumps(gcs_object, sort_keys=True)
+    elif args.stream_to:
+        result_handler = make_result_handler(args.stream_to, args.output_format)
+        try:
+            gcs_reader.stream(args.gcs_object, result_handler, source_format=args.source_format)
+        finally:
+            result_handler.finish()
+    else:
+        gcs_reader.read(args.gcs_object)
+    metrics.close()
+    if args.transport_report:
+        print transport.format_report()
 
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,221 @@
+#!/usr/bin/python2.7
+
+'''Incremental exports of BigQuery tables.
+
+Instead of re-exporting a whole table on every run, the reader keeps a local
+manifest of the last export (see manifest.py) and only fetches what changed:
+
+* Partition mode (default, for date-partitioned tables): the partitions are
+  listed together with their last modification time. Only new or modified
+  partitions are read, each into its own output shard, which replaces the
+  shard written for that partition by the previous run.
+* Watermark mode (--watermark_column): the largest value of the column seen
+  so far is kept in the manifest. The first run reads the whole table; later
+  runs query only rows with a larger value and append them as a new shard.
+
+Usage from the command line:
+python incremental_reader.py [options]
+'''
+
+import os
+import sys
+import time
+from argparse import ArgumentParser
+from auth import BigQuery_Auth
+from manifest import ExportManifest
+from metrics import get_metrics, add_metrics_arguments, metrics_from_args
+from output_handler import ColumnarResultHandler, make_result_handler
+from query_reader import QueryReader
+from transport import add_transport_arguments, transport_from_args
+from table_reader import TableReader, TableReadThread
+
+NUMERIC_TYPES = ['INTEGER', 'FLOAT', 'TIMESTAMP']
+
+
+def parse_value(value, column_type):
+    '''Converts a value returned by the API into a comparable Python value.'''
+    if value is None:
+        return None
+    if column_type == 'INTEGER':
+        return int(value)
+    if column_type in ['FLOAT', 'TIMESTAMP']:
+        return float(value)
+    return value
+
+
+def make_sql_literal(value, column_type):
+    '''Formats a watermark value as a legacy SQL literal.'''
+    if column_type == 'TIMESTAMP':
+        # The API returns timestamps as (floating point) seconds since the epoch.
+        return 'USEC_TO_TIMESTAMP(%d)' % (int(round(float(value) * 1e6)),)
+    if column_type in NUMERIC_TYPES:
+        return value
+    return "'%s'" % (value.replace('\\', '\\\\').replace("'", "\\'"),)
+
+
+class WatermarkResultHandler(ColumnarResultHandler):
+    '''Passes rows to another handler while tracking the largest value of one column.'''
+
+    def __init__(self, result_handler, column, column_type, columns=None):
+        ColumnarResultHandler.__init__(self)
+        self.result_handler = result_handler
+        self.column = column
+        self.column_type = column_type
+        self.column_index = None
+        self.watermark = None
+        self.row_count = 0
+        if columns is not None:
+            self.set_columns(columns)
+
+    def set_columns(self, columns, column_types=None):
+        ColumnarResultHandler.set_columns(self, columns, column_types)
+        self.column_index = self.columns.index(self.column)
+        if isinstance(self.result_handler, ColumnarResultHandler):
+            self.result_handler.set_columns(columns, column_types)
+
+    def handle_rows(self, rows):
+        self.row_count += len(rows)
+        for row in rows:
+            value = row['f'][self.column_index]['v']
+            if value is None:
+                continue
+            if self.watermark is None or (parse_value(value, self.column_type) >
+                                          parse_value(self.watermark, self.column_type)):
+                self.watermark = value
+        self.result_handler.handle_rows(rows)
+
+    def finish(self, type=None, value=None, traceback=None):
+        self.result_handler.finish(type, value, traceback)
+
+
+class IncrementalReader:
+    '''Exports only the partitions or rows of a table that changed since the last run.'''
+
+    def __init__(self, auth, project_id, dataset_id, table_id, output_dir, manifest_file=None,
+                 output_format='csv', sep=';', watermark_column=None, max_workers=10, metrics=None):
+        self.auth = auth
+        self.project_id = project_id
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.sep = sep
+        self.watermark_column = watermark_column
+        self.max_workers = max_workers
+        self.metrics = metrics if metrics is not None else get_metrics()
+        self.table_reader = TableReader(auth, project_id, dataset_id, table_id, metrics=self.metrics)
+        if manifest_file is None:
+            manifest_file = os.path.join(output_dir, '%s.manifest.json' % (table_id,))
+        self.manifest = ExportManifest(manifest_file, source='%s:%s.%s' % (project_id, dataset_id, table_id))
+
+    def make_file_name(self, suffix):
+        return os.path.join(self.output_dir, '%s.%s.%s' % (self.table_id, suffix, self.output_format))
+
+    def read(self):
+        '''Runs one incremental export and saves the manifest.'''
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        if self.watermark_column:
+            self.read_watermark()
+        else:
+            self.read_partitions()
+        self.manifest.save()
+
+    def read_partitions(self):
+        '''Re-reads new and modified partitions, replacing their previous shards.'''
+        changed = self.manifest.changed_partitions(self.table_reader.list_partitions())
+        print '%d partitions changed since the last export' % (len(changed),)
+        for batch_start in range(0, len(changed), self.max_workers):
+            threads = []
+            for partition_id, last_modified in changed[batch_start:batch_start + self.max_workers]:
+                reader = TableReader(self.auth, self.project_id, self.dataset_id,
+                                     '%s$%s' % (self.table_id, partition_id), metrics=self.metrics)
+                thread = TableReadThread(reader, self.make_file_name(partition_id), thread_id=partition_id,
+                                         output_format=self.output_format, sep=self.sep)
+                thread.start()
+                threads.append((partition_id, last_modified, thread))
+            for partition_id, last_modified, thread in threads:
+                thread.join()
+                if thread.error is not None:
+                    # Keep the previous export, so the partition is read again by the next run.
+                    print 'Read of partition %s failed, keeping the previous export' % (partition_id,)
+                    continue
+                outputs = {thread.output_file_name: {'rows': thread.table_reader.rows_read,
+                                                     'last_modified': str(last_modified)}}
+                self.manifest.replace_partition(partition_id, last_modified, outputs)
+            # Save after each batch, so an interrupted run does not repeat finished partitions.
+            self.manifest.save()
+
+    def read_watermark(self):
+        '''Reads rows past the stored watermark into a new shard.'''
+        _, _, columns, column_types = self.table_reader.get_table_info()
+        if self.watermark_column not in column_types:
+            raise ValueError('Unknown watermark column %s' % (self.watermark_column,))
+        column_type = column_types[self.watermark_column]
+        previous = self.manifest.get_state('watermark')
+        file_name = self.make_file_name(int(time.time()))
+        output_columns = columns if self.output_format.lower() == 'csv' else None
+        handler = WatermarkResultHandler(make_result_handler(file_name, self.output_format,
+                                                             columns=output_columns, sep=self.sep),
+                                         self.watermark_column, column_type)
+        if previous is None:
+            # Nothing exported yet: read the whole table without scanning it.
+            handler.set_columns(columns)
+            self.table_reader.read(handler)
+        else:
+            query = 'SELECT * FROM [%s:%s.%s] WHERE %s > %s' % (
+                self.project_id, self.dataset_id, self.table_id, self.watermark_column,
+                make_sql_literal(previous, column_type))
+            QueryReader(self.auth, self.project_id, metrics=self.metrics).read(handler, query)
+        if handler.row_count == 0:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+            print 'No rows past watermark %s' % (previous,)
+            return
+        self.manifest.set_output(file_name, rows=handler.row_count, watermark_from=previous,
+                                 watermark_to=handler.watermark)
+        self.manifest.set_state('watermark_column', self.watermark_column)
+        if handler.watermark is not None:
+            self.manifest.set_state('watermark', handler.watermark)
+        print 'Exported %d rows up to watermark %s' % (handler.row_count, handler.watermark)
+
+
+def main(argv):
+    parser = ArgumentParser(description='Incrementally export a BigQuery table into text files')
+    parser.add_argument('-a', '--service_account', required=True, help='Big Query service account name')
+    parser.add_argument('-s', '--client_secret', required=True,
+                        help='Path to client_secrets.json file required for API login')
+    parser.add_argument('-c', '--credentials',
+                        help='Path to credentials file (e.g. bigquery_credentials.dat) required for API login. '
+                             'If the file is not present, the browser window will be shown and you will be asked to authenticate')
+    parser.add_argument('-k', '--keyfile', help='Path to the key file (e.g., key.p12)')
+    parser.add_argument('-p', '--project_id', required=True, help='BigQuery project ID')
+    parser.add_argument('-d', '--dataset_id', required=True, help='BigQuery dataset ID')
+    parser.add_argument('-t', '--table_id', required=True, help='Name of the table which will be exported')
+    parser.add_argument('-o', '--output_directory', default='.', help='The directory where the output will be exported')
+    parser.add_argument('-f', '--format', default='csv', choices=['json', 'csv'], help='The output format')
+    parser.add_argument('--separator', help='Separator in CSV', default=';')
+    parser.add_argument('-m', '--manifest', help='Manifest file (default: <output_directory>/<table_id>.manifest.json)')
+    parser.add_argument('-w', '--watermark_column',
+                        help='Export rows with a larger value of this column instead of changed partitions')
+    parser.add_argument('--max_workers', type=int, default=10, help='Number of partitions read in parallel')
+    add_metrics_arguments(parser)
+    add_transport_arguments(parser)
+    args = parser.parse_args()
+    metrics = metrics_from_args(args)
+    transport = transport_from_args(args)
+
+    auth = BigQuery_Auth(service_acc=args.service_account, client_secrets=args.client_secret,
+                         credentials=args.credentials, key_file=args.keyfile, transport=transport)
+    reader = IncrementalReader(auth, args.project_id, args.dataset_id, args.table_id, args.output_directory,
+                               manifest_file=args.manifest, output_format=args.format, sep=args.separator,
+                               watermark_column=args.watermark_column, max_workers=args.max_workers,
+                               metrics=metrics)
+    reader.read()
+    metrics.close()
+    if args.transport_report:
+        print transport.format_report()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
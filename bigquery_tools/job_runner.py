@@ -18,18 +18,22 @@ import json
 import threading
 import time
 from auth import BigQuery_Auth
+from metrics import get_metrics
 
-from apiclient.errors import HttpError
+from googleapiclient.errors import HttpError
 
 class JobRunner:
 
-    def __init__(self, auth, project_id, job_id=None):
+    def __init__(self, auth, project_id, job_id=None, metrics=None, verbose=False):
         # Only one thread can call the bq_service at once.
         self.lock = threading.Lock()
         self.bq_service = auth.build_bq_client()
+        self.transport = auth.transport
         self.project_id = project_id
         self.job_id = job_id if job_id else 'job_%d' % int(time.time())
         self.start = None
+        self.metrics = metrics if metrics is not None else get_metrics()
+        self.verbose = verbose
 
     def get_job_ref(self):
         return {'projectId': self.project_id, 'jobId': self.job_id}
@@ -42,34 +46,40 @@ class JobRunner:
             'configuration': job_config}
         try:
             with self.lock:
-                result = self.bq_service.jobs().insert(
+                result = self.metrics.execute(self.bq_service.jobs().insert(
                     projectId=self.project_id,
-                    body=body).execute()
+                    body=body,
+                    fields=self.transport.fields('jobs.insert')), 'jobs.insert', job_id=self.job_id)
             return result['jobReference']
         except HttpError, err:
             print 'Error starting job %s:\n%s' % (body, err)
             return None
 
-    def get_job(self):
+    def get_job(self, kind='jobs.get'):
+        '''Fetches the job resource; kind selects the field mask used for the call.'''
         job_ref = self.get_job_ref()
         try:
             with self.lock:
-                return self.bq_service.jobs().get(
+                return self.metrics.execute(self.bq_service.jobs().get(
                     projectId=job_ref['projectId'],
-                    jobId=job_ref['jobId']).execute()
+                    jobId=job_ref['jobId'],
+                    fields=self.transport.fields(kind)), kind, job_id=self.job_id)
         except HttpError, err:
             print 'Error looking up job %s:\n%s' % (job_ref, err)
             return None
 
     def get_job_state(self):
-        job = self.get_job()
+        job = self.get_job('jobs.get.state')
         return job['status']['state'] if job else 'ERROR'
 
     def wait_for_complete(self):
         '''Waits for a BigQuery job to complete.'''
         while True:
             state = self.get_job_state()
-            print '%s %ds' % (state, time.time() - self.start)
+            elapsed = time.time() - self.start
+            self.metrics.record_job(self.job_id, state, elapsed)
+            if self.verbose:
+                print '%s %ds' % (state, elapsed)
             if state == 'DONE': break
             time.sleep(5)
 
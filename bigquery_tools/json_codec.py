@@ -0,0 +1,150 @@
+#!/usr/bin/python2.7
+
+'''Pluggable JSON decoding of API responses, and raw row passthrough.
+
+API clients built by build_client decode responses with the fastest codec
+installed: orjson, then ujson, then the standard json module. Set
+$BIGQUERY_TOOLS_JSON (or call set_codec) to force one of them.
+
+Most of a tabledata.list response is its rows array, and the JSON and
+NDJSON outputs only write the rows back out as JSON. A raw request
+(make_raw) returns a RawPage instead of the decoded response: the rows array
+is located in the response bytes and cut into the text of each row, and
+only the small remainder of the response (pageToken, totalRows) is decoded.
+Row boundaries are found with a regular expression, which is safe because a
+row object {"f": ...} only appears at the top level of the array; nested
+records are always wrapped in {"v": ...}. A response that does not have the
+expected layout is decoded as usual.
+'''
+
+import json
+import os
+import re
+import threading
+
+CODECS = ('orjson', 'ujson', 'json')
+
+# The start of a row object: '[' or ',' followed by {"f":
+ROW_START = re.compile(r'[\[,]\s*(\{\s*"f"\s*:)')
+# The end of a rows array that is followed by another key.
+ARRAY_END = re.compile(r'\]\s*,\s*"')
+ROWS_KEY = re.compile(r'"rows"\s*:\s*\[')
+
+_codec = None
+_codec_lock = threading.Lock()
+
+
+class Codec:
+    '''A JSON module: its name and its loads function.'''
+
+    def __init__(self, name, loads):
+        self.name = name
+        self.loads = loads
+
+
+def load_codec(name):
+    module = __import__(name)
+    return Codec(name, module.loads)
+
+
+def get_codec():
+    '''Returns the codec used to decode API responses.'''
+    global _codec
+    with _codec_lock:
+        if _codec is None:
+            names = [os.environ['BIGQUERY_TOOLS_JSON']] if 'BIGQUERY_TOOLS_JSON' in os.environ else CODECS
+            for name in names:
+                try:
+                    _codec = load_codec(name)
+                    break
+                except ImportError:
+                    continue
+            else:
+                _codec = Codec('json', json.loads)
+        return _codec
+
+
+def set_codec(name):
+    '''Selects the codec by module name, e.g. 'ujson'.'''
+    global _codec
+    codec = load_codec(name)
+    with _codec_lock:
+        _codec = codec
+
+
+def make_json_model(data_wrapper=False):
+    '''Returns a googleapiclient JsonModel that decodes responses with the selected codec.'''
+    from googleapiclient.model import JsonModel
+
+    class CodecJsonModel(JsonModel):
+
+        def deserialize(self, content):
+            body = get_codec().loads(content)
+            if self._data_wrapper and isinstance(body, dict) and 'data' in body:
+                body = body['data']
+            return body
+
+    return CodecJsonModel(data_wrapper)
+
+
+class RawPage(dict):
+    '''A response with undecoded rows.
+
+    The dict holds the other fields of the response. raw_rows is the list of
+    the JSON texts of the rows, or None if the response had to be decoded,
+    in which case the dict is the whole response. row_count is the number
+    of rows either way.
+    '''
+
+    def __init__(self, content):
+        dict.__init__(self)
+        split = split_rows(content)
+        if split is None:
+            self.raw_rows = None
+            self.update(get_codec().loads(content))
+            self.row_count = len(self.get('rows', ()))
+        else:
+            self.raw_rows, rest = split
+            self.update(rest)
+            self.row_count = len(self.raw_rows)
+
+
+def split_rows(content):
+    '''Returns the texts of the rows of a response and the rest of it (decoded),
+    or None if the rows cannot be located.'''
+    key = ROWS_KEY.search(content)
+    if key is None:
+        # No rows (the last page), or an unexpected layout.
+        return None
+    array_start = key.end() - 1
+    end = ARRAY_END.search(content, array_start)
+    array_end = end.start() if end is not None else content.rfind(']')
+    if '\n' in content[array_start:array_end]:
+        # Pretty printed rows would not be one line each.
+        return None
+    try:
+        rest = get_codec().loads(content[:key.start()] + '"rows": null' + content[array_end + 1:])
+    except ValueError:
+        return None
+    if not isinstance(rest, dict):
+        return None
+    del rest['rows']
+    starts = [match.start(1) for match in ROW_START.finditer(content, array_start, array_end)]
+    rows = []
+    for index, start in enumerate(starts):
+        end = starts[index + 1] if index + 1 < len(starts) else array_end
+        rows.append(content[start:end].rstrip(', \t\r'))
+    return rows, rest
+
+
+def make_raw(request):
+    '''Makes an API request return a RawPage instead of the decoded response.'''
+    postproc = request.postproc
+
+    def raw_postproc(resp, content):
+        if resp.status >= 300:
+            # Raises the HttpError.
+            return postproc(resp, content)
+        return RawPage(content)
+    request.postproc = raw_postproc
+    return request
@@ -0,0 +1,89 @@
+#!/usr/bin/python2.7
+
+'''Local manifest of an export.
+
+The manifest is a JSON file that records the output files of an export
+together with the state needed to continue it later, e.g. the watermark
+value of an incremental export or the last modification time of each
+exported partition. It is rewritten atomically on every save, so an
+interrupted run leaves the previous manifest intact.
+
+Example:
+{
+  "source": "project:dataset.table",
+  "state": {"watermark": "1466000000.0", "partitions": {"20160601": "1466000000000"}},
+  "outputs": {"out/table.20160601.csv": {"rows": 1000, "partition": "20160601"}}
+}
+'''
+
+import json
+import os
+import threading
+
+
+class ExportManifest:
+    '''Reads and atomically updates an export manifest file.'''
+
+    def __init__(self, file_name, source=None):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.data = {'source': source, 'state': {}, 'outputs': {}}
+        if os.path.exists(file_name):
+            with open(file_name) as f:
+                self.data.update(json.load(f))
+        if source is not None:
+            self.data['source'] = source
+
+    def get_state(self, key, default=None):
+        return self.data['state'].get(key, default)
+
+    def set_state(self, key, value):
+        with self.lock:
+            self.data['state'][key] = value
+
+    def outputs(self):
+        '''Returns a dict of output file name -> output properties.'''
+        return dict(self.data['outputs'])
+
+    def set_output(self, file_name, **properties):
+        with self.lock:
+            self.data['outputs'][file_name] = properties
+
+    def remove_output(self, file_name):
+        with self.lock:
+            self.data['outputs'].pop(file_name, None)
+
+    def changed_partitions(self, partitions):
+        '''Given (partition_id, last_modified) pairs, returns those that are new
+        or were modified since the last export.'''
+        exported = self.get_state('partitions', {})
+        return [(partition_id, last_modified) for partition_id, last_modified in partitions
+                if exported.get(partition_id) != str(last_modified)]
+
+    def replace_partition(self, partition_id, last_modified, outputs):
+        '''Records the new outputs of a partition and deletes the files of its previous export.
+
+        outputs: dict of output file name -> output properties.
+        '''
+        with self.lock:
+            for file_name, properties in self.data['outputs'].items():
+                if properties.get('partition') == partition_id and file_name not in outputs:
+                    if os.path.exists(file_name):
+                        os.remove(file_name)
+                    del self.data['outputs'][file_name]
+            for file_name, properties in outputs.items():
+                properties['partition'] = partition_id
+                self.data['outputs'][file_name] = properties
+            self.data['state'].setdefault('partitions', {})[partition_id] = str(last_modified)
+
+    def save(self):
+        '''Writes the manifest to a temporary file and renames it over the old one.'''
+        directory = os.path.dirname(self.file_name)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self.lock:
+            content = json.dumps(self.data, indent=2, sort_keys=True)
+        temp_file_name = '%s.%d.tmp' % (self.file_name, os.getpid())
+        with open(temp_file_name, 'w') as f:
+            f.write(content)
+        os.rename(temp_file_name, self.file_name)
@@ -25,18 +25,32 @@ class MetadataReader:
     def list_tables(self, project_id, dataset_id):
         try:
             tables = self.service.tables()
-            tlist = tables.list(projectId=project_id, datasetId=dataset_id).execute()
+            tlist = tables.list(projectId=project_id, datasetId=dataset_id,
+                                fields=self.auth.transport.fields('tables.list')).execute()
             return [field['id'] for field in tlist['tables']]
         except HttpError as err:
             print 'Error in listTables:', pprint(err.content)
 
 
+    def iter_tables(self, project_id, dataset_id):
+        '''Yields the tables.list entries (id, tableReference, type) of all tables in a dataset.'''
+        tables = self.service.tables()
+        request = tables.list(projectId=project_id, datasetId=dataset_id,
+                              fields=self.auth.transport.fields('tables.list'))
+        while request is not None:
+            response = request.execute()
+            for table in response.get('tables', []):
+                yield table
+            request = tables.list_next(request, response)
+
+
     def table_columns(self, project_id, dataset_id, table_id):
         try:
             tableCollection = self.service.tables()
             tableReply = tableCollection.get(projectId=project_id,
                                              datasetId=dataset_id,
-                                             tableId=table_id).execute()
+                                             tableId=table_id,
+                                             fields=self.auth.transport.fields('tables.get')).execute()
             return {field['name']: field['type'] for field in tableReply['schema']['fields']}
         except HttpError as err:
             print 'Error in query table data: ', pprint(err)
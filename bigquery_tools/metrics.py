@@ -0,0 +1,259 @@
+#!/usr/bin/python2.7
+
+'''Instrumentation for API calls, downloads and jobs.
+
+Readers record events into a Metrics object instead of printing them. Each
+event is a flat dict such as
+  {'ts': 1466000000.0, 'event': 'request', 'kind': 'tabledata.list',
+   'latency': 0.42, 'bytes': 1048576, 'rows': 8192, 'thread': '[0-1000)'}
+and is passed to every registered sink. Three sinks are provided:
+
+  CallbackSink(fn)                   calls fn(event) for each event
+  JSONLinesSink(path)                appends one JSON object per event
+  PrometheusTextfileSink(path)       aggregates counters and gauges and writes
+                                     them in the node_exporter textfile format
+
+A Metrics object without sinks only keeps the counters in memory, which is
+cheap enough to leave enabled on the hot path.
+
+Usage:
+  metrics = Metrics([JSONLinesSink('metrics.jsonl')])
+  reader = TableReader(auth, project_id, dataset_id, table_id, metrics=metrics)
+  ...
+  metrics.close()
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+from transport import CALL_TYPE_HEADER
+
+METRIC_PREFIX = 'bigquery_tools'
+
+
+class CallbackSink:
+    '''Passes every event to a user supplied function.'''
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def handle(self, event):
+        self.callback(event)
+
+    def close(self):
+        pass
+
+
+class JSONLinesSink:
+    '''Writes every event as a JSON object on its own line.'''
+
+    def __init__(self, file_name):
+        self.lock = threading.Lock()
+        self.output_file = open(file_name, 'a')
+
+    def handle(self, event):
+        line = json.dumps(event, sort_keys=True) + '\n'
+        with self.lock:
+            # Events arriving after close() are dropped.
+            if self.output_file:
+                self.output_file.write(line)
+
+    def close(self):
+        with self.lock:
+            if self.output_file:
+                self.output_file.close()
+                self.output_file = None
+
+
+class PrometheusTextfileSink:
+    '''Aggregates events into counters and gauges and periodically rewrites
+    a Prometheus textfile collector file.'''
+
+    def __init__(self, file_name, flush_interval=10):
+        self.file_name = file_name
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # Serializes flushes; events are still aggregated while the file is written.
+        self.flush_lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.last_flush = time.time()
+
+    def _add(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def handle(self, event):
+        with self.lock:
+            if event['event'] == 'request':
+                labels = {'kind': event['kind']}
+                self._add('requests_total', labels, 1)
+                self._add('request_seconds_total', labels, event.get('latency', 0))
+                self._add('response_bytes_total', labels, event.get('bytes', 0))
+                self._add('rows_total', labels, event.get('rows', 0))
+            elif event['event'] == 'retry':
+                self._add('retries_total', {'kind': event['kind'], 'status': str(event.get('status'))}, 1)
+            elif event['event'] == 'gauge':
+                self.gauges[(event['name'], ())] = event['value']
+            elif event['event'] == 'job':
+                self._add('job_polls_total', {'state': event['state']}, 1)
+            elif event['event'] == 'page_size':
+                self.gauges[('page_size', (('kind', event['kind']),))] = event['max_results']
+                self._add('page_size_decisions_total', {'kind': event['kind'], 'reason': event['reason']}, 1)
+            flush = time.time() - self.last_flush >= self.flush_interval
+            if flush:
+                # Only the thread that sees the interval expire flushes.
+                self.last_flush = time.time()
+        if flush:
+            self.flush()
+
+    def format_metric(self, name, labels, value):
+        label_text = ','.join('%s="%s"' % (key, val) for key, val in labels)
+        if label_text:
+            return '%s_%s{%s} %s' % (METRIC_PREFIX, name, label_text, value)
+        return '%s_%s %s' % (METRIC_PREFIX, name, value)
+
+    def flush(self):
+        '''Atomically replaces the textfile with the current values.'''
+        # Flushes are serialized, so an older snapshot never overwrites a newer one.
+        with self.flush_lock:
+            with self.lock:
+                lines = []
+                for metrics, metric_type in ((self.counters, 'counter'), (self.gauges, 'gauge')):
+                    for name in sorted(set(key[0] for key in metrics)):
+                        lines.append('# TYPE %s_%s %s' % (METRIC_PREFIX, name, metric_type))
+                        for key in sorted(metrics):
+                            if key[0] == name:
+                                lines.append(self.format_metric(name, key[1], metrics[key]))
+                self.last_flush = time.time()
+            temp_file_name = '%s.%d.tmp' % (self.file_name, os.getpid())
+            with open(temp_file_name, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.rename(temp_file_name, self.file_name)
+
+    def close(self):
+        self.flush()
+
+
+class Metrics:
+    '''Collects request, retry, gauge and job events and fans them out to sinks.'''
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks or [])
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.gauges = {}
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def emit(self, event, **fields):
+        '''Sends an event to all sinks.'''
+        if not self.sinks:
+            return
+        fields['event'] = event
+        fields['ts'] = time.time()
+        fields.setdefault('thread', threading.current_thread().name)
+        for sink in self.sinks:
+            try:
+                sink.handle(fields)
+            except Exception:
+                # A failing sink must not break the read it is measuring.
+                logging.exception('Metrics sink %s failed', sink.__class__.__name__)
+
+    def _add_totals(self, kind, **values):
+        with self.lock:
+            totals = self.totals.setdefault(kind, {'requests': 0, 'latency': 0.0, 'bytes': 0,
+                                                   'rows': 0, 'retries': 0})
+            for key, value in values.items():
+                totals[key] += value
+
+    def record_request(self, kind, latency, bytes=0, rows=0, **labels):
+        '''Records one completed API call or download chunk.'''
+        self._add_totals(kind, requests=1, latency=latency, bytes=bytes, rows=rows)
+        self.emit('request', kind=kind, latency=latency, bytes=bytes, rows=rows, **labels)
+
+    def record_retry(self, kind, status, **labels):
+        '''Records a retryable error.'''
+        self._add_totals(kind, retries=1)
+        self.emit('retry', kind=kind, status=status, **labels)
+
+    def record_job(self, job_id, state, elapsed, **labels):
+        '''Records one poll of a job's state.'''
+        self.emit('job', job_id=job_id, state=state, elapsed=elapsed, **labels)
+
+    def record_page_size(self, kind, max_results, reason, **fields):
+        '''Records the page size chosen for the next request of a reader (see page_sizer.py).'''
+        self.emit('page_size', kind=kind, max_results=max_results, reason=reason, **fields)
+
+    def add_gauge(self, name, delta, **labels):
+        '''Adjusts a gauge (e.g. the number of active readers) and returns its value.'''
+        with self.lock:
+            value = self.gauges.get(name, 0) + delta
+            self.gauges[name] = value
+        self.emit('gauge', name=name, value=value, **labels)
+        return value
+
+    def execute(self, request, kind, num_retries=0, measurement=None, **labels):
+        '''Executes an API request, recording its latency, response size and row count.
+
+        measurement: a dict that receives the latency, bytes and rows of the request.
+        '''
+        response_bytes = [0]
+        postproc = request.postproc
+
+        def measure(resp, content):
+            response_bytes[0] = len(content)
+            return postproc(resp, content)
+        request.postproc = measure
+        # Lets the transport attribute the response to this call type.
+        request.headers[CALL_TYPE_HEADER] = kind
+        start = time.time()
+        response = request.execute(num_retries=num_retries)
+        latency = time.time() - start
+        if hasattr(response, 'row_count'):
+            # A json_codec.RawPage.
+            rows = response.row_count
+        else:
+            rows = len(response.get('rows', ())) if isinstance(response, dict) else 0
+        if measurement is not None:
+            measurement.update(latency=latency, bytes=response_bytes[0], rows=rows)
+        self.record_request(kind, latency, bytes=response_bytes[0], rows=rows, **labels)
+        return response
+
+    def summary(self):
+        '''Returns a copy of the per-kind totals and current gauges.'''
+        with self.lock:
+            return {'totals': dict((kind, dict(values)) for kind, values in self.totals.items()),
+                    'gauges': dict(self.gauges)}
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+_default_metrics = Metrics()
+
+
+def get_metrics():
+    '''Returns the process-wide Metrics used by readers that are not given one.'''
+    return _default_metrics
+
+
+def add_metrics_arguments(parser):
+    '''Adds the common metrics options to a command line parser.'''
+    parser.add_argument('--metrics_file', help='Write metrics events to this file as JSON lines')
+    parser.add_argument('--prometheus_file', help='Write aggregated metrics to this Prometheus textfile')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Print a status line for every page read')
+
+
+def metrics_from_args(args):
+    '''Registers the sinks requested on the command line with the process-wide Metrics.'''
+    metrics = get_metrics()
+    if args.metrics_file:
+        metrics.add_sink(JSONLinesSink(args.metrics_file))
+    if args.prometheus_file:
+        metrics.add_sink(PrometheusTextfileSink(args.prometheus_file))
+    return metrics
@@ -3,41 +3,91 @@ __author__ = 'Paulius Danenas'
 import os
 import json
 import csv
+import sqlite3
+import threading
+from checksums import HashingWriter
+from manifest import ExportManifest
+from output_writer import open_output
 
 class ResultHandler:
     '''Abstract class to handle reading TableData rows.'''
 
+    # Whether handle_raw_rows writes the row texts without decoding them (see json_codec.py).
+    accepts_raw_rows = False
+
     def handle_rows(self, rows):
         '''Process one page of results.'''
         pass
 
+    def handle_raw_rows(self, rows):
+        '''Process one page of results given as the JSON texts of the rows.'''
+        self.handle_rows([json.loads(row) for row in rows])
+
+    def finish(self, type=None, value=None, traceback=None):
+        '''Called once after the last page.'''
+        pass
+
 
 class ColumnarResultHandler(ResultHandler):
 
     def __init__(self):
         self.columns = None
+        self.column_types = None
 
-    def set_columns(self, columns):
+    def set_columns(self, columns, column_types=None):
         self.columns = list(columns)
+        if column_types is not None:
+            self.column_types = dict(column_types)
 
 
 class FileResultHandler(ResultHandler):
-    '''Result handler that saves rows to a file.'''
+    '''Result handler that saves rows to a file.
 
-    def __init__(self, output_file_name):
+    With max_rows or max_bytes the output rolls over to a new file once the
+    current one holds that many rows or bytes: output.csv is written as
+    output.00000.csv, output.00001.csv, ... and every file is complete on its
+    own (a CSV header, a JSON array). The files with their row counts, byte
+    sizes and hashes are listed in output.csv.manifest.json.
+    '''
+
+    accepts_raw_rows = True
+
+    def __init__(self, output_file_name, max_rows=None, max_bytes=None):
         self.output_file_name = output_file_name
         self.output_file = None
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.rotate = bool(max_rows or max_bytes)
+        self.file_index = 0
+        self.file_rows = 0
+        self.current_file_name = None
+        self.manifest = None
+        if self.rotate:
+            self.manifest = ExportManifest('%s.manifest.json' % (output_file_name,),
+                                           source=os.path.basename(output_file_name))
         print 'Writing results to %s' % (output_file_name,)
 
     def __enter__(self):
         self.make_output_dir()
-        self.output_file = open(self.output_file_name, 'wb')
+        if self.manifest is not None:
+            # Files of a previous export with the same name are no longer valid. Their paths
+            # are relative to the manifest; parts beyond the new last one would be left over.
+            manifest_dir = os.path.dirname(self.manifest.file_name)
+            for file_name in self.manifest.outputs():
+                self.manifest.remove_output(file_name)
+                path = os.path.join(manifest_dir, file_name)
+                if os.path.exists(path):
+                    os.remove(path)
+            self.manifest.set_state('finished', False)
+        self.open_file()
         return self
 
     def finish(self, type=None, value=None, traceback=None):
         if self.output_file:
-            self.output_file.close()
-            self.output_file = None
+            self.close_file()
+        if self.manifest is not None:
+            self.manifest.set_state('finished', type is None)
+            self.manifest.save()
         print 'Finished writing results'
 
     def make_output_dir(self):
@@ -47,47 +97,371 @@ class FileResultHandler(ResultHandler):
             return
         os.makedirs(output_dir)
 
+    def part_file_name(self, index):
+        root, ext = os.path.splitext(self.output_file_name)
+        return '%s.%05d%s' % (root, index, ext)
+
+    def open_file(self):
+        '''Opens the next output file.'''
+        self.file_rows = 0
+        if self.rotate:
+            self.current_file_name = self.part_file_name(self.file_index)
+            # Hashes the file while it is written, for the manifest.
+            self.output_file = HashingWriter(open_output(self.current_file_name))
+        else:
+            self.current_file_name = self.output_file_name
+            self.output_file = open_output(self.current_file_name)
+
+    def close_file(self):
+        '''Closes the current output file and records it in the manifest.'''
+        self.output_file.close()
+        if self.rotate:
+            properties = {'rows': self.file_rows, 'bytes': self.output_file.hasher.size}
+            properties.update(self.output_file.hasher.hashes())
+            self.manifest.set_output(os.path.basename(self.current_file_name), **properties)
+            self.manifest.save()
+            self.file_index += 1
+        self.output_file = None
+
+    def next_row(self):
+        '''Called before a row is written; rolls over to a new file if the current one is full.'''
+        if self.output_file is None:
+            self.__enter__()
+        elif self.rotate and self.file_rows and (
+                (self.max_rows and self.file_rows >= self.max_rows) or
+                (self.max_bytes and self.output_file.hasher.size >= self.max_bytes)):
+            self.close_file()
+            self.open_file()
+        self.file_rows += 1
+
+    def format_row(self, row):
+        # Rows from the API are dicts; they are written one JSON object per line.
+        return row if isinstance(row, basestring) else json.dumps(row) + '\n'
+
     def handle_rows(self, rows):
         if self.output_file is None:
             self.__enter__()
-        self.output_file.write(''.join(rows))
+        if not self.rotate:
+            self.output_file.write(''.join(self.format_row(row) for row in rows))
+            return
+        for row in rows:
+            self.next_row()
+            self.output_file.write(self.format_row(row))
+
+    def handle_raw_rows(self, rows):
+        # The row texts are already one JSON object each.
+        self.handle_rows([row + '\n' for row in rows])
 
 
 class JSONResultHandler(FileResultHandler):
+    '''Writes the rows as one JSON array per file.'''
 
-    def __init__(self, output_file_name):
-        FileResultHandler.__init__(self, output_file_name)
-        self.output = list()
+    def open_file(self):
+        FileResultHandler.open_file(self)
+        self.output_file.write('[')
+
+    def close_file(self):
+        self.output_file.write(']')
+        FileResultHandler.close_file(self)
 
     def finish(self, type=None, value=None, traceback=None):
-        if self.output_file is None:
+        if self.output_file is None and self.file_index == 0:
+            # An empty result is still written as an empty array.
             self.__enter__()
-        self.output_file.write(json.dumps(self.output))
         FileResultHandler.finish(self, type, value, traceback)
 
     def handle_rows(self, rows):
-        self.output.extend(rows)
+        for row in rows:
+            self.next_row()
+            # Rows are written as they arrive, separated like json.dumps separates list items.
+            self.output_file.write((', ' if self.file_rows > 1 else '') + json.dumps(row))
+
+    def handle_raw_rows(self, rows):
+        for row in rows:
+            self.next_row()
+            self.output_file.write((', ' if self.file_rows > 1 else '') + row)
 
 
 class CSVResultHandler(FileResultHandler, ColumnarResultHandler):
 
-    def __init__(self, output_file_name, columns=None, sep=';'):
-        FileResultHandler.__init__(self, output_file_name)
+    accepts_raw_rows = False
+
+    def handle_raw_rows(self, rows):
+        ResultHandler.handle_raw_rows(self, rows)
+
+    def __init__(self, output_file_name, columns=None, sep=';', max_rows=None, max_bytes=None):
+        FileResultHandler.__init__(self, output_file_name, max_rows=max_rows, max_bytes=max_bytes)
         self.csv_file = None
         self.columns = columns
         self.sep = sep
 
-    def __enter__(self):
-        FileResultHandler.__enter__(self)
+    def open_file(self):
+        FileResultHandler.open_file(self)
         self.csv_file = csv.writer(self.output_file, delimiter=self.sep,
                                    quoting=csv.QUOTE_MINIMAL)
+        # Every file gets the header, so each can be read on its own.
         if self.columns:
             self.csv_file.writerow(self.columns)
-        return self
 
     def handle_rows(self, rows):
         if self.output_file is None:
             self.__enter__()
         for row in rows:
+            self.next_row()
             self.csv_file.writerow([field['v'].encode("ascii", "ignore")
                                     if field['v'] is not None else None for field in row['f']])
+
+
+# SQLite column types of the BigQuery types; the others are stored as TEXT.
+SQLITE_TYPES = {'INTEGER': 'INTEGER', 'INT64': 'INTEGER', 'FLOAT': 'REAL', 'FLOAT64': 'REAL',
+                'BOOLEAN': 'INTEGER', 'BOOL': 'INTEGER', 'TIMESTAMP': 'REAL'}
+# Rows inserted per transaction.
+SQLITE_BATCH_ROWS = 100000
+
+
+def sqlite_quote(name):
+    return '"%s"' % (name.replace('"', '""'),)
+
+
+def sqlite_converter(column_type):
+    '''Returns the function converting a tabledata value of a column type to its SQLite value.'''
+    sqlite_type = SQLITE_TYPES.get((column_type or '').upper(), 'TEXT')
+
+    def convert(value):
+        if value is None:
+            return None
+        if isinstance(value, (list, dict)):
+            # Repeated and nested fields are stored as JSON.
+            return json.dumps(value)
+        if sqlite_type == 'INTEGER':
+            if value in ('true', 'false'):
+                return 1 if value == 'true' else 0
+            return int(value)
+        if sqlite_type == 'REAL':
+            return float(value)
+        return value
+    return convert
+
+
+class SQLiteWriter:
+    '''The connection to one database file, shared by all handlers writing into it.
+
+    SQLite allows one writer at a time, so the handlers of a parallel read
+    insert through one connection under a lock instead of waiting for each
+    other's database locks. Rows are inserted in transactions of batch_rows
+    rows with journaling and syncing off; the indexes are built when the
+    last handler has finished, so they are not updated on every insert.
+
+    A table is dropped and created again the first time the writer creates
+    it, so an export replaces the table of an earlier one. The writer stays
+    open between loads (the pieces of a parallel read may start after others
+    have finished) until close_idle_sqlite_writers ends the run.
+    '''
+
+    def __init__(self, database_file, batch_rows=SQLITE_BATCH_ROWS):
+        self.database_file = database_file
+        self.batch_rows = batch_rows
+        self.lock = threading.Lock()
+        self.users = 0
+        self.pending_rows = 0
+        self.tables = set()
+        self.indexes = []
+        self.connection = sqlite3.connect(database_file, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA temp_store=MEMORY')
+        self.connection.execute('PRAGMA cache_size=-262144')
+
+    def begin_load(self):
+        with self.lock:
+            # A failed load leaves a database to be deleted, not one to be recovered.
+            self.connection.execute('PRAGMA journal_mode=OFF')
+            self.connection.execute('PRAGMA synchronous=OFF')
+
+    def create_table(self, table_name, columns, column_types):
+        with self.lock:
+            if table_name in self.tables:
+                return
+            self.connection.execute('DROP TABLE IF EXISTS %s' % (sqlite_quote(table_name),))
+            self.connection.execute('CREATE TABLE %s (%s)' % (
+                sqlite_quote(table_name),
+                ', '.join('%s %s' % (sqlite_quote(column),
+                                     SQLITE_TYPES.get(column_types.get(column, '').upper(), 'TEXT'))
+                          for column in columns)))
+            self.tables.add(table_name)
+
+    def add_indexes(self, table_name, indexes):
+        with self.lock:
+            for index in indexes:
+                index = (index,) if isinstance(index, basestring) else tuple(index)
+                if (table_name, index) not in self.indexes:
+                    self.indexes.append((table_name, index))
+
+    def insert(self, table_name, columns, rows):
+        with self.lock:
+            if self.pending_rows == 0:
+                self.connection.execute('BEGIN')
+            self.connection.executemany('INSERT INTO %s (%s) VALUES (%s)' % (
+                sqlite_quote(table_name), ', '.join(sqlite_quote(column) for column in columns),
+                ', '.join('?' * len(columns))), rows)
+            self.pending_rows += len(rows)
+            if self.pending_rows >= self.batch_rows:
+                self.connection.execute('COMMIT')
+                self.pending_rows = 0
+
+    def end_load(self):
+        '''Commits the last rows, builds the indexes and restores the default pragmas.'''
+        with self.lock:
+            if self.pending_rows:
+                self.connection.execute('COMMIT')
+                self.pending_rows = 0
+            for table_name, index in self.indexes:
+                self.connection.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (
+                    sqlite_quote('%s_%s' % (table_name, '_'.join(index))), sqlite_quote(table_name),
+                    ', '.join(sqlite_quote(column) for column in index)))
+            self.connection.execute('PRAGMA journal_mode=DELETE')
+            self.connection.execute('PRAGMA synchronous=FULL')
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+_sqlite_writers = {}
+_sqlite_writers_lock = threading.Lock()
+
+
+def open_sqlite_writer(database_file):
+    '''Returns the SQLiteWriter of a database file, shared by all handlers of the process.'''
+    key = os.path.abspath(database_file)
+    with _sqlite_writers_lock:
+        if key not in _sqlite_writers:
+            _sqlite_writers[key] = SQLiteWriter(database_file)
+        writer = _sqlite_writers[key]
+        writer.users += 1
+        if writer.users == 1:
+            writer.begin_load()
+        return writer
+
+
+def release_sqlite_writer(writer):
+    '''Finishes the load when the last handler of the writer is done.'''
+    with _sqlite_writers_lock:
+        writer.users -= 1
+        if writer.users == 0:
+            writer.end_load()
+
+
+def close_idle_sqlite_writers():
+    '''Closes the writers no handler uses; the next export into their files replaces the tables again.'''
+    with _sqlite_writers_lock:
+        for key, writer in _sqlite_writers.items():
+            if writer.users == 0:
+                writer.close()
+                del _sqlite_writers[key]
+
+
+class SQLiteResultHandler(ColumnarResultHandler):
+    '''Loads the rows into a table of a SQLite database.
+
+    The table is created with typed columns from the BigQuery schema
+    (INTEGER, REAL or TEXT; repeated and nested fields as JSON text) and
+    the rows of each page are inserted with one executemany. Several handlers
+    may load the same database file at once, e.g. the threads of a parallel
+    read; see SQLiteWriter. indexes: columns (or tuples of columns) to index
+    once the load is done.
+    '''
+
+    def __init__(self, database_file, table_name, columns=None, column_types=None, indexes=None):
+        ColumnarResultHandler.__init__(self)
+        self.database_file = database_file
+        self.table_name = table_name
+        if columns is not None:
+            self.set_columns(columns, column_types)
+        self.indexes = list(indexes or [])
+        self.writer = None
+        self.converters = None
+        print 'Writing results to %s (table %s)' % (database_file, table_name)
+
+    def __enter__(self):
+        output_dir = os.path.dirname(self.database_file)
+        if output_dir and not os.path.isdir(output_dir):
+            try:
+                os.makedirs(output_dir)
+            except OSError:
+                # Created by another handler of the same read.
+                if not os.path.isdir(output_dir):
+                    raise
+        self.writer = open_sqlite_writer(self.database_file)
+        if self.indexes:
+            self.writer.add_indexes(self.table_name, self.indexes)
+        return self
+
+    def handle_rows(self, rows):
+        if self.writer is None:
+            self.__enter__()
+        if not rows:
+            return
+        if self.columns is None:
+            raise ValueError('The columns of %s are not known' % (self.table_name,))
+        if self.converters is None:
+            column_types = self.column_types or {}
+            self.writer.create_table(self.table_name, self.columns, column_types)
+            self.converters = [sqlite_converter(column_types.get(column)) for column in self.columns]
+        converters = self.converters
+        self.writer.insert(self.table_name, self.columns,
+                           [[convert(field['v']) for convert, field in zip(converters, row['f'])] for row in rows])
+
+    def finish(self, type=None, value=None, traceback=None):
+        if self.writer is None and self.columns is not None and type is None:
+            # An empty result is still loaded as an empty table.
+            self.__enter__()
+        if self.writer is not None and self.converters is None and self.columns is not None:
+            self.writer.create_table(self.table_name, self.columns, self.column_types or {})
+        if self.writer is not None:
+            release_sqlite_writer(self.writer)
+            self.writer = None
+        print 'Finished writing results'
+
+
+def create_sqlite_indexes(database_file, table_name, indexes):
+    '''Builds indexes on a loaded table, e.g. after a parallel read.'''
+    writer = open_sqlite_writer(database_file)
+    writer.add_indexes(table_name, indexes)
+    release_sqlite_writer(writer)
+
+
+def sqlite_database_name(output_file_name):
+    '''Returns the database file and table name of an output file name.
+
+    Output files are named after the table, with a piece or partition suffix
+    in parallel reads (table.3, table.20160101.0); all of them load the same
+    table of dir/table.sqlite. A name ending in .sqlite is the database file.
+    '''
+    table_name = os.path.basename(output_file_name).split('.')[0]
+    if output_file_name.endswith('.sqlite'):
+        return output_file_name, table_name
+    return os.path.join(os.path.dirname(output_file_name), '%s.sqlite' % (table_name,)), table_name
+
+
+def make_result_handler(output_file_name, output_format='csv', columns=None, sep=';', max_rows=None, max_bytes=None,
+                        column_types=None, indexes=None):
+    '''Creates the result handler for an output format name.
+
+    max_rows, max_bytes: roll over to a new output file after this many rows or bytes.
+    column_types, indexes: the BigQuery types of the columns and the columns to index of a SQLite output.
+    '''
+    if output_format.lower() == 'sqlite':
+        database_file, table_name = sqlite_database_name(output_file_name)
+        return SQLiteResultHandler(database_file, table_name, columns=columns, column_types=column_types,
+                                   indexes=indexes)
+    elif output_format.lower() == 'csv':
+        return CSVResultHandler(output_file_name, columns=columns, sep=sep, max_rows=max_rows, max_bytes=max_bytes)
+    elif output_format.lower() == 'json':
+        return JSONResultHandler(output_file_name, max_rows=max_rows, max_bytes=max_bytes)
+    else:
+        return FileResultHandler(output_file_name, max_rows=max_rows, max_bytes=max_bytes)
+
+
+def add_rotation_arguments(parser):
+    '''Adds the output file rotation options to an ArgumentParser.'''
+    parser.add_argument('--max_file_rows', type=int, help='Start a new output file after this many rows')
+    parser.add_argument('--max_file_bytes', type=int, help='Start a new output file after this many bytes')
@@ -0,0 +1,198 @@
+#!/usr/bin/python2.7
+
+'''Buffered output files for the result handlers and shard writers.
+
+Result handlers write many small strings (a CSV row, a JSON row) from the
+threads that also read from the network. open_output returns a
+BufferedWriter that collects them in memory and writes them to the file in
+large blocks: a write is issued once buffer_size bytes are pending, and
+only whole multiples of ALIGNMENT bytes are written until the file is
+flushed or closed, so the file is written in aligned blocks.
+
+durability sets when data is forced to disk with fsync:
+  'none'   never (the default; the data reaches the disk when the OS writes it)
+  'close'  when the file is closed, so a finished output is on disk
+  'flush'  after every block written
+
+With io_thread=True the blocks are written by one dedicated I/O thread
+instead of the thread that produced them, so a slow disk does not stall the
+reads. At most MAX_PENDING_BYTES may be waiting for the I/O thread; writers
+wait beyond that. Errors of the I/O thread are raised by the next write or
+by close.
+
+The defaults are set for the process with configure, or from the command
+line with add_writer_arguments and writer_options_from_args.
+'''
+
+import os
+import threading
+from collections import deque
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+ALIGNMENT = 64 * 1024
+MAX_PENDING_BYTES = 64 * 1024 * 1024
+DURABILITY = ('none', 'close', 'flush')
+
+_options = {'buffer_size': DEFAULT_BUFFER_SIZE, 'durability': 'none', 'io_thread': False}
+
+
+def configure(buffer_size=None, durability=None, io_thread=None):
+    '''Sets the process-wide defaults of open_output.'''
+    if durability is not None and durability not in DURABILITY:
+        raise ValueError('Unknown durability %r (one of %s)' % (durability, ', '.join(DURABILITY)))
+    for name, value in (('buffer_size', buffer_size), ('durability', durability), ('io_thread', io_thread)):
+        if value is not None:
+            _options[name] = value
+
+
+class IOThread(threading.Thread):
+    '''Writes the blocks of BufferedWriters in the order they were submitted.'''
+
+    def __init__(self, max_pending_bytes=MAX_PENDING_BYTES):
+        threading.Thread.__init__(self, name='output-io')
+        self.daemon = True
+        self.max_pending_bytes = max_pending_bytes
+        self.condition = threading.Condition()
+        self.jobs = deque()
+        self.pending_bytes = 0
+
+    def submit(self, writer, data):
+        with self.condition:
+            # Back pressure: a reader waits instead of queueing unbounded output.
+            while self.pending_bytes and self.pending_bytes + len(data) > self.max_pending_bytes:
+                self.condition.wait()
+            self.jobs.append((writer, data))
+            self.pending_bytes += len(data)
+            writer.pending += 1
+            self.condition.notify_all()
+
+    def wait(self, writer):
+        '''Waits until all blocks of a writer are written.'''
+        with self.condition:
+            while writer.pending:
+                self.condition.wait()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                writer, data = self.jobs.popleft()
+            try:
+                if writer.error is None:
+                    writer.write_block(data)
+            except Exception as err:
+                writer.error = err
+            with self.condition:
+                self.pending_bytes -= len(data)
+                writer.pending -= 1
+                self.condition.notify_all()
+
+
+_io_thread = None
+_io_thread_lock = threading.Lock()
+
+
+def get_io_thread():
+    '''Returns the I/O thread of the process, starting it on first use.'''
+    global _io_thread
+    with _io_thread_lock:
+        if _io_thread is None:
+            _io_thread = IOThread()
+            _io_thread.start()
+        return _io_thread
+
+
+class BufferedWriter:
+    '''A write-only file that writes in large aligned blocks; see the module docstring.'''
+
+    def __init__(self, file_name, buffer_size=None, durability=None, io_thread=None):
+        self.name = file_name
+        self.buffer_size = buffer_size if buffer_size is not None else _options['buffer_size']
+        self.durability = durability if durability is not None else _options['durability']
+        use_io_thread = io_thread if io_thread is not None else _options['io_thread']
+        self.io_thread = get_io_thread() if use_io_thread else None
+        self.fd = os.open(file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+        self.chunks = []
+        self.buffered = 0
+        self.pending = 0
+        self.error = None
+        self.closed = False
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.buffer_size:
+            self.flush_buffer(aligned=True)
+
+    def flush_buffer(self, aligned=False):
+        '''Hands the buffered data (only whole ALIGNMENT blocks if aligned) to be written.'''
+        if not self.buffered:
+            return
+        data = ''.join(self.chunks)
+        size = len(data) - len(data) % ALIGNMENT if aligned else len(data)
+        if size == 0:
+            self.chunks = [data]
+            return
+        self.chunks = [data[size:]] if size < len(data) else []
+        self.buffered = len(data) - size
+        block = data[:size]
+        if self.io_thread is not None:
+            self.io_thread.submit(self, block)
+        else:
+            self.write_block(block)
+
+    def write_block(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+        if self.durability == 'flush':
+            os.fsync(self.fd)
+
+    def flush(self):
+        self.flush_buffer()
+        if self.io_thread is not None:
+            self.io_thread.wait(self)
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+            if self.durability in ('close', 'flush'):
+                os.fsync(self.fd)
+        finally:
+            os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def open_output(file_name):
+    '''Opens an output file for writing with the process-wide options.'''
+    return BufferedWriter(file_name)
+
+
+def add_writer_arguments(parser):
+    '''Adds the output writer options to an ArgumentParser.'''
+    parser.add_argument('--write_buffer_size', type=int, help='Bytes buffered per output file before writing')
+    parser.add_argument('--durability', choices=DURABILITY,
+                        help='When output is forced to disk: never, when a file is closed or after every write')
+    parser.add_argument('--io_thread', action='store_true',
+                        help='Write output files on a dedicated thread instead of the reading threads')
+
+
+def writer_options_from_args(args):
+    '''Applies the output writer options given on the command line to the process.'''
+    configure(buffer_size=args.write_buffer_size, durability=args.durability, io_thread=args.io_thread or None)
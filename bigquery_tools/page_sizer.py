@@ -0,0 +1,87 @@
+#!/usr/bin/python2.7
+
+'''Adaptive page sizes for tabledata.list and jobs.getQueryResults.
+
+A fixed maxResults suits no table: the API cuts pages of wide rows short
+at its response size limit anyway, while pages of narrow rows are far
+smaller than they could be and the read is dominated by the per-request
+overhead. A PageSizer measures the response bytes per row and the seconds
+per row of every page and sets the maxResults of the next request to the
+largest page that stays within target_bytes and target_latency. The page
+grows at most by GROWTH per request, so a sudden change of the row width
+does not produce one huge response, and shrinks by half after a server
+error. Every decision is recorded with Metrics.record_page_size.
+'''
+
+import threading
+
+INITIAL_PAGE_SIZE = 16 * 1024
+MIN_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 256 * 1024
+# Response size (below the API limit of 10 MB) and latency aimed at per page.
+TARGET_BYTES = 8 * 1024 * 1024
+TARGET_LATENCY = 5.0
+# Largest factor a page grows by from one request to the next.
+GROWTH = 2.0
+# Weight of the newest page in the moving averages.
+SMOOTHING = 0.5
+
+
+class PageSizer:
+    '''Chooses the maxResults of the requests of one reader; see the module docstring.'''
+
+    def __init__(self, kind, metrics, initial_size=INITIAL_PAGE_SIZE, min_size=MIN_PAGE_SIZE,
+                 max_size=MAX_PAGE_SIZE, target_bytes=TARGET_BYTES, target_latency=TARGET_LATENCY):
+        self.kind = kind
+        self.metrics = metrics
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_bytes = target_bytes
+        self.target_latency = target_latency
+        self.size = max(min_size, min(max_size, initial_size))
+        self.bytes_per_row = None
+        self.seconds_per_row = None
+        self.lock = threading.Lock()
+
+    def next_size(self):
+        '''Returns the maxResults of the next request.'''
+        return self.size
+
+    def average(self, current, value):
+        return value if current is None else SMOOTHING * value + (1 - SMOOTHING) * current
+
+    def record(self, rows, response_bytes, latency, **labels):
+        '''Adjusts the page size after a page of rows was read.'''
+        if rows <= 0:
+            return self.size
+        with self.lock:
+            self.bytes_per_row = self.average(self.bytes_per_row, float(response_bytes) / rows)
+            # Includes the per-request overhead, so small pages grow while they are faster than the target.
+            self.seconds_per_row = self.average(self.seconds_per_row, float(latency) / rows)
+            by_bytes = self.target_bytes / max(self.bytes_per_row, 1.0)
+            by_latency = self.target_latency / max(self.seconds_per_row, 1e-9)
+            reason = 'bytes' if by_bytes <= by_latency else 'latency'
+            size = min(by_bytes, by_latency)
+            if size > self.size * GROWTH:
+                size, reason = self.size * GROWTH, 'growth'
+            size, reason = self.clamp(int(size), reason)
+            self.size = size
+        self.metrics.record_page_size(self.kind, size, reason, bytes_per_row=self.bytes_per_row,
+                                      seconds_per_row=self.seconds_per_row, **labels)
+        return size
+
+    def backoff(self, **labels):
+        '''Halves the page size after a server error.'''
+        with self.lock:
+            self.size, _ = self.clamp(self.size // 2, 'error')
+            size = self.size
+        self.metrics.record_page_size(self.kind, size, 'error', bytes_per_row=self.bytes_per_row,
+                                      seconds_per_row=self.seconds_per_row, **labels)
+        return size
+
+    def clamp(self, size, reason):
+        if size < self.min_size:
+            return self.min_size, 'min'
+        if size > self.max_size:
+            return self.max_size, 'max'
+        return size, reason
@@ -0,0 +1,138 @@
+#!/usr/bin/python2.7
+
+'''Maps the row offsets of table snapshots to page tokens.
+
+Following pageTokens is cheaper for the service than reading at a
+startIndex, but a token is only known once the page before it was read.
+TableReader records the token returned with every page of a snapshot
+(table@snapshot_time) it reads, keyed by the row offset the token starts
+at, in a PageTokenIndex kept in ~/.cache/bigquery_tools/page_tokens.json
+(or $BIGQUERY_TOOLS_CACHE). A later read of the same snapshot, e.g. the
+pieces of a parallel read, a resumed export or a sample, starts from the
+nearest recorded token instead of a startIndex, dropping the few rows
+before its start offset (at most MAX_SKIP_ROWS), and parallel reads split
+the table at recorded offsets where they can.
+
+Tokens are only recorded for snapshots: the pages of a table that is
+written to change. Snapshots more than MAX_AGE old can no longer be read,
+so their tokens are dropped.
+'''
+
+import bisect
+import json
+import os
+import threading
+import time
+from discovery_cache import DEFAULT_CACHE_DIR
+
+# Snapshot decorators reach back 7 days.
+MAX_AGE = 7 * 24 * 3600
+# Rows a reader may read and drop to start from a token before its start offset.
+MAX_SKIP_ROWS = 10000
+
+
+def get_index_file():
+    return os.path.join(os.environ.get('BIGQUERY_TOOLS_CACHE', DEFAULT_CACHE_DIR), 'page_tokens.json')
+
+
+def snapshot_key(project_id, dataset_id, table_id, selected_fields=None):
+    '''Identifies the pages of a snapshot read; None if table_id has no snapshot decorator.'''
+    if '@' not in table_id:
+        return None
+    key = '%s:%s.%s' % (project_id, dataset_id, table_id)
+    if selected_fields:
+        key = '%s/%s' % (key, ','.join(selected_fields))
+    return key
+
+
+class PageTokenIndex:
+    '''Page tokens of table snapshots by row offset; see the module docstring.'''
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.entries = {}
+        # Sorted offsets of each key, built on demand.
+        self.offsets = {}
+        self.changed = False
+        if os.path.exists(file_name):
+            self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.file_name) as f:
+                entries = json.load(f)
+        except ValueError:
+            # A damaged index only costs the tokens.
+            return {}
+        cutoff = time.time() - MAX_AGE
+        return dict((key, entry) for key, entry in entries.items() if entry['created'] >= cutoff)
+
+    def record(self, key, offset, token):
+        '''Records the token of the page that starts at a row offset.'''
+        with self.lock:
+            entry = self.entries.setdefault(key, {'created': int(time.time()), 'tokens': {}})
+            if entry['tokens'].get(str(offset)) != token:
+                entry['tokens'][str(offset)] = token
+                self.offsets.pop(key, None)
+                self.changed = True
+
+    def get_offsets(self, key):
+        if key not in self.offsets:
+            self.offsets[key] = sorted(int(offset) for offset in self.entries.get(key, {}).get('tokens', {}))
+        return self.offsets[key]
+
+    def find(self, key, offset, max_skip=MAX_SKIP_ROWS):
+        '''Returns (token, rows to skip) to start reading at a row offset, or None.'''
+        with self.lock:
+            offsets = self.get_offsets(key)
+            position = bisect.bisect_right(offsets, offset)
+            if position == 0 or offset - offsets[position - 1] > max_skip:
+                return None
+            token_offset = offsets[position - 1]
+            return self.entries[key]['tokens'][str(token_offset)], offset - token_offset
+
+    def align(self, key, offsets, max_shift):
+        '''Moves split offsets to the nearest recorded offset at most max_shift rows away.'''
+        with self.lock:
+            recorded = self.get_offsets(key)
+        aligned = []
+        for offset in offsets:
+            position = bisect.bisect_left(recorded, offset)
+            candidates = [recorded[index] for index in (position - 1, position) if 0 <= index < len(recorded)]
+            nearest = min(candidates, key=lambda candidate: abs(candidate - offset)) if candidates else None
+            aligned.append(nearest if nearest is not None and abs(nearest - offset) <= max_shift else offset)
+        return aligned
+
+    def save(self):
+        '''Merges the index into the file (other processes may have added tokens) and renames it over the old one.'''
+        with self.lock:
+            if not self.changed:
+                return
+            entries = self.load() if os.path.exists(self.file_name) else {}
+            for key, entry in self.entries.items():
+                merged = entries.setdefault(key, {'created': entry['created'], 'tokens': {}})
+                merged['tokens'].update(entry['tokens'])
+            self.entries = entries
+            self.offsets = {}
+            self.changed = False
+            directory = os.path.dirname(self.file_name)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            temp_file_name = '%s.%d.%s.tmp' % (self.file_name, os.getpid(), threading.current_thread().ident)
+            with open(temp_file_name, 'w') as f:
+                json.dump(entries, f, sort_keys=True)
+            os.rename(temp_file_name, self.file_name)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_page_token_index(file_name=None):
+    '''Returns the PageTokenIndex of a file (by default the user's cache), shared by all readers in the process.'''
+    file_name = os.path.abspath(file_name or get_index_file())
+    with _indexes_lock:
+        if file_name not in _indexes:
+            _indexes[file_name] = PageTokenIndex(file_name)
+        return _indexes[file_name]
@@ -0,0 +1,164 @@
+#!/usr/bin/python2.7
+
+'''Cost estimates and profiles of BigQuery queries.
+
+A dry run (QueryReader.dry_run) validates a query without running it and
+returns a CostEstimate: the bytes the query would scan, the resulting
+on-demand price and whether the result would be served from the query cache.
+
+A QueryProfile is built from the statistics of a finished query job: its
+timings, bytes processed and billed, slot milliseconds, cache hit and the
+query plan with the timing ratios, records and shuffle bytes of every
+stage. Profiles are appended to a JSON lines file, one per run, keyed by
+a fingerprint of the query text so the runs of one query can be compared:
+
+  python query_reader.py ... --profile profiles.jsonl
+  python query_profile.py profiles.jsonl
+'''
+
+import hashlib
+import json
+import re
+import sys
+import time
+from argparse import ArgumentParser
+
+# On-demand price of one TiB scanned, in USD.
+PRICE_PER_TB = 5.0
+TB = 1024 ** 4
+
+
+def query_fingerprint(query):
+    '''Identifies a query independent of whitespace and case.'''
+    if isinstance(query, str):
+        # A str query (e.g. read from a file) holds UTF-8 bytes; it gets the fingerprint of the same unicode query.
+        query = query.decode('utf-8', 'replace')
+    return hashlib.md5(re.sub(r'\s+', ' ', query.strip().lower()).encode('utf-8')).hexdigest()[:12]
+
+
+class CostEstimate:
+    '''The result of a dry run.'''
+
+    def __init__(self, query, total_bytes_processed, cache_hit, price_per_tb=PRICE_PER_TB):
+        self.query = query
+        self.total_bytes_processed = total_bytes_processed
+        self.cache_hit = cache_hit
+        self.estimated_cost = 0.0 if cache_hit else float(total_bytes_processed) / TB * price_per_tb
+
+    @classmethod
+    def from_response(cls, query, response, price_per_tb=PRICE_PER_TB):
+        '''Builds the estimate from a dry run jobs.query response.'''
+        return cls(query, int(response.get('totalBytesProcessed', 0)), bool(response.get('cacheHit')),
+                   price_per_tb=price_per_tb)
+
+    def to_dict(self):
+        return {'fingerprint': query_fingerprint(self.query), 'total_bytes_processed': self.total_bytes_processed,
+                'cache_hit': self.cache_hit, 'estimated_cost': self.estimated_cost}
+
+    def __str__(self):
+        if self.cache_hit:
+            return 'The query would be answered from the cache (0 bytes billed)'
+        return 'The query would process %d bytes (%.2f GiB, about $%.4f)' % (
+            self.total_bytes_processed, self.total_bytes_processed / float(1024 ** 3), self.estimated_cost)
+
+
+def parse_stage(stage):
+    '''Extracts the timing and volume figures of one query plan stage.'''
+    parsed = {'name': stage.get('name'), 'status': stage.get('status')}
+    for key in ('waitRatioAvg', 'waitRatioMax', 'readRatioAvg', 'readRatioMax',
+                'computeRatioAvg', 'computeRatioMax', 'writeRatioAvg', 'writeRatioMax'):
+        if key in stage:
+            parsed[key] = float(stage[key])
+    for key in ('recordsRead', 'recordsWritten', 'shuffleOutputBytes', 'shuffleOutputBytesSpilled',
+                'startMs', 'endMs', 'parallelInputs'):
+        if key in stage:
+            parsed[key] = int(stage[key])
+    if 'startMs' in parsed and 'endMs' in parsed:
+        parsed['elapsedMs'] = parsed['endMs'] - parsed['startMs']
+    return parsed
+
+
+class QueryProfile:
+    '''Statistics of a finished query job.'''
+
+    def __init__(self, job, query=None):
+        statistics = job.get('statistics', {})
+        query_statistics = statistics.get('query', {})
+        self.job_id = job.get('jobReference', {}).get('jobId')
+        self.query = query if query is not None else job.get('configuration', {}).get('query', {}).get('query', '')
+        self.created = int(time.time())
+        times = [int(statistics[key]) if key in statistics else None
+                 for key in ('creationTime', 'startTime', 'endTime')]
+        self.queued_ms = times[1] - times[0] if None not in times[:2] else None
+        self.elapsed_ms = times[2] - times[1] if None not in times[1:] else None
+        self.total_bytes_processed = int(query_statistics.get('totalBytesProcessed', 0))
+        self.total_bytes_billed = int(query_statistics.get('totalBytesBilled', 0))
+        self.total_slot_ms = int(query_statistics.get('totalSlotMs', 0))
+        self.cache_hit = bool(query_statistics.get('cacheHit'))
+        self.stages = [parse_stage(stage) for stage in query_statistics.get('queryPlan', [])]
+
+    def shuffle_bytes(self):
+        return sum(stage.get('shuffleOutputBytes', 0) for stage in self.stages)
+
+    def to_dict(self):
+        return {'fingerprint': query_fingerprint(self.query), 'query': self.query, 'job_id': self.job_id,
+                'created': self.created, 'queued_ms': self.queued_ms, 'elapsed_ms': self.elapsed_ms,
+                'total_bytes_processed': self.total_bytes_processed, 'total_bytes_billed': self.total_bytes_billed,
+                'total_slot_ms': self.total_slot_ms, 'cache_hit': self.cache_hit,
+                'shuffle_bytes': self.shuffle_bytes(), 'stages': self.stages}
+
+    def save(self, file_name):
+        '''Appends the profile to a JSON lines file.'''
+        with open(file_name, 'a') as f:
+            f.write(json.dumps(self.to_dict(), sort_keys=True) + '\n')
+
+    def format(self):
+        lines = ['Job %s: %s ms (queued %s ms), %d bytes processed, %d billed, %d slot ms, %d shuffle bytes%s' % (
+            self.job_id, self.elapsed_ms, self.queued_ms, self.total_bytes_processed, self.total_bytes_billed,
+            self.total_slot_ms, self.shuffle_bytes(), ', cache hit' if self.cache_hit else '')]
+        for stage in self.stages:
+            lines.append('  %-24s wait %.2f read %.2f compute %.2f write %.2f  records %s -> %s  shuffle %s' % (
+                stage['name'], stage.get('waitRatioAvg', 0), stage.get('readRatioAvg', 0),
+                stage.get('computeRatioAvg', 0), stage.get('writeRatioAvg', 0), stage.get('recordsRead', '-'),
+                stage.get('recordsWritten', '-'), stage.get('shuffleOutputBytes', '-')))
+        return '\n'.join(lines)
+
+
+def compare_profiles(profiles):
+    '''Summarizes profiles (dicts) per query, slowest first.
+
+    Returns (fingerprint, runs, median elapsed ms, max elapsed ms, median slot ms, query) tuples.
+    '''
+    by_query = {}
+    for profile in profiles:
+        by_query.setdefault(profile['fingerprint'], []).append(profile)
+
+    def median(values):
+        values = sorted(value for value in values if value is not None)
+        return values[len(values) // 2] if values else None
+
+    summary = []
+    for fingerprint, runs in by_query.items():
+        elapsed = [run['elapsed_ms'] for run in runs]
+        summary.append((fingerprint, len(runs), median(elapsed), max(elapsed),
+                        median(run['total_slot_ms'] for run in runs), runs[-1]['query']))
+    return sorted(summary, key=lambda row: -(row[2] or 0))
+
+
+def main(argv):
+    parser = ArgumentParser(description='Compare the query profiles recorded with query_reader.py --profile')
+    parser.add_argument('profiles', help='JSON lines file with query profiles')
+    parser.add_argument('--top', type=int, default=20, help='Number of queries to show')
+    args = parser.parse_args(argv)
+
+    with open(args.profiles) as f:
+        profiles = [json.loads(line) for line in f if line.strip()]
+    print '%-12s %5s %12s %12s %12s  %s' % ('query', 'runs', 'median ms', 'max ms', 'slot ms', 'text')
+    for fingerprint, runs, median_ms, max_ms, slot_ms, query in compare_profiles(profiles)[:args.top]:
+        line = u'%-12s %5d %12s %12s %12s  %s' % (fingerprint, runs, median_ms, max_ms, slot_ms,
+                                                  re.sub(r'\s+', ' ', query)[:60])
+        print line.encode('utf-8')
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -2,20 +2,77 @@
 
 __author__ = 'Paulius Danenas'
 
+'''Reads the results of BigQuery queries.
+
+QueryReader.read pages through the results of a synchronous query.
+QueryReader.read_large runs the query as an asynchronous job that writes
+its results into a temporary table, reads that table in parallel (by index
+ranges or through a GCS extract) and drops it afterwards; use it for
+results too large for a synchronous query.
+
+QueryReader.dry_run estimates the bytes a query would scan without running
+it, and QueryReader.profile returns the statistics and query plan of the
+last query that was run (see query_profile.py).
+
+Usage from the command line:
+python query_reader.py [options]
+'''
+
+import os
+import sys
 import time
+from argparse import ArgumentParser
 from googleapiclient.errors import HttpError
-from output_handler import ColumnarResultHandler
-from table_reader import TableReadThread
-from progressbar import Counter, ProgressBar, Timer
-
-READ_CHUNK_SIZE = 64 * 1024
+from auth import BigQuery_Auth
+from job_runner import JobRunner
+from output_handler import ColumnarResultHandler, make_result_handler
+from table_manager import TableManager
+from table_reader import TableReader, TableReadThread
+from query_profile import PRICE_PER_TB, CostEstimate, QueryProfile
+from metrics import get_metrics, add_metrics_arguments, metrics_from_args
+from output_writer import add_writer_arguments, writer_options_from_args
+from transport import add_transport_arguments, transport_from_args
+from page_sizer import PageSizer
 
 
 class QueryReader:
-    def __init__(self, auth, project_id):
+    def __init__(self, auth, project_id, metrics=None, verbose=False):
         self.project_id = project_id
+        self.auth = auth
         self.bq_service = auth.build_bq_client()
+        self.transport = auth.transport
         self.columns = None
+        self.thread_id = 'main'
+        self.metrics = metrics if metrics is not None else get_metrics()
+        self.verbose = verbose
+        # Job reference and text of the last query that was run, for profile().
+        self.job_reference = None
+        self.query = None
+
+    def dry_run(self, query, inlineUDF=None, udfURI=None, price_per_tb=PRICE_PER_TB):
+        '''Validates a query without running it and returns a CostEstimate.'''
+        query_data = {
+            'query': query,
+            'dryRun': True,
+            'useQueryCache': True,
+            'userDefinedFunctionResources': self.make_udf_resources(inlineUDF, udfURI)
+        }
+        response = self.metrics.execute(self.bq_service.jobs().query(projectId=self.project_id, body=query_data,
+                                                                     fields=self.transport.fields('jobs.query.dry_run')),
+                                        'jobs.query.dry_run', thread=self.thread_id)
+        return CostEstimate.from_response(query, response, price_per_tb=price_per_tb)
+
+    def profile(self, job_reference=None):
+        '''Returns the QueryProfile of a finished query job (by default the last one run).'''
+        job_reference = job_reference if job_reference is not None else self.job_reference
+        if job_reference is None:
+            raise ValueError('No query has been run')
+        job_runner = JobRunner(self.auth, job_reference['projectId'], job_id=job_reference['jobId'],
+                               metrics=self.metrics, verbose=self.verbose)
+        job = job_runner.get_job('jobs.get.profile')
+        if job is None:
+            raise Exception('Unable to get the statistics of job %s' % (job_reference['jobId'],))
+        return QueryProfile(job, query=self.query if job_reference == self.job_reference else None)
 
     def read(self, result_handler, query, timeout=10000, num_retries=5, inlineUDF=None, udfURI=None):
         """
@@ -32,12 +89,7 @@ class QueryReader:
         """
         try:
             query_request = self.bq_service.jobs()
-            udfResource = []
-            if inlineUDF:
-                udfResource.append({'inlineCode': inlineUDF})
-            else:
-                if udfURI:
-                    udfResource.append({'resourceUri': udfURI})
+            udfResource = self.make_udf_resources(inlineUDF, udfURI)
 
             query_data = {
                 'query': query,
@@ -45,20 +97,34 @@ class QueryReader:
                 'allowLargeResults': True,
                 'userDefinedFunctionResources': udfResource
             }
-            query_job = query_request.query(projectId=self.project_id, body=query_data).execute()
+            query_job = self.metrics.execute(query_request.query(projectId=self.project_id, body=query_data,
+                                                                 fields=self.transport.fields('jobs.query')),
+                                             'jobs.query', thread=self.thread_id)
+            self.job_reference = query_job['jobReference']
+            self.query = query
             self.columns = [field['name'] for field in query_job['schema']['fields']]
             if isinstance(result_handler, ColumnarResultHandler):
-                result_handler.set_columns(self.columns)
+                result_handler.set_columns(self.columns, dict((field['name'], field['type'])
+                                                              for field in query_job['schema']['fields']))
             page_token = None
+            page_sizer = PageSizer('jobs.getQueryResults', self.metrics)
+            from progressbar import Counter, ProgressBar, Timer
             widgets = ['Retrieved rows: ', Counter(), ' (', Timer(), ')']
             pbar = ProgressBar(widgets=widgets)
             pbar.start()
             pbar.maxval = 0
             i = 0
             while True:
-                page = query_request.getQueryResults(pageToken=page_token,
-                                                     **query_job['jobReference']).execute(num_retries=num_retries)
+                measurement = {}
+                page = self.metrics.execute(query_request.getQueryResults(
+                                                pageToken=page_token,
+                                                maxResults=page_sizer.next_size(),
+                                                fields=self.transport.fields('jobs.getQueryResults'),
+                                                **query_job['jobReference']),
+                                            'jobs.getQueryResults', num_retries=num_retries,
+                                            measurement=measurement, thread=self.thread_id)
                 rows = page.get('rows', [])
+                page_sizer.record(len(rows), measurement['bytes'], measurement['latency'], thread=self.thread_id)
                 if rows:
                     i += len(rows)
                     pbar.maxval = i
@@ -72,11 +138,79 @@ class QueryReader:
         except HttpError as err:
             # If the error is a rate limit or connection error, wait and try again.
             if err.resp.status in [403, 500, 503]:
-                print '%s: Retryable error %s, waiting' % (self.thread_id, err.resp.status,)
+                self.metrics.record_retry('jobs.query', err.resp.status, thread=self.thread_id)
+                if self.verbose:
+                    print '%s: Retryable error %s, waiting' % (self.thread_id, err.resp.status,)
                 time.sleep(5)
             else:
                 raise
 
+    def drop_result_table(self, dataset_id, table_id):
+        table_manager = TableManager(self.auth)
+        if table_manager.table_exists(self.project_id, dataset_id, table_id):
+            table_manager.drop_table(dataset_id, table_id, project_id=self.project_id)
+            print 'Dropped temporary table %s.%s' % (dataset_id, table_id)
+
+    def make_udf_resources(self, inlineUDF=None, udfURI=None):
+        if inlineUDF:
+            return [{'inlineCode': inlineUDF}]
+        if udfURI:
+            return [{'resourceUri': udfURI}]
+        return []
+
+    def read_large(self, query, dataset_id, output_dir, result_name='query_result', output_format='csv',
+                   sep=';', strategy='parallel-indexed', partition_count=10, gcs_bucket=None,
+                   inlineUDF=None, udfURI=None):
+        '''Runs a query as a job writing into a temporary table, reads the table in parallel and drops it.
+
+        If the read fails, the table is kept (and named in the error) since the output is incomplete.
+
+        :param dataset_id: Dataset of the temporary result table
+        :param result_name: Prefix of the temporary table, and so of the output file names
+        :param strategy: 'parallel-indexed', 'extract' (requires gcs_bucket) or 'auto'
+        '''
+        table_id = '%s_%d' % (result_name, int(time.time() * 1000))
+        job_config = {'query': {
+            'query': query,
+            'destinationTable': {'projectId': self.project_id, 'datasetId': dataset_id, 'tableId': table_id},
+            'allowLargeResults': True,
+            'createDisposition': 'CREATE_IF_NEEDED',
+            'writeDisposition': 'WRITE_TRUNCATE',
+            'userDefinedFunctionResources': self.make_udf_resources(inlineUDF, udfURI)}}
+        job_runner = JobRunner(self.auth, self.project_id, job_id='query_%s' % (table_id,),
+                               metrics=self.metrics, verbose=self.verbose)
+        if not job_runner.start_job(job_config):
+            raise Exception('Unable to start the query job for %s' % (table_id,))
+        self.job_reference = job_runner.get_job_ref()
+        self.query = query
+        try:
+            if not job_runner.wait_for_complete():
+                raise Exception('Query job %s failed' % (job_runner.job_id,))
+        except Exception:
+            # The table is created by the job, also if the job fails part way.
+            self.drop_result_table(dataset_id, table_id)
+            raise
+        try:
+            table_reader = TableReader(self.auth, self.project_id, dataset_id, table_id,
+                                       metrics=self.metrics, verbose=self.verbose)
+            if strategy == 'auto':
+                table_reader.auto_read(output_dir, output_format=output_format, sep=sep, gcs_bucket=gcs_bucket,
+                                       max_workers=partition_count)
+            elif strategy == 'extract':
+                if not (os.path.exists(output_dir) and os.path.isdir(output_dir)):
+                    os.makedirs(output_dir)
+                _, _, columns, _ = table_reader.get_table_info()
+                table_reader.extract_read(output_dir, gcs_bucket, partition_count, columns,
+                                          output_format=output_format, sep=sep)
+            else:
+                table_reader.parallel_indexed_read(partition_count, output_dir, output_format=output_format, sep=sep)
+        except Exception as err:
+            # The output is incomplete; the result table is the only complete copy, so it is kept.
+            raise Exception('Reading the query result failed (%s); the result is kept in table %s.%s' % (
+                err, dataset_id, table_id)), None, sys.exc_info()[2]
+        self.drop_result_table(dataset_id, table_id)
+        return table_id
+
 
 class QueryReadThread(TableReadThread):
     def __init__(self, query_reader, output_file_name, query,
@@ -84,6 +218,7 @@ class QueryReadThread(TableReadThread):
         TableReadThread.__init__(self, None, output_file_name, thread_id, output_format, sep)
         self.query_reader = query_reader
         self.query = query
+        query_reader.thread_id = thread_id
 
     def get_columns(self):
         return None
@@ -91,3 +226,66 @@ class QueryReadThread(TableReadThread):
     def run(self):
         print 'Reading %s' % (self.thread_id,)
         self.query_reader.read(self.get_result_handler(), self.query)
+
+
+def main(argv):
+    parser = ArgumentParser(description='Read the results of a BigQuery query into text files')
+    parser.add_argument('-a', '--service_account', required=True, help='Big Query service account name')
+    parser.add_argument('-s', '--client_secret', required=True,
+                        help='Path to client_secrets.json file required for API login')
+    parser.add_argument('-c', '--credentials',
+                        help='Path to credentials file (e.g. bigquery_credentials.dat) required for API login. '
+                             'If the file is not present, the browser window will be shown and you will be asked to authenticate')
+    parser.add_argument('-k', '--keyfile', help='Path to the key file (e.g., key.p12)')
+    parser.add_argument('-p', '--project_id', required=True, help='BigQuery project ID')
+    parser.add_argument('-q', '--query', required=True, help='The query to run')
+    parser.add_argument('-o', '--output_directory', default='.', help='The directory where the output will be exported')
+    parser.add_argument('-n', '--result_name', default='query_result', help='Name of the output files')
+    parser.add_argument('-f', '--format', default='csv', choices=['json', 'csv', 'sqlite'], help='The output format')
+    parser.add_argument('--separator', help='Separator in CSV', default=';')
+    parser.add_argument('--large', action='store_true',
+                        help='Run the query as a job into a temporary table and read that table in parallel')
+    parser.add_argument('-d', '--temp_dataset', help='Dataset of the temporary result table (with --large)')
+    parser.add_argument('--strategy', default='parallel-indexed', choices=['parallel-indexed', 'extract', 'auto'],
+                        help='How the temporary result table is read')
+    parser.add_argument('--partition_count', type=int, default=10, help='Number of parallel readers')
+    parser.add_argument('-b', '--gcs_bucket', help='GCS bucket for the extract strategy')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='Only print the bytes the query would process and whether it would hit the cache')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Print the statistics and query plan of the query and append them to FILE')
+    add_writer_arguments(parser)
+    add_metrics_arguments(parser)
+    add_transport_arguments(parser)
+    args = parser.parse_args()
+    if args.large and not args.temp_dataset:
+        parser.error('--large requires --temp_dataset')
+    if args.strategy == 'extract' and not args.gcs_bucket:
+        parser.error('--strategy extract requires --gcs_bucket')
+    metrics = metrics_from_args(args)
+    writer_options_from_args(args)
+    transport = transport_from_args(args)
+
+    auth = BigQuery_Auth(service_acc=args.service_account, client_secrets=args.client_secret,
+                         credentials=args.credentials, key_file=args.keyfile, transport=transport)
+    query_reader = QueryReader(auth, args.project_id, metrics=metrics, verbose=args.verbose)
+    if args.dry_run:
+        print query_reader.dry_run(args.query)
+    elif args.large:
+        query_reader.read_large(args.query, args.temp_dataset, args.output_directory, result_name=args.result_name,
+                                output_format=args.format, sep=args.separator, strategy=args.strategy,
+                                partition_count=args.partition_count, gcs_bucket=args.gcs_bucket)
+    else:
+        output_file_name = os.path.join(args.output_directory, '%s.%s' % (args.result_name, args.format))
+        query_reader.read(make_result_handler(output_file_name, args.format, sep=args.separator), args.query)
+    if args.profile and not args.dry_run:
+        profile = query_reader.profile()
+        print profile.format()
+        profile.save(args.profile)
+    metrics.close()
+    if args.transport_report:
+        print transport.format_report()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,221 @@
+#!/usr/bin/python2.7
+
+'''Chooses how to read a table.
+
+A table can be streamed with tabledata.list on one thread, read in parallel
+by index ranges (or by partition for date-partitioned tables) or extracted
+to GCS and downloaded. Which is fastest depends on the size of the table:
+every tabledata.list page costs a round trip and the API serves a limited
+number of bytes per second and stream, while an extract job has a large
+fixed overhead but then moves data much faster. The extract is not an
+exact substitute: its TIMESTAMP, RECORD and REPEATED values are formatted
+differently from tabledata.list (see gcs_reader.format_field).
+
+The CostModel estimates the wall-clock time of each strategy from numRows
+and numBytes; plan_read picks the cheapest one together with its worker
+count. The model constants can be calibrated from benchmark results
+(benchmarks/run_benchmarks.py -o results.jsonl):
+
+  python read_planner.py --calibrate results.jsonl -o cost_model.json
+  python table_reader.py ... --type auto --cost_model cost_model.json
+'''
+
+import json
+import math
+import sys
+from argparse import ArgumentParser
+
+STRATEGIES = ['single-thread', 'parallel-indexed', 'partition-discovery', 'extract']
+
+DEFAULT_CONSTANTS = {
+    # Fixed cost of one tabledata.list round trip, in seconds.
+    'page_latency': 0.25,
+    # Response bytes per second of one tabledata.list stream.
+    'list_bytes_per_second': 4 * 1024 * 1024,
+    # Ratio of tabledata.list response bytes to the table's numBytes.
+    'list_bytes_ratio': 2.5,
+    # Rows per tabledata.list page.
+    'rows_per_page': 64 * 1024,
+    # Bytes per tabledata.list page the API returns at most.
+    'max_page_bytes': 10 * 1024 * 1024,
+    # Concurrent tabledata.list streams that still scale.
+    'max_list_streams': 16,
+    # Fixed cost of an extract job (start, polling, listing shards), in seconds.
+    'extract_overhead': 30.0,
+    # Bytes per second written by an extract job.
+    'extract_bytes_per_second': 200 * 1024 * 1024,
+    # Bytes per second of one GCS download stream.
+    'gcs_bytes_per_second': 40 * 1024 * 1024,
+    # Concurrent GCS download streams that still scale.
+    'max_gcs_streams': 16,
+}
+
+
+class ReadPlan:
+    '''The chosen strategy, its worker count and the estimates of all strategies.'''
+
+    def __init__(self, strategy, workers, estimated_seconds, estimates):
+        self.strategy = strategy
+        self.workers = workers
+        self.estimated_seconds = estimated_seconds
+        self.estimates = estimates
+
+    def __str__(self):
+        return '%s with %d workers (estimated %.1fs; %s)' % (
+            self.strategy, self.workers, self.estimated_seconds,
+            ', '.join('%s %.1fs' % (strategy, seconds) for strategy, (_, seconds) in sorted(self.estimates.items())))
+
+
+class CostModel:
+    '''Estimates the wall-clock time of the read strategies.'''
+
+    def __init__(self, constants=None):
+        self.constants = dict(DEFAULT_CONSTANTS)
+        self.constants.update(constants or {})
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['constants'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name) as f:
+            return cls(json.load(f))
+
+    def save(self, file_name):
+        with open(file_name, 'w') as f:
+            json.dump(self.constants, f, indent=2, sort_keys=True)
+
+    def pages(self, num_rows, num_bytes):
+        '''Number of tabledata.list pages needed to read a table.'''
+        list_bytes = num_bytes * self.list_bytes_ratio
+        return max(1, int(math.ceil(max(float(num_rows) / self.rows_per_page,
+                                         list_bytes / self.max_page_bytes))))
+
+    def list_seconds(self, num_rows, num_bytes, workers=1):
+        '''Time to read a table with tabledata.list on a number of streams.'''
+        pages = self.pages(num_rows, num_bytes)
+        workers = max(1, min(workers, pages))
+        # Streams beyond max_list_streams only add round trips in parallel, not throughput.
+        streams = min(workers, self.max_list_streams)
+        transfer = num_bytes * self.list_bytes_ratio / (self.list_bytes_per_second * streams)
+        return math.ceil(float(pages) / workers) * self.page_latency + transfer
+
+    def extract_seconds(self, num_bytes, workers=1):
+        '''Time to extract a table to GCS and download it on a number of streams.'''
+        streams = max(1, min(workers, self.max_gcs_streams))
+        return (self.extract_overhead + float(num_bytes) / self.extract_bytes_per_second +
+                float(num_bytes) / (self.gcs_bytes_per_second * streams))
+
+    def calibrate(self, results):
+        '''Fits the constants to benchmark results (dicts from run_benchmarks.py).
+
+        Single-thread table reads give the per page latency and the stream
+        throughput (a least squares fit of wall time against requests and
+        bytes; with a single run only the throughput is fitted), parallel
+        reads give how many streams still scale and downloads the GCS
+        throughput. Returns the names of the constants that were changed.
+        '''
+        results = [result for result in results if not result.get('error') and result.get('wall_seconds')]
+        changed = []
+        reads = [result for result in results if result['case'].startswith('table_read_')]
+        if reads:
+            requests = [float(result['total_requests']) for result in reads]
+            sizes = [float(result['response_bytes']) for result in reads]
+            seconds = [result['wall_seconds'] for result in reads]
+            # Least squares for seconds = latency * requests + bytes / rate.
+            srr = sum(r * r for r in requests)
+            sbb = sum(b * b for b in sizes)
+            srb = sum(r * b for r, b in zip(requests, sizes))
+            srt = sum(r * t for r, t in zip(requests, seconds))
+            sbt = sum(b * t for b, t in zip(sizes, seconds))
+            determinant = srr * sbb - srb * srb
+            if len(reads) > 1 and determinant > 1e-9 * srr * sbb:
+                latency = (srt * sbb - sbt * srb) / determinant
+                per_byte = (srr * sbt - srb * srt) / determinant
+            else:
+                latency = self.page_latency
+                per_byte = (sum(seconds) - latency * sum(requests)) / sum(sizes)
+            if latency >= 0 and per_byte > 0:
+                self.constants['page_latency'] = latency
+                self.constants['list_bytes_per_second'] = 1.0 / per_byte
+                changed.extend(['page_latency', 'list_bytes_per_second'])
+            pages = [result for result in reads if result.get('requests', {}).get('tabledata.list')]
+            if pages:
+                self.constants['rows_per_page'] = (sum(result['rows'] for result in pages) /
+                                                   max(1, sum(result['requests']['tabledata.list']
+                                                              for result in pages)))
+                changed.append('rows_per_page')
+            # The fastest single stream read of each table size.
+            single = {}
+            for result in sorted(reads, key=lambda result: -result['wall_seconds']):
+                if result.get('params'):
+                    single[result['params'].get('rows')] = result
+            for result in results:
+                if result['case'] != 'parallel_indexed_read' or not result.get('params'):
+                    continue
+                baseline = single.get(result['params'].get('rows'))
+                if baseline is not None:
+                    # The speedup over a single stream is the number of streams that scaled.
+                    speedup = baseline['wall_seconds'] / result['wall_seconds']
+                    self.constants['max_list_streams'] = max(1, int(round(speedup)))
+                    changed.append('max_list_streams')
+        downloads = [result for result in results if result['case'] == 'gcs_download']
+        if downloads:
+            self.constants['gcs_bytes_per_second'] = (sum(result['response_bytes'] for result in downloads) /
+                                                      sum(result['wall_seconds'] for result in downloads))
+            changed.append('gcs_bytes_per_second')
+        return changed
+
+
+def plan_read(num_rows, num_bytes, partitioned=False, can_extract=False, max_workers=16, cost_model=None):
+    '''Chooses the fastest strategy to read a table and its number of workers.
+
+    partitioned: the table is date-partitioned, so it is read by partition
+    instead of by index range. can_extract: a GCS bucket is available.
+    '''
+    model = cost_model if cost_model is not None else CostModel()
+    estimates = {'single-thread': (1, model.list_seconds(num_rows, num_bytes))}
+    # More workers than pages, or than streams that scale, do not help.
+    workers = max(1, min(max_workers, model.pages(num_rows, num_bytes), model.max_list_streams))
+    if workers > 1:
+        parallel = 'partition-discovery' if partitioned else 'parallel-indexed'
+        estimates[parallel] = (workers, model.list_seconds(num_rows, num_bytes, workers))
+    if can_extract:
+        extract_workers = max(1, min(max_workers, model.max_gcs_streams))
+        estimates['extract'] = (extract_workers, model.extract_seconds(num_bytes, extract_workers))
+    # Ties go to the simpler strategy, in the order of STRATEGIES.
+    strategy = min(estimates, key=lambda name: (estimates[name][1], STRATEGIES.index(name)))
+    workers, seconds = estimates[strategy]
+    return ReadPlan(strategy, workers, seconds, estimates)
+
+
+def main(argv):
+    parser = ArgumentParser(description='Calibrate the read cost model or show the plan for a table size')
+    parser.add_argument('--calibrate', help='Benchmark results (JSON lines) to fit the cost model to')
+    parser.add_argument('--cost_model', help='Cost model file to start from')
+    parser.add_argument('-o', '--output', help='Write the calibrated cost model to this file')
+    parser.add_argument('--rows', type=int, help='Show the plan for a table with this many rows')
+    parser.add_argument('--bytes', type=int, help='... and this many bytes')
+    parser.add_argument('--partitioned', action='store_true', help='... that is date-partitioned')
+    parser.add_argument('--gcs', action='store_true', help='... and may be extracted to GCS')
+    parser.add_argument('--max_workers', type=int, default=16, help='Maximum number of workers')
+    args = parser.parse_args(argv)
+
+    model = CostModel.load(args.cost_model) if args.cost_model else CostModel()
+    if args.calibrate:
+        with open(args.calibrate) as f:
+            results = [json.loads(line) for line in f if line.strip()]
+        changed = model.calibrate(results)
+        print 'Calibrated %s from %d results' % (', '.join(changed) or 'nothing', len(results))
+        if args.output:
+            model.save(args.output)
+    if args.rows is not None:
+        print plan_read(args.rows, args.bytes or 0, partitioned=args.partitioned, can_extract=args.gcs,
+                        max_workers=args.max_workers, cost_model=model)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
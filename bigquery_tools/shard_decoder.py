@@ -0,0 +1,290 @@
+#!/usr/bin/python2.7
+
+'''Decodes extract job shards into a local output format.
+
+BigQuery extract jobs write NEWLINE_DELIMITED_JSON, CSV or AVRO shards,
+optionally GZIP compressed (Avro shards use DEFLATE or SNAPPY block
+compression instead). A ShardDecoder converts each shard into CSV,
+newline-delimited JSON or Parquet as soon as it has been downloaded: the
+downloading threads submit file names into a bounded queue and a few decoder
+threads convert them, so downloads and conversion overlap and a slow
+decoder applies back-pressure to the downloads.
+
+Reading Avro requires fastavro and writing Parquet requires pyarrow.
+'''
+
+import csv
+import gzip
+import json
+import os
+import Queue
+import sys
+import threading
+from collections import OrderedDict
+from metrics import get_metrics
+from output_writer import open_output
+
+HAS_FASTAVRO = False
+try:
+    import fastavro
+    HAS_FASTAVRO = True
+except ImportError:
+    pass
+
+# pyarrow is slow to import, so it is imported by the first ParquetShardWriter.
+pyarrow = None
+
+
+def import_pyarrow():
+    global pyarrow
+    if pyarrow is None:
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise Exception("Unable to write Parquet files. Try installing pyarrow")
+
+# Extract destination formats and the file suffix of their shards.
+FORMAT_SUFFIXES = {'NEWLINE_DELIMITED_JSON': 'json', 'CSV': 'csv', 'AVRO': 'avro'}
+OUTPUT_SUFFIXES = {'csv': 'csv', 'json': 'json', 'parquet': 'parquet'}
+# Number of records written to the output per batch.
+BATCH_SIZE = 10000
+# Parquet types of BigQuery column types; other types are written as strings.
+PARQUET_TYPES = {'INTEGER': 'int64', 'FLOAT': 'float64', 'BOOLEAN': 'bool_'}
+
+
+def shard_suffix(destination_format, compression=None):
+    '''Returns the file suffix of extract shards, e.g. "csv.gz".'''
+    suffix = FORMAT_SUFFIXES[destination_format]
+    if compression == 'GZIP':
+        suffix += '.gz'
+    return suffix
+
+
+def open_shard(file_name):
+    if file_name.endswith('.gz'):
+        return gzip.open(file_name, 'rb')
+    return open(file_name, 'rb')
+
+
+def read_records(file_name, source_format, sep=','):
+    '''Yields the records of a shard as ordered dicts of column -> value.'''
+    if source_format == 'AVRO':
+        if not HAS_FASTAVRO:
+            raise Exception("Unable to read Avro shards. Try installing fastavro")
+        with open(file_name, 'rb') as f:
+            for record in fastavro.reader(f):
+                yield record
+    elif source_format == 'CSV':
+        with open_shard(file_name) as f:
+            reader = csv.reader(f, delimiter=sep)
+            header = next(reader, None)
+            for values in reader:
+                yield OrderedDict(zip(header, [value if value != '' else None for value in values]))
+    else:
+        with open_shard(file_name) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line, object_pairs_hook=OrderedDict)
+
+
+def format_value(value):
+    '''Formats a decoded value for a CSV cell.'''
+    if value is None:
+        return None
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def parquet_value(value, column_type):
+    '''Converts a decoded value to the Parquet type of its BigQuery column type.'''
+    if value is None:
+        return None
+    if column_type == 'INTEGER':
+        return int(value)
+    if column_type == 'FLOAT':
+        return float(value)
+    if column_type == 'BOOLEAN':
+        return value if isinstance(value, bool) else value.lower() == 'true'
+    if isinstance(value, unicode):
+        return value
+    return format_value(value).decode('utf-8')
+
+
+class CSVShardWriter:
+
+    def __init__(self, file_name, columns, sep=';', column_types=None):
+        self.output_file = open_output(file_name)
+        self.writer = csv.writer(self.output_file, delimiter=sep, quoting=csv.QUOTE_MINIMAL)
+        self.columns = columns
+        self.writer.writerow(columns)
+
+    def write(self, records):
+        self.writer.writerows([[format_value(record.get(column)) for column in self.columns]
+                               for record in records])
+
+    def close(self):
+        self.output_file.close()
+
+
+class JSONShardWriter:
+    '''Writes newline-delimited JSON.'''
+
+    def __init__(self, file_name, columns, sep=None, column_types=None):
+        self.output_file = open_output(file_name)
+
+    def write(self, records):
+        self.output_file.write(''.join(json.dumps(record, default=str) + '\n' for record in records))
+
+    def close(self):
+        self.output_file.close()
+
+
+class ParquetShardWriter:
+    '''Writes Parquet with a fixed schema built from the BigQuery column types.'''
+
+    def __init__(self, file_name, columns, sep=None, column_types=None):
+        import_pyarrow()
+        self.file_name = file_name
+        self.columns = columns
+        # Columns without a known type are written as strings.
+        self.column_types = [(column_types or {}).get(column, 'STRING') for column in columns]
+        self.schema = pyarrow.schema([pyarrow.field(column, getattr(pyarrow, PARQUET_TYPES.get(column_type, 'string'))())
+                                      for column, column_type in zip(columns, self.column_types)])
+        self.writer = pyarrow.parquet.ParquetWriter(file_name, self.schema)
+
+    def write(self, records):
+        arrays = [pyarrow.array([parquet_value(record.get(column), column_type) for record in records],
+                                type=field.type)
+                  for column, column_type, field in zip(self.columns, self.column_types, self.schema)]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+SHARD_WRITERS = {'csv': CSVShardWriter, 'json': JSONShardWriter, 'parquet': ParquetShardWriter}
+
+
+def convert_shard(file_name, output_file_name, source_format, output_format, columns=None,
+                  source_sep=',', sep=';', column_types=None):
+    '''Converts one shard and returns the number of records written.
+
+    An empty shard is written with just the header when the columns are
+    known; otherwise no output file is written and None is returned.
+    '''
+    writer = None
+    batch = []
+    count = 0
+    if columns:
+        writer = SHARD_WRITERS[output_format](output_file_name, columns, sep, column_types)
+    try:
+        for record in read_records(file_name, source_format, sep=source_sep):
+            if writer is None:
+                writer = SHARD_WRITERS[output_format](output_file_name, columns or list(record.keys()), sep,
+                                                      column_types)
+            batch.append(record)
+            if len(batch) >= BATCH_SIZE:
+                writer.write(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            writer.write(batch)
+            count += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    return count if writer is not None else None
+
+
+class ShardDecoder:
+    '''Converts downloaded shards on a pool of threads fed by a bounded queue.'''
+
+    def __init__(self, source_format, output_format, columns=None, num_threads=2, queue_size=4,
+                 keep_shards=False, source_sep=',', sep=';', metrics=None, column_types=None):
+        self.source_format = source_format
+        self.output_format = output_format
+        self.columns = columns
+        self.column_types = column_types
+        self.keep_shards = keep_shards
+        self.source_sep = source_sep
+        self.sep = sep
+        self.metrics = metrics if metrics is not None else get_metrics()
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.outputs = {}
+        self.errors = []
+        self.threads = []
+        for index in range(num_threads):
+            thread = threading.Thread(target=self.work, name='shard-decoder-%d' % (index,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def make_output_file_name(self, file_name):
+        base_name = file_name[:-3] if file_name.endswith('.gz') else file_name
+        base_name = os.path.splitext(base_name)[0]
+        return '%s.%s' % (base_name, OUTPUT_SUFFIXES[self.output_format])
+
+    def get_output_file_names(self, file_names):
+        '''Returns the output files of converted shards; empty shards without known columns have none.'''
+        with self.lock:
+            return [output_file_name for output_file_name in map(self.make_output_file_name, file_names)
+                    if output_file_name in self.outputs]
+
+    def submit(self, file_name):
+        '''Queues a downloaded shard; blocks while the decoders are behind.'''
+        self.queue.put(file_name)
+        self.metrics.add_gauge('decoder_queue_depth', 1)
+
+    def work(self):
+        while True:
+            file_name = self.queue.get()
+            if file_name is None:
+                self.queue.task_done()
+                return
+            self.metrics.add_gauge('decoder_queue_depth', -1)
+            try:
+                output_file_name = self.make_output_file_name(file_name)
+                if output_file_name == file_name:
+                    # The shard is already in the output format.
+                    with self.lock:
+                        self.outputs[file_name] = None
+                    continue
+                count = convert_shard(file_name, output_file_name, self.source_format, self.output_format,
+                                      columns=self.columns, source_sep=self.source_sep, sep=self.sep,
+                                      column_types=self.column_types)
+                if count is not None:
+                    with self.lock:
+                        self.outputs[output_file_name] = count
+                if not self.keep_shards:
+                    os.remove(file_name)
+                print 'Decoded %d records from %s' % (count or 0, file_name)
+            except Exception:
+                with self.lock:
+                    self.errors.append(sys.exc_info())
+            finally:
+                self.queue.task_done()
+
+    def raise_errors(self):
+        with self.lock:
+            errors, self.errors = self.errors, []
+        if errors:
+            error_type, error, traceback = errors[0]
+            raise error_type, error, traceback
+
+    def wait(self):
+        '''Waits until the shards submitted so far are converted and re-raises the first error.'''
+        self.queue.join()
+        self.raise_errors()
+
+    def close(self):
+        '''Waits until all submitted shards are converted and re-raises the first error.'''
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.raise_errors()
+        return dict(self.outputs)
@@ -1,5 +1,5 @@
 import json
-from apiclient.errors import HttpError
+from googleapiclient.errors import HttpError
 
 class GenericGBQException(Exception):
     """
@@ -11,6 +11,7 @@ class TableManager:
 
     def __init__(self, auth):
         self.service = auth.build_bq_client()
+        self.transport = auth.transport
 
     def create_table(self, dataset_id, table_name, schema, project_id=None):
         dataset_ref = {'datasetId': dataset_id,
@@ -37,7 +38,8 @@ class TableManager:
         try:
             self.service.datasets().get(
                 projectId=project_id,
-                datasetId=dataset_id).execute()
+                datasetId=dataset_id,
+                fields=self.transport.fields('datasets.exists')).execute()
             return True
         except HttpError as ex:
             if ex.resp.status == 404:
@@ -52,7 +54,8 @@ class TableManager:
             self.service.tables().get(
                 projectId=project_id,
                 datasetId=dataset_id,
-                tableId=table_id).execute()
+                tableId=table_id,
+                fields=self.transport.fields('tables.exists')).execute()
             return True
         except HttpError as ex:
             if ex.resp.status == 404:
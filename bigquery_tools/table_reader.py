@@ -4,17 +4,24 @@
 
 __author__ = 'Paulius Danenas'
 
-from apiclient.errors import HttpError
+from googleapiclient.errors import HttpError
 from auth import BigQuery_Auth
 from argparse import ArgumentParser
 from datetime import datetime
-from progressbar import Percentage, Bar, ProgressBar, Timer
 import logging
 import os
 import sys
 import threading
 import time
-from output_handler import FileResultHandler, CSVResultHandler, JSONResultHandler
+from output_handler import make_result_handler, add_rotation_arguments, create_sqlite_indexes, sqlite_database_name
+from metrics import get_metrics, add_metrics_arguments, metrics_from_args
+from output_writer import add_writer_arguments, writer_options_from_args
+from transport import add_transport_arguments, transport_from_args
+from worker_pool import WorkerPool
+from read_planner import CostModel, plan_read
+from page_sizer import PageSizer
+from json_codec import make_raw
+from page_token_index import get_page_token_index, snapshot_key
 
 READ_CHUNK_SIZE = 64 * 1024
 
@@ -22,32 +29,89 @@ class TableReader:
     '''Reads data from a BigQuery table.'''
 
     def __init__(self, auth, project_id, dataset_id, table_id,
-                 start_index=None, read_count=None, next_page_token=None):
+                 start_index=None, read_count=None, next_page_token=None,
+                 metrics=None, verbose=False, selected_fields=None, row_filter=None, page_size=None,
+                 page_tokens=True):
         self.project_id = project_id
         self.dataset_id = dataset_id
         self.bq_service = auth.build_bq_client()
         self.next_page_token = next_page_token
         self.next_index = start_index
         self.rows_left = read_count
+        self.rows_read = 0
         self.table_id = table_id
         self.auth = auth
+        self.transport = auth.transport
+        self.thread_id = 'main'
+        self.metrics = metrics if metrics is not None else get_metrics()
+        self.verbose = verbose
+        self.selected_fields = list(selected_fields) if selected_fields else None
+        self.row_filter = row_filter
+        # A fixed maxResults, or None to adapt it to the row width and latency.
+        self.page_size = page_size
+        self.page_sizer = PageSizer('tabledata.list', self.metrics)
+        # Page tokens of snapshots are recorded and reused (see page_token_index.py).
+        self.page_token_index = get_page_token_index() if page_tokens else None
+        # Row offset of the next page in the table, if known, and rows to drop from it.
+        self.offset = start_index if start_index is not None else (0 if next_page_token is None else None)
+        self.skip_rows = 0
+        # Set by get_table_info.
+        self.num_bytes = None
+        self.time_partitioning = None
+
+    def is_selected(self, column):
+        '''Checks whether a top-level column is returned by the current field selection.'''
+        if self.selected_fields is None:
+            return True
+        return any(field.split('.')[0] == column for field in self.selected_fields)
 
     def get_table_info(self):
         '''Returns core information for the table.'''
-        table = self.bq_service.tables().get(projectId=self.project_id,
-                                             datasetId=self.dataset_id,
-                                             tableId=self.table_id).execute()
+        table = self.metrics.execute(self.bq_service.tables().get(projectId=self.project_id,
+                                                                  datasetId=self.dataset_id,
+                                                                  tableId=self.table_id,
+                                                                  fields=self.transport.fields('tables.get')),
+                                     'tables.get', thread=self.thread_id)
         last_modified = int(table.get('lastModifiedTime', 0))
         last_modified = datetime.fromtimestamp(int(last_modified / 1000))
         row_count = int(table.get('numRows', 0))
-        columns = [field['name'] for field in table['schema']['fields']]
-        column_types = {field['name']: field['type'] for field in table['schema']['fields']}
+        self.num_bytes = int(table.get('numBytes', 0))
+        self.time_partitioning = table.get('timePartitioning')
+        # tabledata.list returns the selected fields in schema order.
+        fields = [field for field in table['schema']['fields'] if self.is_selected(field['name'])]
+        columns = [field['name'] for field in fields]
+        column_types = {field['name']: field['type'] for field in fields}
         print '%s last modified at %s' % (table['id'], last_modified.strftime("%b %d %Y %H:%M:%S"))
         return (last_modified, row_count, columns, column_types)
 
+    def list_partitions(self, timeout=60000):
+        '''Returns (partition_id, last_modified_ms) pairs for a date-partitioned table.'''
+        query = 'SELECT partition_id, last_modified_time FROM [%s:%s.%s$__PARTITIONS_SUMMARY__]' % (
+            self.project_id, self.dataset_id, self.table_id.split('@')[0])
+        jobs = self.bq_service.jobs()
+        page = self.metrics.execute(jobs.query(projectId=self.project_id,
+                                               body={'query': query, 'timeoutMs': timeout},
+                                               fields=self.transport.fields('jobs.query.rows')),
+                                    'jobs.query', thread=self.thread_id)
+        partitions = []
+        while True:
+            if page.get('jobComplete', True):
+                for row in page.get('rows', []):
+                    partitions.append((row['f'][0]['v'], int(row['f'][1]['v'])))
+                page_token = page.get('pageToken')
+                if not page_token:
+                    return sorted(partitions)
+            else:
+                page_token = None
+            page = self.metrics.execute(jobs.getQueryResults(
+                pageToken=page_token, timeoutMs=timeout,
+                fields=self.transport.fields('jobs.getQueryResults.rows'),
+                **page['jobReference']), 'jobs.getQueryResults', thread=self.thread_id)
+
     def advance(self, rows, page_token):
         '''Called after reading a page, advances current indices.'''
         done = page_token is None
+        self.rows_read += len(rows)
         if self.rows_left is not None:
             self.rows_left -= len(rows)
             if self.rows_left < 0: print 'Error: Read too many rows!'
@@ -68,6 +132,26 @@ class TableReader:
         else:
             return '%s@%d' % (self.table_id, self.snapshot_time)
 
+    def get_snapshot_key(self):
+        if self.page_token_index is None:
+            return None
+        return snapshot_key(self.project_id, self.dataset_id, self.get_table_id(), self.selected_fields)
+
+    def seek_page_token(self):
+        '''Starts an index-based read of a snapshot from the nearest recorded page token instead.'''
+        key = self.get_snapshot_key()
+        if key is None or not self.next_index:
+            return
+        found = self.page_token_index.find(key, self.next_index)
+        if found is None:
+            return
+        self.next_page_token, self.skip_rows = found
+        self.offset = self.next_index - self.skip_rows
+        self.next_index = None
+        if self.verbose:
+            print '%s: Starting from a page token %d rows before %d' % (self.thread_id, self.skip_rows,
+                                                                       self.offset + self.skip_rows)
+
     def make_read_message(self, row_count, max_results):
         '''Creates a status message for the current read operation.'''
         read_msg = 'Read %d rows' % (row_count,)
@@ -81,79 +165,149 @@ class TableReader:
             read_msg = '%s [max %d]' % (read_msg, max_results)
         return read_msg
 
-    def read_one_page(self, max_results=READ_CHUNK_SIZE):
-        '''Reads one page from the table.'''
+    def read_one_page(self, max_results=None, raw=False):
+        '''Reads one page from the table; by default the page size is chosen by the PageSizer.
+
+        With raw=True the rows are returned as JSON texts when the response allows it (see json_codec.py).
+        '''
+        adaptive = max_results is None and self.page_size is None
         while True:
             try:
+                if adaptive:
+                    max_results = self.page_sizer.next_size()
+                elif max_results is None:
+                    max_results = self.page_size
                 if self.rows_left is not None and self.rows_left < max_results:
                     max_results = self.rows_left
-                data = self.bq_service.tabledata().list(
+                # Rows before the start offset of a read that started from a page token.
+                max_results += self.skip_rows
+                request = self.bq_service.tabledata().list(
                     projectId=self.project_id,
                     datasetId=self.dataset_id,
                     tableId=self.get_table_id(),
                     startIndex=self.next_index,
                     pageToken=self.next_page_token,
-                    maxResults=max_results).execute()
+                    maxResults=max_results,
+                    selectedFields=','.join(self.selected_fields) if self.selected_fields else None,
+                    prettyPrint=False if raw else None,
+                    fields=self.transport.fields('tabledata.list'))
+                if raw:
+                    make_raw(request)
+                measurement = {}
+                data = self.metrics.execute(request, 'tabledata.list', measurement=measurement, thread=self.thread_id)
                 next_page_token = data.get('pageToken', None)
-                rows = data.get('rows', [])
-                print self.make_read_message(len(rows), max_results)
+                if raw and data.raw_rows is not None:
+                    rows = data.raw_rows
+                else:
+                    rows = data.get('rows', [])
+                if adaptive:
+                    self.page_sizer.record(len(rows), measurement['bytes'], measurement['latency'],
+                                           thread=self.thread_id)
+                if self.offset is not None:
+                    self.offset += len(rows)
+                    key = self.get_snapshot_key()
+                    if key is not None and next_page_token is not None:
+                        self.page_token_index.record(key, self.offset, next_page_token)
+                if self.skip_rows:
+                    skipped = min(self.skip_rows, len(rows))
+                    rows = rows[skipped:]
+                    self.skip_rows -= skipped
+                if self.verbose:
+                    print self.make_read_message(len(rows), max_results)
                 is_done = self.advance(rows, next_page_token)
                 return (is_done, rows)
             except HttpError, err:
                 # If the error is a rate limit or connection error, wait and
                 # try again.
                 if err.resp.status in [403, 500, 503]:
-                    print '%s: Retryable error %s, waiting' % (
-                        self.thread_id, err.resp.status,)
+                    self.metrics.record_retry('tabledata.list', err.resp.status, thread=self.thread_id)
+                    if adaptive and err.resp.status != 403:
+                        self.page_sizer.backoff(thread=self.thread_id)
+                    if self.verbose:
+                        print '%s: Retryable error %s, waiting' % (
+                            self.thread_id, err.resp.status,)
                     time.sleep(5)
                 else:
                     raise
 
-    def read(self, result_handler, snapshot_time=None):
-        '''Reads an entire table until the end or we hit a row limit.'''
+    def read(self, result_handler, snapshot_time=None, row_count=None):
+        '''Reads an entire table until the end or we hit a row limit.
+
+        row_count is only used for the progress bar; it is looked up if not given.
+        '''
         # Read the current time and use that for the snapshot time.
         # This will prevent us from getting inconsistent results when the
         # underlying table is changing.
-        _, row_count, _, _ = self.get_table_info()
+        if row_count is None:
+            _, row_count, _, _ = self.get_table_info()
         if snapshot_time is None and not '@' in self.table_id:
             self.snapshot_time = int(time.time() * 1000)
         self.snapshot_time = snapshot_time
+        from progressbar import Percentage, Bar, ProgressBar, Timer
         pbar = ProgressBar(widgets=[Percentage(), Bar(), Timer()], maxval=row_count).start()
+        # Handlers that write JSON get the rows without decoding them, unless they are filtered.
+        raw = getattr(result_handler, 'accepts_raw_rows', False) and self.row_filter is None
+        self.seek_page_token()
         while True:
-            is_done, rows = self.read_one_page()
+            is_done, rows = self.read_one_page(raw=raw)
             if rows:
-                result_handler.handle_rows(rows)
                 pbar.update(len(rows))
+                if self.row_filter is not None:
+                    rows = [row for row in rows if self.row_filter(row)]
+            if rows and isinstance(rows[0], basestring):
+                result_handler.handle_raw_rows(rows)
+            elif rows:
+                result_handler.handle_rows(rows)
             if is_done:
                 result_handler.finish()
                 pbar.finish()
+                if self.page_token_index is not None:
+                    self.page_token_index.save()
                 return
 
-    def parallel_indexed_read(self, partition_count, output_dir, output_format='csv', sep=';'):
-        '''Divides up a table and reads the pieces in parallel by index.'''
+    def parallel_indexed_read(self, partition_count, output_dir, output_format='csv', sep=';', snapshot_time=None):
+        '''Divides up a table and reads the pieces in parallel by index.
+
+        snapshot_time: read the snapshot of an earlier read; the pieces then start at
+        offsets with recorded page tokens where possible.
+        '''
         _, row_count, _, _ = self.get_table_info()
-        snapshot_time = int(time.time() * 1000)
+        if snapshot_time is None:
+            snapshot_time = int(time.time() * 1000)
+        snapshot_table_id = '%s@%d' % (self.table_id, snapshot_time)
         stride = row_count / partition_count
+        starts = [stride * index for index in range(partition_count)]
+        if self.page_token_index is not None:
+            # Pieces may be a tenth of a stride larger or smaller to start at a page token.
+            starts[1:] = self.page_token_index.align(
+                snapshot_key(self.project_id, self.dataset_id, snapshot_table_id, self.selected_fields),
+                starts[1:], stride // 10)
+        # The last piece also reads the rows left over by the division.
+        ends = starts[1:] + [row_count]
         threads = []
         for index in range(partition_count):
             if not (os.path.exists(output_dir) and os.path.isdir(output_dir)):
                 os.makedirs(output_dir)
             file_name = '%s.%d' % (os.path.join(output_dir, self.table_id), index)
-            start_index = stride * index
+            start_index = starts[index]
             thread_reader = TableReader(auth=self.auth, project_id=self.project_id,
-                                        dataset_id=self.dataset_id,
-                                        table_id='%s@%d' % (self.table_id, snapshot_time),
-                                        start_index=start_index, read_count=stride)
+                                        dataset_id=self.dataset_id, table_id=snapshot_table_id,
+                                        start_index=start_index, read_count=ends[index] - start_index,
+                                        metrics=self.metrics, verbose=self.verbose,
+                                        selected_fields=self.selected_fields, row_filter=self.row_filter,
+                                        page_size=self.page_size, page_tokens=self.page_token_index is not None)
             read_thread = TableReadThread(thread_reader, file_name,
-                                          thread_id='[%d-%d)' % (start_index, start_index + stride),
+                                          thread_id='[%d-%d)' % (start_index, ends[index]),
                                           output_format=output_format, sep=sep)
             threads.append(read_thread)
             threads[index].start()
-        for index in range(partition_count):
-            threads[index].join()
+        join_read_threads(threads)
+        self.rows_read += sum(thread.table_reader.rows_read for thread in threads)
 
     def parallel_partitioned_read(self, partition_count, output_dir, output_format='csv', sep=';'):
         ''' Table must be partitioned to use this technique! '''
+        if not (os.path.exists(output_dir) and os.path.isdir(output_dir)):
+            os.makedirs(output_dir)
         snapshot_time = int(time.time() * 1000)
         threads = []
         for index in range(partition_count):
@@ -161,42 +315,272 @@ class TableReader:
             suffix = '%d-of-%d' % (index, partition_count)
             partition_table_id = '%s@%d%s' % (self.table_id, snapshot_time, suffix)
             thread_reader = TableReader(auth=self.auth, project_id=self.project_id,
-                dataset_id=self.dataset_id, table_id=partition_table_id)
+                dataset_id=self.dataset_id, table_id=partition_table_id,
+                metrics=self.metrics, verbose=self.verbose,
+                selected_fields=self.selected_fields, row_filter=self.row_filter,
+                page_size=self.page_size, page_tokens=self.page_token_index is not None)
             read_thread = TableReadThread(thread_reader, file_name, thread_id=suffix,
                                           output_format=output_format, sep=sep)
             threads.append(read_thread)
             threads[index].start()
-        for index in range(partition_count):
-            threads[index].join()
+        join_read_threads(threads)
+        self.rows_read += sum(thread.table_reader.rows_read for thread in threads)
+
+
+    def get_partition_sizes(self, partitions, max_workers=10):
+        '''Returns (partition_id, row_count) pairs for (partition_id, last_modified) pairs.
+
+        The sizes are looked up concurrently, each worker thread with its own client.
+        '''
+        sizes = {}
+        clients = threading.local()
+
+        def get_size(partition_id):
+            if not hasattr(clients, 'bq_service'):
+                clients.bq_service = self.auth.build_bq_client()
+            table = self.metrics.execute(clients.bq_service.tables().get(
+                projectId=self.project_id, datasetId=self.dataset_id,
+                tableId='%s$%s' % (self.table_id, partition_id),
+                fields=self.transport.fields('tables.get.size')), 'tables.get.size', thread=self.thread_id)
+            sizes[partition_id] = int(table.get('numRows', 0))
+
+        pool = WorkerPool(max_workers, metrics=self.metrics, name='partition_size')
+        for partition_id, _ in partitions:
+            pool.submit(0, get_size, partition_id)
+        pool.join()
+        return [(partition_id, sizes[partition_id]) for partition_id, _ in partitions]
+
+    def read_partition_piece(self, partition_id, file_name, start_index, read_count,
+                             output_format, sep, columns=None, row_count=None):
+        '''Reads one partition, or an index range of it, into a file; returns the number of rows read.'''
+        reader = TableReader(auth=self.auth, project_id=self.project_id, dataset_id=self.dataset_id,
+                             table_id='%s$%s' % (self.table_id, partition_id),
+                             start_index=start_index, read_count=read_count,
+                             metrics=self.metrics, verbose=self.verbose,
+                             selected_fields=self.selected_fields, row_filter=self.row_filter,
+                             page_size=self.page_size, page_tokens=self.page_token_index is not None)
+        thread_id = partition_id
+        if start_index is not None:
+            thread_id = '%s[%d-%d)' % (partition_id, start_index, start_index + read_count)
+        TableReadThread(reader, file_name, thread_id=thread_id, output_format=output_format, sep=sep,
+                        columns=columns, row_count=read_count or row_count).run()
+        return reader.rows_read
+
+    def partition_discovery_read(self, output_dir, max_workers=10, split_rows=None,
+                                 output_format='csv', sep=';'):
+        '''Reads the partitions of a date-partitioned table on a bounded pool of threads.
+
+        The real partitions ($YYYYMMDD decorators) are listed with their row
+        counts and read largest first. A partition with more than split_rows
+        rows (by default an even share of the table per worker) is further
+        split into index ranges, so one skewed partition does not dominate the
+        wall-clock time. Each piece is written to <table_id>.<partition>.<n>.
+
+        Index ranges are only consistent while the partition does not change, so
+        a split partition modified during the read is read again in one piece.
+        Partitions are not split for SQLite output, whose pieces all insert into
+        one table, so the rows of a piece could not be replaced.
+        '''
+        if not (os.path.exists(output_dir) and os.path.isdir(output_dir)):
+            os.makedirs(output_dir)
+        _, _, columns, _ = self.get_table_info()
+        partitions = self.list_partitions()
+        sizes = self.get_partition_sizes(partitions, max_workers)
+        total_rows = sum(row_count for _, row_count in sizes)
+        if split_rows is None:
+            split_rows = max(total_rows // max_workers, READ_CHUNK_SIZE)
+        print 'Reading %d rows in %d partitions' % (total_rows, len(sizes))
+        base_name = os.path.join(output_dir, self.table_id)
+        pool = WorkerPool(max_workers, metrics=self.metrics, name='partition_reader')
+        split_partitions = {}
+        # Rows read into each piece file.
+        piece_rows = {}
+
+        def read_piece(partition_id, file_name, *args):
+            piece_rows[file_name] = self.read_partition_piece(partition_id, file_name, *args)
+        for partition_id, row_count in sizes:
+            pieces = max(1, -(-row_count // split_rows)) if output_format.lower() != 'sqlite' else 1
+            stride = -(-row_count // pieces)
+            if pieces > 1:
+                split_partitions[partition_id] = (pieces, row_count)
+            for index in range(pieces):
+                file_name = '%s.%s.%d' % (base_name, partition_id, index)
+                if pieces == 1:
+                    # Unsplit partitions are read with page tokens.
+                    start_index, read_count = None, None
+                else:
+                    start_index = index * stride
+                    read_count = min(stride, row_count - start_index)
+                pool.submit(read_count or row_count, read_piece, partition_id, file_name,
+                            start_index, read_count, output_format, sep, columns, row_count)
+        pool.join()
+        if not split_partitions:
+            self.rows_read += sum(piece_rows.values())
+            return
+        last_modified = dict(partitions)
+        for partition_id, modified in self.list_partitions():
+            if partition_id not in split_partitions or last_modified.get(partition_id) == modified:
+                continue
+            print 'Partition %s changed during the read, reading it again' % (partition_id,)
+            pieces, row_count = split_partitions[partition_id]
+            for index in range(1, pieces):
+                file_name = '%s.%s.%d' % (base_name, partition_id, index)
+                piece_rows.pop(file_name, None)
+                # Pieces that read no rows wrote no file.
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+            pool.submit(row_count, read_piece, partition_id, '%s.%s.0' % (base_name, partition_id),
+                        None, None, output_format, sep, columns, row_count)
+        pool.join()
+        self.rows_read += sum(piece_rows.values())
+
+
+    def auto_read(self, output_dir, output_format='csv', sep=';', gcs_bucket=None, max_workers=16,
+                  cost_model=None):
+        '''Reads the table with the strategy the cost model estimates to be fastest.
+
+        Extracting to GCS is only considered if a gcs_bucket is given and no
+        row filter is set; the extracted shards are streamed into the output
+        files without being saved. Extracted TIMESTAMP, RECORD and REPEATED
+        values are formatted differently from tabledata.list (see
+        gcs_reader.format_field), so give no gcs_bucket where that matters.
+        '''
+        _, row_count, columns, _ = self.get_table_info()
+        plan = plan_read(row_count, self.num_bytes, partitioned=self.time_partitioning is not None,
+                         can_extract=gcs_bucket is not None and self.row_filter is None
+                         and self.selected_fields is None,
+                         max_workers=max_workers, cost_model=cost_model)
+        print 'Reading %d rows (%d bytes): %s' % (row_count, self.num_bytes, plan)
+        if not (os.path.exists(output_dir) and os.path.isdir(output_dir)):
+            os.makedirs(output_dir)
+        if plan.strategy == 'single-thread':
+            thread = TableReadThread(self, '%s.%s' % (os.path.join(output_dir, self.table_id), output_format),
+                                     output_format=output_format, sep=sep, columns=columns, row_count=row_count)
+            thread.run()
+        elif plan.strategy == 'parallel-indexed':
+            self.parallel_indexed_read(plan.workers, output_dir, output_format=output_format, sep=sep)
+        elif plan.strategy == 'partition-discovery':
+            self.partition_discovery_read(output_dir, max_workers=plan.workers,
+                                          output_format=output_format, sep=sep)
+        else:
+            self.extract_read(output_dir, gcs_bucket, plan.workers, columns, output_format=output_format, sep=sep)
+        return plan
+
+    def extract_read(self, output_dir, gcs_bucket, partition_count, columns, output_format='csv', sep=';'):
+        '''Extracts the table to GCS and streams the shards into one output file per partition.'''
+        # Imported here, since gcs_extract_read imports this module.
+        from gcs_extract_read import run_partitioned_extract_job
+        from gcs_reader import GcsReader
+        from job_runner import JobRunner
+        job_runner = JobRunner(self.auth, project_id=self.project_id, metrics=self.metrics, verbose=self.verbose)
+        # Note: a separate GCS reader is required per partition.
+        gcs_readers = [GcsReader(auth=self.auth, gcs_bucket=gcs_bucket, metrics=self.metrics)
+                       for _ in range(partition_count)]
+        result_handlers = [make_result_handler('%s.%d' % (os.path.join(output_dir, self.table_id), index),
+                                               output_format, columns=columns if output_format == 'csv' else None,
+                                               sep=sep)
+                           for index in range(partition_count)]
+        try:
+            run_partitioned_extract_job(job_runner, gcs_readers, source_project_id=self.project_id,
+                                        source_dataset_id=self.dataset_id, source_table_id=self.table_id,
+                                        result_handlers=result_handlers, columns=columns)
+        finally:
+            for result_handler in result_handlers:
+                result_handler.finish()
+
+
+def make_row_filter(expressions, columns):
+    '''Builds a row predicate from expressions such as "country=LT" or "status!=deleted".
+
+    All expressions must hold for a row to be kept. Values are compared with
+    the raw string values returned by the API; "null" matches missing values.
+    '''
+    conditions = []
+    for expression in expressions:
+        # Split on the first operator only; the value may contain "=" or "!=".
+        position = expression.find('=')
+        negate = position > 0 and expression[position - 1] == '!'
+        column = expression[:position - 1 if negate else position].strip()
+        if position < 0 or not column:
+            raise ValueError('Invalid filter %s, expected COLUMN=VALUE or COLUMN!=VALUE' % (expression,))
+        value = expression[position + 1:]
+        if column not in columns:
+            raise ValueError('Unknown column %s in filter %s' % (column, expression))
+        value = None if value == 'null' else value
+        conditions.append((columns.index(column), value, negate))
+
+    def row_filter(row):
+        fields = row['f']
+        for position, value, negate in conditions:
+            if (fields[position]['v'] == value) == negate:
+                return False
+        return True
+    return row_filter
+
+
+def join_read_threads(threads):
+    '''Waits for TableReadThreads and re-raises the first error of a failed one.'''
+    for thread in threads:
+        thread.join()
+    for thread in threads:
+        if thread.error is not None:
+            error_type, error, traceback = thread.error
+            raise error_type, error, traceback
 
 
 class TableReadThread(threading.Thread):
     '''Thread that reads from a table and writes it to a file.'''
 
     def __init__(self, table_reader, output_file_name,
-                 thread_id='thread', output_format='csv', sep=';'):
+                 thread_id='thread', output_format='csv', sep=';', columns=None, row_count=None,
+                 max_file_rows=None, max_file_bytes=None, snapshot_time=None):
         threading.Thread.__init__(self)
+        # Known columns and row count save a tables.get per thread.
+        self.columns = columns
+        self.row_count = row_count
         self.table_reader = table_reader
         self.output_file_name = output_file_name
         self.thread_id = thread_id
         self.output_format = output_format
         self.sep = sep
+        # Roll the output over to a new file after this many rows or bytes.
+        self.max_file_rows = max_file_rows
+        self.max_file_bytes = max_file_bytes
+        self.snapshot_time = snapshot_time
+        # Set to the exc_info of a failed read.
+        self.error = None
+        if table_reader is not None:
+            table_reader.thread_id = thread_id
 
     def get_columns(self):
+        if self.columns is not None:
+            return self.columns
         _, _, columns, _ = self.table_reader.get_table_info()
         return columns
 
     def get_result_handler(self):
-        if self.output_format.lower() == 'csv':
-            return CSVResultHandler(self.output_file_name, columns=self.get_columns(), sep=self.sep)
-        elif self.output_format.lower() == 'json':
-            return JSONResultHandler(self.output_file_name)
-        else:
-            return FileResultHandler(self.output_file_name)
+        columns, column_types = None, None
+        if self.output_format.lower() == 'sqlite' and self.table_reader is not None:
+            # SQLite tables are created with the column types of the schema.
+            _, _, columns, column_types = self.table_reader.get_table_info()
+        elif self.output_format.lower() == 'csv':
+            columns = self.get_columns()
+        return make_result_handler(self.output_file_name, self.output_format, columns=columns, sep=self.sep,
+                                   max_rows=self.max_file_rows, max_bytes=self.max_file_bytes,
+                                   column_types=column_types)
 
     def run(self):
         print 'Reading %s' % (self.thread_id,)
-        self.table_reader.read(self.get_result_handler())
+        metrics = self.table_reader.metrics
+        metrics.add_gauge('active_readers', 1, thread=self.thread_id)
+        try:
+            self.table_reader.read(self.get_result_handler(), snapshot_time=self.snapshot_time,
+                                   row_count=self.row_count)
+        except Exception:
+            self.error = sys.exc_info()
+            raise
+        finally:
+            metrics.add_gauge('active_readers', -1, thread=self.thread_id)
 
 
 def main(argv):
@@ -214,34 +598,87 @@ def main(argv):
     parser.add_argument('-d', '--dataset_id', required=True, help="The name of the BigQuery dataset which contains the table")
     parser.add_argument('-t', '--table_id', required=True, help='Name of the table which will be exported')
     parser.add_argument('-o', '--output_directory', default='.', help='The directory where the output will be exported')
-    parser.add_argument('-f', '--format', default='json', choices=['json', 'csv'], help='The output format')
+    parser.add_argument('-f', '--format', default='json', choices=['json', 'csv', 'sqlite'], help='The output format')
     parser.add_argument('--separator', help='Separator in CSV', default=';')
-    parser.add_argument('--type', choices=['single-thread', 'parallel-indexed', 'parallel-partitioned'],
-                        default='single-thread', help='Reader type')
+    parser.add_argument('--sqlite_index', action='append', default=[], dest='sqlite_indexes',
+                        help='Index the COLUMN (or COLUMN,COLUMN) of the SQLite table once it is loaded; may be repeated')
+    parser.add_argument('--type', choices=['single-thread', 'parallel-indexed', 'parallel-partitioned',
+                                           'partition-discovery', 'auto'],
+                        default='single-thread',
+                        help='Reader type; auto chooses one (and the number of workers) from the table size')
+    parser.add_argument('-b', '--gcs_bucket', help='GCS bucket the auto reader may extract the table to')
+    parser.add_argument('--cost_model', help='Calibrated cost model file for the auto reader (see read_planner.py)')
     parser.add_argument('--partition_count', type=int, default=10, help='Number of partitions for parallel reading')
+    parser.add_argument('--max_workers', type=int, default=10,
+                        help='Number of reader threads for partition-discovery reading')
+    parser.add_argument('--split_rows', type=int,
+                        help='Split partitions larger than this into index ranges (partition-discovery)')
+    parser.add_argument('--columns', help='Comma separated list of columns to read (default: all columns)')
+    parser.add_argument('--snapshot_time', type=int,
+                        help='Snapshot (milliseconds since the epoch) to read (single-thread and parallel-indexed); '
+                             'reads of the same snapshot reuse its recorded page tokens')
+    parser.add_argument('--no_page_tokens', action='store_true',
+                        help='Do not record or reuse the page tokens of snapshots')
+    parser.add_argument('--page_size', type=int,
+                        help='Rows per tabledata.list request (default: adapted to the row width and latency)')
+    parser.add_argument('--filter', action='append', default=[], dest='filters',
+                        help='Keep only rows where COLUMN=VALUE or COLUMN!=VALUE; may be repeated')
+    add_rotation_arguments(parser)
+    add_writer_arguments(parser)
+    add_metrics_arguments(parser)
+    add_transport_arguments(parser)
     args = parser.parse_args()
+    metrics = metrics_from_args(args)
+    writer_options_from_args(args)
+    transport = transport_from_args(args)
 
     auth = BigQuery_Auth(service_acc=args.service_account, client_secrets=args.client_secret,
-                         credentials=args.credentials, key_file=args.keyfile)
+                         credentials=args.credentials, key_file=args.keyfile, transport=transport)
     table_reader = TableReader(auth, project_id=args.project_id,
-                               dataset_id=args.dataset_id, table_id=args.table_id)
+                               dataset_id=args.dataset_id, table_id=args.table_id,
+                               metrics=metrics, verbose=args.verbose, page_size=args.page_size,
+                               page_tokens=not args.no_page_tokens,
+                               selected_fields=[column.strip() for column in args.columns.split(',')] if args.columns else None)
+    if args.filters:
+        _, _, columns, _ = table_reader.get_table_info()
+        table_reader.row_filter = make_row_filter(args.filters, columns)
     fname = table_reader.table_id + '.' + args.format if args.format is not None else table_reader.table_id
     output_file_name = os.path.join(args.output_directory, fname)
     if args.type == 'single-thread':
         thread = TableReadThread(table_reader, output_file_name,
-                                 output_format=args.format, sep=args.separator)
+                                 output_format=args.format, sep=args.separator,
+                                 max_file_rows=args.max_file_rows, max_file_bytes=args.max_file_bytes,
+                                 snapshot_time=args.snapshot_time)
         thread.start()
         thread.join()
     elif args.type == 'parallel-indexed':
         table_reader.parallel_indexed_read(output_dir=args.output_directory,
                                            partition_count=args.partition_count,
                                            output_format=args.format,
-                                           sep=args.separator)
+                                           sep=args.separator,
+                                           snapshot_time=args.snapshot_time)
     elif args.type == 'parallel-partitioned':
         table_reader.parallel_partitioned_read(output_dir=args.output_directory,
                                                partition_count=args.partition_count,
                                                output_format=args.format,
                                                sep=args.separator)
+    elif args.type == 'partition-discovery':
+        table_reader.partition_discovery_read(output_dir=args.output_directory,
+                                              max_workers=args.max_workers,
+                                              split_rows=args.split_rows,
+                                              output_format=args.format,
+                                              sep=args.separator)
+    elif args.type == 'auto':
+        table_reader.auto_read(output_dir=args.output_directory, output_format=args.format, sep=args.separator,
+                               gcs_bucket=args.gcs_bucket, max_workers=args.max_workers,
+                               cost_model=CostModel.load(args.cost_model) if args.cost_model else None)
+    if args.format == 'sqlite' and args.sqlite_indexes:
+        database_file, table_name = sqlite_database_name(output_file_name)
+        create_sqlite_indexes(database_file, table_name,
+                              [[column.strip() for column in index.split(',')] for index in args.sqlite_indexes])
+    metrics.close()
+    if args.transport_report:
+        print transport.format_report()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,258 @@
+#!/usr/bin/python2.7
+
+'''Reads a random sample of the rows of a table.
+
+Reading the first rows of a table gives a sample biased towards old data,
+and a sampling query scans (and bills) the whole table. TableSampler picks
+random startIndex offsets instead and reads small pages at these offsets
+with tabledata.list, concurrently and against a fixed snapshot, so a sample
+costs a few hundred small requests and no query.
+
+The table is divided into blocks of page_rows consecutive rows and a
+sample of whole blocks is drawn without replacement; the rows of the last
+blocks beyond the sample size are dropped at random. With page_rows=1 this
+is a simple random sample of rows; larger pages need fewer requests but the
+rows of one block are neighbours (a cluster sample). The same seed (and
+snapshot time) reproduces the same sample.
+
+With stratified=True the rows of a date-partitioned table are sampled
+within each partition, in proportion to the partition sizes, so every day
+is represented. Partition decorators cannot be combined with a snapshot, so
+a stratified sample reads the current partitions.
+
+Usage from the command line:
+python table_sampler.py [options]
+'''
+
+import os
+import random
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from googleapiclient.errors import HttpError
+from auth import BigQuery_Auth
+from metrics import get_metrics, add_metrics_arguments, metrics_from_args
+from output_writer import add_writer_arguments, writer_options_from_args
+from output_handler import make_result_handler
+from page_token_index import snapshot_key
+from table_reader import TableReader
+from transport import add_transport_arguments, transport_from_args
+from worker_pool import WorkerPool
+
+DEFAULT_PAGE_ROWS = 100
+
+
+def allocate_sample(sample_size, sizes):
+    '''Splits a sample size over strata in proportion to their sizes (largest remainder).
+
+    sizes: (stratum, row_count) pairs. Returns a dict of stratum -> sample size.
+    '''
+    total = sum(row_count for _, row_count in sizes)
+    if total == 0:
+        return {}
+    sample_size = min(sample_size, total)
+    shares = [(stratum, row_count, float(sample_size) * row_count / total) for stratum, row_count in sizes]
+    allocation = dict((stratum, int(share)) for stratum, _, share in shares)
+    remaining = sample_size - sum(allocation.values())
+    # Ties go to the first stratum, so the allocation does not depend on the seed.
+    for stratum, row_count, share in sorted(shares, key=lambda item: -(item[2] - int(item[2]))):
+        if remaining <= 0:
+            break
+        if allocation[stratum] < row_count:
+            allocation[stratum] += 1
+            remaining -= 1
+    return allocation
+
+
+class TableSampler:
+    '''Reads a random sample of a table; see the module docstring.'''
+
+    def __init__(self, auth, project_id, dataset_id, table_id, seed=None, page_rows=DEFAULT_PAGE_ROWS,
+                 max_workers=16, metrics=None, verbose=False, selected_fields=None):
+        self.auth = auth
+        self.project_id = project_id
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+        self.random = random.Random(seed)
+        self.page_rows = max(1, page_rows)
+        self.max_workers = max_workers
+        self.metrics = metrics if metrics is not None else get_metrics()
+        self.verbose = verbose
+        self.selected_fields = list(selected_fields) if selected_fields else None
+        self.transport = auth.transport
+        self.clients = threading.local()
+        self.table_reader = TableReader(auth, project_id, dataset_id, table_id, metrics=self.metrics,
+                                        verbose=verbose, selected_fields=self.selected_fields)
+
+    def get_columns(self):
+        _, _, columns, _ = self.table_reader.get_table_info()
+        return columns
+
+    def pick_blocks(self, row_count, sample_size):
+        '''Returns the sorted (start_index, read_count) blocks of a sample of one table or partition.'''
+        num_blocks = -(-row_count // self.page_rows)
+        count = min(num_blocks, -(-sample_size // self.page_rows))
+        starts = sorted(index * self.page_rows for index in self.random.sample(xrange(num_blocks), count))
+        return [(start, min(self.page_rows, row_count - start)) for start in starts]
+
+    def fetch(self, table_id, start_index, read_count):
+        '''Reads the rows of one block, retrying rate limit and server errors.
+
+        The block is read from a recorded page token of the snapshot less than a block before it, if there is one.
+        '''
+        if not hasattr(self.clients, 'bq_service'):
+            self.clients.bq_service = self.auth.build_bq_client()
+        page_token_index = self.table_reader.page_token_index
+        key = snapshot_key(self.project_id, self.dataset_id, table_id, self.selected_fields)
+        found = page_token_index.find(key, start_index, self.page_rows) if key and page_token_index else None
+        page_token, skip_rows = found if found is not None else (None, 0)
+        rows = []
+        while len(rows) < read_count:
+            try:
+                page_start = start_index + len(rows) - skip_rows
+                request = self.clients.bq_service.tabledata().list(
+                    projectId=self.project_id, datasetId=self.dataset_id, tableId=table_id,
+                    startIndex=None if page_token else page_start, pageToken=page_token,
+                    maxResults=read_count - len(rows) + skip_rows,
+                    selectedFields=','.join(self.selected_fields) if self.selected_fields else None,
+                    fields=self.transport.fields('tabledata.list'))
+                page = self.metrics.execute(request, 'tabledata.list', thread='sample')
+            except HttpError, err:
+                if err.resp.status in [403, 500, 503]:
+                    self.metrics.record_retry('tabledata.list', err.resp.status, thread='sample')
+                    if self.verbose:
+                        print 'sample: Retryable error %s, waiting' % (err.resp.status,)
+                    time.sleep(5)
+                    continue
+                raise
+            page_rows = page.get('rows', [])
+            if not page_rows:
+                # The table shrank since its size was read.
+                break
+            page_token = page.get('pageToken')
+            if key and page_token_index and page_token:
+                page_token_index.record(key, page_start + len(page_rows), page_token)
+            skipped = min(skip_rows, len(page_rows))
+            rows.extend(page_rows[skipped:])
+            skip_rows -= skipped
+        return rows
+
+    def read_blocks(self, blocks):
+        '''Reads (table_id, start_index, read_count) blocks concurrently; returns the rows of each block.'''
+        results = {}
+
+        def read_block(index, table_id, start_index, read_count):
+            results[index] = self.fetch(table_id, start_index, read_count)
+
+        pool = WorkerPool(self.max_workers, metrics=self.metrics, name='sampler')
+        for index, (table_id, start_index, read_count) in enumerate(blocks):
+            pool.submit(0, read_block, index, table_id, start_index, read_count)
+        pool.join()
+        return [results[index] for index in range(len(blocks))]
+
+    def trim(self, rows, sample_size):
+        '''Drops rows at random (keeping the order of the rest) down to the sample size.'''
+        if len(rows) <= sample_size:
+            return rows
+        keep = sorted(self.random.sample(xrange(len(rows)), sample_size))
+        return [rows[index] for index in keep]
+
+    def sample(self, sample_size, result_handler, stratified=False, snapshot_time=None):
+        '''Writes a random sample of sample_size rows to the result handler and returns the row count.'''
+        _, row_count, _, _ = self.table_reader.get_table_info()
+        start = time.time()
+        if stratified:
+            if self.table_reader.time_partitioning is None:
+                raise ValueError('Stratified sampling requires a date-partitioned table')
+            sizes = self.table_reader.get_partition_sizes(self.table_reader.list_partitions(), self.max_workers)
+            allocation = allocate_sample(sample_size, sizes)
+            blocks = []
+            partition_samples = []
+            for partition_id, partition_rows in sizes:
+                partition_sample = allocation.get(partition_id)
+                if partition_sample:
+                    partition_blocks = self.pick_blocks(partition_rows, partition_sample)
+                    partition_samples.append((partition_sample, len(partition_blocks)))
+                    blocks.extend(('%s$%s' % (self.table_id, partition_id), start_index, read_count)
+                                  for start_index, read_count in partition_blocks)
+            block_rows = self.read_blocks(blocks)
+            # Each partition is trimmed to its own share of the sample.
+            rows = []
+            position = 0
+            for partition_sample, block_count in partition_samples:
+                rows.extend(self.trim([row for block in block_rows[position:position + block_count] for row in block],
+                                      partition_sample))
+                position += block_count
+        else:
+            if snapshot_time is None:
+                snapshot_time = int(time.time() * 1000)
+            table_id = '%s@%d' % (self.table_id, snapshot_time)
+            blocks = [(table_id, start_index, read_count)
+                      for start_index, read_count in self.pick_blocks(row_count, sample_size)]
+            rows = self.trim([row for block in self.read_blocks(blocks) for row in block], sample_size)
+        if rows:
+            result_handler.handle_rows(rows)
+        result_handler.finish()
+        if self.table_reader.page_token_index is not None:
+            self.table_reader.page_token_index.save()
+        print 'Sampled %d of %d rows in %d requests (%.1fs)' % (len(rows), row_count, len(blocks),
+                                                              time.time() - start)
+        return len(rows)
+
+
+def main(argv):
+    parser = ArgumentParser(description='Read a random sample of a BigQuery table into a text file')
+    parser.add_argument('-a', '--service_account', required=True, help='Big Query service account name')
+    parser.add_argument('-s', '--client_secret', required=True,
+                        help='Path to client_secrets.json file required for API login')
+    parser.add_argument('-c', '--credentials',
+                        help='Path to credentials file (e.g. bigquery_credentials.dat) required for API login. '
+                             'If the file is not present, the browser window will be shown and you will be asked to authenticate')
+    parser.add_argument('-k', '--keyfile', help='Path to the key file (e.g., key.p12)')
+    parser.add_argument('-p', '--project_id', required=True, help='BigQuery project ID')
+    parser.add_argument('-d', '--dataset_id', required=True, help='The name of the BigQuery dataset which contains the table')
+    parser.add_argument('-t', '--table_id', required=True, help='Name of the table which will be sampled')
+    parser.add_argument('-n', '--sample_size', type=int, required=True, help='Number of rows to sample')
+    parser.add_argument('--seed', type=int, help='Random seed, to reproduce a sample')
+    parser.add_argument('--snapshot_time', type=int,
+                        help='Snapshot (milliseconds since the epoch) to sample, to reproduce a sample')
+    parser.add_argument('--page_rows', type=int, default=DEFAULT_PAGE_ROWS,
+                        help='Consecutive rows read per random offset (1 for a simple random sample)')
+    parser.add_argument('--stratified', action='store_true',
+                        help='Sample every partition of a date-partitioned table in proportion to its size')
+    parser.add_argument('--max_workers', type=int, default=16, help='Number of concurrent requests')
+    parser.add_argument('--columns', help='Comma separated list of columns to read (default: all columns)')
+    parser.add_argument('-o', '--output_directory', default='.', help='The directory where the output will be exported')
+    parser.add_argument('-f', '--format', default='csv', choices=['json', 'csv', 'sqlite'], help='The output format')
+    parser.add_argument('--separator', help='Separator in CSV', default=';')
+    add_writer_arguments(parser)
+    add_metrics_arguments(parser)
+    add_transport_arguments(parser)
+    args = parser.parse_args()
+    metrics = metrics_from_args(args)
+    writer_options_from_args(args)
+    transport = transport_from_args(args)
+
+    auth = BigQuery_Auth(service_acc=args.service_account, client_secrets=args.client_secret,
+                         credentials=args.credentials, key_file=args.keyfile, transport=transport)
+    sampler = TableSampler(auth, args.project_id, args.dataset_id, args.table_id, seed=args.seed,
+                           page_rows=args.page_rows, max_workers=args.max_workers, metrics=metrics,
+                           verbose=args.verbose,
+                           selected_fields=[column.strip() for column in args.columns.split(',')] if args.columns else None)
+    columns, column_types = None, None
+    if args.format == 'sqlite':
+        _, _, columns, column_types = sampler.table_reader.get_table_info()
+    elif args.format == 'csv':
+        columns = sampler.get_columns()
+    output_file_name = os.path.join(args.output_directory, '%s.sample.%s' % (args.table_id, args.format))
+    sampler.sample(args.sample_size, make_result_handler(output_file_name, args.format, columns=columns,
+                                                         sep=args.separator, column_types=column_types),
+                   stratified=args.stratified, snapshot_time=args.snapshot_time)
+    metrics.close()
+    if args.transport_report:
+        print transport.format_report()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,190 @@
+#!/usr/bin/python2.7
+
+'''Shares OAuth access tokens between threads and processes.
+
+Every client built by a BigQuery_Auth used to refresh its credentials on
+its own, so a read with 50 threads made 50 token exchanges and every client
+refreshed again when its token expired in the middle of a read. A
+TokenBroker holds one access token per set of credentials for the whole
+process: the first thread that finds the token missing or about to expire
+(within REFRESH_MARGIN seconds) refreshes it while the others wait for the
+result. Tokens are also kept in a cache file (readable by the user only)
+guarded by a file lock, so worker processes started by the same user reuse
+the token of the first one instead of each making a token exchange.
+
+Clients use the token through BrokeredHttp, which sets the Authorization
+header of every request and, if a request is rejected with 401, drops the
+token and retries once with a fresh one.
+'''
+
+import calendar
+import fcntl
+import json
+import os
+import threading
+import time
+from metrics import get_metrics
+
+# Seconds before its expiry a token is refreshed.
+REFRESH_MARGIN = 300
+# Lifetime assumed for tokens whose credentials do not report an expiry.
+DEFAULT_LIFETIME = 3600
+
+
+class BrokeredHttp(object):
+    '''Wraps an httplib2.Http to authorize requests with the broker's token.'''
+
+    def __init__(self, broker, credentials, http):
+        self.broker = broker
+        self.credentials = credentials
+        self.http = http
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        headers = dict(headers or {})
+        token = self.broker.get_token(self.credentials)
+        headers['authorization'] = 'Bearer %s' % (token,)
+        resp, content = self.http.request(uri, method, body, headers, *args, **kwargs)
+        if resp.status == 401:
+            # The token was revoked or expired early; one retry with a new token.
+            self.broker.invalidate(token)
+            headers['authorization'] = 'Bearer %s' % (self.broker.get_token(self.credentials),)
+            resp, content = self.http.request(uri, method, body, headers, *args, **kwargs)
+        return resp, content
+
+
+class TokenBroker:
+    '''Caches the access token of one set of credentials; see the module docstring.'''
+
+    def __init__(self, key, cache_file=None, refresh_margin=REFRESH_MARGIN, metrics=None):
+        self.key = key
+        self.cache_file = cache_file
+        self.refresh_margin = refresh_margin
+        self.metrics = metrics if metrics is not None else get_metrics()
+        self.condition = threading.Condition()
+        self.token = None
+        self.expiry = 0
+        self.refreshing = False
+        self.stats = {'refreshes': 0, 'memory_hits': 0, 'file_hits': 0, 'waits': 0}
+
+    def is_valid(self, expiry):
+        return expiry - self.refresh_margin > time.time()
+
+    def get_token(self, credentials):
+        '''Returns a valid access token; only one thread refreshes it at a time.'''
+        with self.condition:
+            while not (self.token is not None and self.is_valid(self.expiry)):
+                if not self.refreshing:
+                    self.refreshing = True
+                    break
+                self.stats['waits'] += 1
+                self.condition.wait()
+            else:
+                self.stats['memory_hits'] += 1
+                return self.token
+        token, expiry = None, 0
+        try:
+            token, expiry = self.load_token(credentials)
+        finally:
+            with self.condition:
+                if token is not None:
+                    self.token, self.expiry = token, expiry
+                self.refreshing = False
+                self.condition.notify_all()
+        return token
+
+    def invalidate(self, token):
+        '''Drops a rejected token, unless another thread already replaced it.'''
+        with self.condition:
+            if self.token == token:
+                self.token = None
+                self.expiry = 0
+        if self.cache_file is not None:
+            with self.locked_cache() as cache:
+                if cache.get(self.key, {}).get('token') == token:
+                    del cache[self.key]
+
+    def load_token(self, credentials):
+        '''Takes the token from the cache file, or refreshes the credentials and stores the new one.'''
+        if self.cache_file is None:
+            return self.refresh(credentials)
+        with self.locked_cache() as cache:
+            entry = cache.get(self.key)
+            if entry is not None and self.is_valid(entry['expiry']):
+                with self.condition:
+                    self.stats['file_hits'] += 1
+                return entry['token'], entry['expiry']
+            token, expiry = self.refresh(credentials)
+            cache[self.key] = {'token': token, 'expiry': expiry}
+            return token, expiry
+
+    def refresh(self, credentials):
+        '''Makes a token exchange.'''
+        import httplib2
+        start = time.time()
+        credentials.refresh(httplib2.Http())
+        self.metrics.record_request('oauth2.token', time.time() - start)
+        with self.condition:
+            self.stats['refreshes'] += 1
+        if credentials.token_expiry is not None:
+            expiry = calendar.timegm(credentials.token_expiry.utctimetuple())
+        else:
+            expiry = int(time.time()) + DEFAULT_LIFETIME
+        return credentials.access_token, expiry
+
+    def locked_cache(self):
+        return LockedTokenCache(self.cache_file)
+
+
+class LockedTokenCache:
+    '''Context manager that holds an exclusive lock on the token cache file
+    and yields its content, written back on exit if it changed.'''
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.lock_file = None
+        self.content = None
+        self.data = None
+
+    def __enter__(self):
+        directory = os.path.dirname(self.file_name)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        self.lock_file = os.fdopen(os.open('%s.lock' % (self.file_name,), os.O_RDWR | os.O_CREAT, 0600), 'r+')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        self.content = None
+        if os.path.exists(self.file_name):
+            with open(self.file_name) as f:
+                self.content = f.read()
+        try:
+            self.data = json.loads(self.content) if self.content else {}
+        except ValueError:
+            # A damaged cache only costs a refresh.
+            self.data = {}
+        return self.data
+
+    def __exit__(self, type, value, traceback):
+        try:
+            content = json.dumps(self.data, sort_keys=True)
+            if type is None and content != self.content:
+                temp_file_name = '%s.%d.tmp' % (self.file_name, os.getpid())
+                with os.fdopen(os.open(temp_file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'w') as f:
+                    f.write(content)
+                os.rename(temp_file_name, self.file_name)
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def get_token_broker(key, cache_file=None):
+    '''Returns the TokenBroker of a set of credentials, shared by all BigQuery_Auth objects in the process.'''
+    with _brokers_lock:
+        if key not in _brokers:
+            _brokers[key] = TokenBroker(key, cache_file=cache_file)
+        return _brokers[key]
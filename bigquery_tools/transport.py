@@ -0,0 +1,242 @@
+#!/usr/bin/python2.7
+
+'''Partial responses and compressed transfers for API calls.
+
+Every API call made by the package is identified by a call type such as
+'tabledata.list' or 'jobs.get.state'. When partial responses are enabled,
+the call is made with a minimal fields= mask covering only what the package
+reads from the response, so e.g. job polls fetch just the job state instead
+of the whole job resource. Independently, gzip transfer encoding is
+negotiated, which Google APIs only honor when the User-Agent contains "gzip".
+
+The call type of each request is passed down by Metrics.execute in a request
+header that the transport strips before sending. Responses are counted per
+call type together with whether the server actually sent them gzip encoded.
+
+To report bytes saved, the transport can probe every Nth call of each type
+by repeating it without the mask. The probes give the full-to-masked size
+ratio and the gzip ratio of each call type, which are used to estimate the
+savings over all calls. httplib2 decodes responses before they reach the
+transport, so the gzip ratio is measured by compressing the probed content,
+and gzip savings are only reported for responses that were gzip encoded.
+
+A Transport may also limit the rate of API calls (max_requests_per_second)
+for all clients built from it, to stay within the API quota when many
+readers run in one process. Media downloads are not limited.
+
+Usage:
+  transport = Transport(partial_responses=True, gzip=True, probe_interval=100)
+  auth = BigQuery_Auth(..., transport=transport)
+  ...
+  print transport.format_report()
+'''
+
+import threading
+import time
+import urllib
+import urlparse
+import zlib
+
+GZIP_USER_AGENT = 'bigquery-tools (gzip)'
+# Request header carrying the call type from Metrics.execute to the transport; never sent.
+CALL_TYPE_HEADER = 'x-bigquery-tools-call-type'
+
+# Minimal response fields for each call type made by the package.
+FIELD_MASKS = {
+    'tabledata.list': 'pageToken,rows',
+    'tables.get': 'id,tableReference,type,numRows,numBytes,lastModifiedTime,schema,timePartitioning',
+    'tables.get.size': 'numRows,numBytes',
+    'tables.exists': 'id',
+    'tables.list': 'nextPageToken,tables(id,tableReference,type)',
+    'datasets.exists': 'id',
+    'jobs.query': 'jobReference,jobComplete,schema,totalRows',
+    'jobs.query.rows': 'jobReference,jobComplete,pageToken,rows',
+    'jobs.query.dry_run': 'totalBytesProcessed,cacheHit',
+    'jobs.getQueryResults': 'jobComplete,pageToken,rows',
+    'jobs.getQueryResults.rows': 'jobReference,jobComplete,pageToken,rows',
+    'jobs.insert': 'jobReference,status',
+    'jobs.get.state': 'status/state',
+    'jobs.get.profile': 'jobReference,configuration/query/query,statistics',
+    'objects.get': 'name,size,md5Hash,crc32c,updated,contentType,generation',
+    'objects.list': 'nextPageToken,prefixes,items(name,size,md5Hash,crc32c,updated,generation)',
+}
+
+
+class RateLimiter:
+    '''Spaces out calls to at most rate per second, shared by all threads.'''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def acquire(self):
+        '''Blocks until the caller may make its call.'''
+        with self.lock:
+            now = time.time()
+            # Unused time does not accumulate beyond one call.
+            scheduled = max(self.next_time, now)
+            self.next_time = scheduled + self.interval
+        if scheduled > now:
+            time.sleep(scheduled - now)
+
+
+class TransportHttp(object):
+    '''Wraps an (authorized) httplib2.Http to negotiate gzip and to probe
+    the size of unmasked responses.'''
+
+    def __init__(self, transport, http):
+        self.transport = transport
+        self.http = http
+
+    def __getattr__(self, name):
+        return getattr(self.http, name)
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        headers = dict(headers or {})
+        kind = headers.pop(CALL_TYPE_HEADER, None) or self.transport.kind_of(uri)
+        # Media downloads are fetched by byte range, so they are left uncompressed.
+        if self.transport.gzip and 'alt=media' not in uri:
+            headers['accept-encoding'] = 'gzip'
+            user_agent = headers.get('user-agent', '')
+            if 'gzip' not in user_agent:
+                headers['user-agent'] = ('%s %s' % (user_agent, GZIP_USER_AGENT)).strip()
+        if self.transport.rate_limiter is not None and 'alt=media' not in uri:
+            self.transport.rate_limiter.acquire()
+        resp, content = self.http.request(uri, method, body, headers, *args, **kwargs)
+        # httplib2 moves the Content-Encoding of a decoded response to -content-encoding.
+        gzipped = resp.get('-content-encoding') == 'gzip'
+        self.transport.record(kind, len(content), gzipped)
+        if (resp.status == 200 and method == 'GET' and kind != 'objects.get_media' and
+                self.transport.should_probe(kind)):
+            self.probe(kind, uri, headers, content, gzipped, *args, **kwargs)
+        return resp, content
+
+    def probe(self, kind, uri, headers, content, gzipped, *args, **kwargs):
+        '''Repeats a masked GET without its mask to measure the full response.'''
+        parts = urlparse.urlsplit(uri)
+        query = [(key, value) for key, value in urlparse.parse_qsl(parts.query) if key != 'fields']
+        if len(query) == len(urlparse.parse_qsl(parts.query)):
+            # The call is not masked; only the gzip ratio can be measured.
+            full_content = content
+        else:
+            full_uri = urlparse.urlunsplit(parts[:3] + (urllib.urlencode(query), parts[4]))
+            _, full_content = self.http.request(full_uri, 'GET', None, headers, *args, **kwargs)
+        gzip_bytes = len(zlib.compress(content, 6)) if gzipped else None
+        self.transport.record_probe(kind, len(content), len(full_content), gzip_bytes)
+
+
+class Transport:
+    '''Transport options shared by the clients built from one BigQuery_Auth.'''
+
+    def __init__(self, partial_responses=True, gzip=True, probe_interval=0, field_masks=None,
+                 max_requests_per_second=None):
+        self.partial_responses = partial_responses
+        self.rate_limiter = RateLimiter(max_requests_per_second) if max_requests_per_second else None
+        self.gzip = gzip
+        self.probe_interval = probe_interval
+        self.field_masks = dict(FIELD_MASKS)
+        self.field_masks.update(field_masks or {})
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def fields(self, kind):
+        '''Returns the fields= mask for a call type, or None to request the full response.'''
+        if not self.partial_responses:
+            return None
+        return self.field_masks.get(kind)
+
+    def build_http(self, http):
+        '''Wraps an httplib2.Http object (after authorization).'''
+        return TransportHttp(self, http)
+
+    def kind_of(self, uri):
+        '''Names the call type of a request that was not made through Metrics.execute.'''
+        if 'alt=media' in uri:
+            return 'objects.get_media'
+        return 'other'
+
+    def _stats(self, kind):
+        return self.stats.setdefault(kind, {'requests': 0, 'bytes': 0, 'gzip_responses': 0, 'gzip_bytes': 0,
+                                            'probes': 0, 'probe_bytes': 0, 'probe_full_bytes': 0,
+                                            'gzip_probe_bytes': 0, 'probe_gzip_bytes': 0})
+
+    def record(self, kind, response_bytes, gzipped=False):
+        with self.lock:
+            stats = self._stats(kind)
+            stats['requests'] += 1
+            stats['bytes'] += response_bytes
+            if gzipped:
+                stats['gzip_responses'] += 1
+                stats['gzip_bytes'] += response_bytes
+
+    def should_probe(self, kind):
+        if not self.probe_interval:
+            return False
+        with self.lock:
+            return (self._stats(kind)['requests'] - 1) % self.probe_interval == 0
+
+    def record_probe(self, kind, masked_bytes, full_bytes, gzip_bytes=None):
+        '''Records a probe; gzip_bytes is None unless the probed response was gzip encoded.'''
+        with self.lock:
+            stats = self._stats(kind)
+            stats['probes'] += 1
+            stats['probe_bytes'] += masked_bytes
+            stats['probe_full_bytes'] += full_bytes
+            if gzip_bytes is not None:
+                stats['gzip_probe_bytes'] += masked_bytes
+                stats['probe_gzip_bytes'] += gzip_bytes
+
+    def savings_report(self):
+        '''Returns the estimated bytes saved by field masks and gzip per call type.'''
+        report = {}
+        with self.lock:
+            for kind, stats in self.stats.items():
+                entry = {'requests': stats['requests'], 'response_bytes': stats['bytes'],
+                         'gzip_responses': stats['gzip_responses']}
+                if stats['probes'] and stats['probe_bytes']:
+                    full_ratio = float(stats['probe_full_bytes']) / stats['probe_bytes']
+                    entry['estimated_full_bytes'] = int(stats['bytes'] * full_ratio)
+                    entry['bytes_saved_by_fields'] = entry['estimated_full_bytes'] - stats['bytes']
+                if stats['gzip_probe_bytes']:
+                    # Only responses the server actually sent gzip encoded count as savings.
+                    gzip_ratio = float(stats['probe_gzip_bytes']) / stats['gzip_probe_bytes']
+                    entry['estimated_wire_bytes'] = (stats['bytes'] - stats['gzip_bytes'] +
+                                                     int(stats['gzip_bytes'] * gzip_ratio))
+                    entry['bytes_saved_by_gzip'] = stats['bytes'] - entry['estimated_wire_bytes']
+                report[kind] = entry
+        return report
+
+    def format_report(self):
+        lines = ['%-26s %10s %10s %14s %16s %14s' % ('call type', 'requests', 'gzipped', 'bytes',
+                                                      'saved (fields)', 'saved (gzip)')]
+        for kind, entry in sorted(self.savings_report().items()):
+            lines.append('%-26s %10d %10d %14d %16s %14s' % (
+                kind, entry['requests'], entry['gzip_responses'], entry['response_bytes'],
+                entry.get('bytes_saved_by_fields', 'n/a'), entry.get('bytes_saved_by_gzip', 'n/a')))
+        return '\n'.join(lines)
+
+
+_default_transport = Transport()
+
+
+def get_transport():
+    '''Returns the process-wide Transport used by auth objects that are not given one.'''
+    return _default_transport
+
+
+def add_transport_arguments(parser):
+    '''Adds the common transport options to a command line parser.'''
+    parser.add_argument('--full_responses', action='store_true',
+                        help='Request complete API responses instead of minimal field masks')
+    parser.add_argument('--no_gzip', action='store_true', help='Do not negotiate gzip transfer encoding')
+    parser.add_argument('--transport_report', type=int, metavar='N', default=0,
+                        help='Probe every Nth call without its field mask and print the bytes saved')
+    parser.add_argument('--max_requests_per_second', type=float,
+                        help='Limit the rate of API calls made by this process')
+
+
+def transport_from_args(args):
+    '''Creates the Transport requested on the command line.'''
+    return Transport(partial_responses=not args.full_responses, gzip=not args.no_gzip,
+                     probe_interval=args.transport_report, max_requests_per_second=args.max_requests_per_second)
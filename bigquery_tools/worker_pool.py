@@ -0,0 +1,73 @@
+#!/usr/bin/python2.7
+
+'''A bounded pool of worker threads that runs the largest tasks first.
+
+Tasks are submitted with a size (e.g. a row count). Workers always pick the
+largest pending task, so the biggest pieces of work start early and a few
+large tasks do not end up running alone at the end of a read.
+
+Usage:
+  pool = WorkerPool(num_workers=8)
+  pool.submit(100000, reader.read, handler)
+  pool.join()
+'''
+
+import itertools
+import Queue
+import sys
+import threading
+from metrics import get_metrics
+
+
+class WorkerPool:
+    '''Runs submitted callables on a fixed number of threads, largest first.'''
+
+    def __init__(self, num_workers, metrics=None, name='worker'):
+        self.num_workers = num_workers
+        self.metrics = metrics if metrics is not None else get_metrics()
+        self.name = name
+        self.queue = Queue.PriorityQueue()
+        # Ties are broken by submission order.
+        self.counter = itertools.count()
+        self.errors = []
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def submit(self, size, function, *args, **kwargs):
+        '''Queues function(*args, **kwargs); tasks with a larger size run first.'''
+        self.queue.put((-size, next(self.counter), function, args, kwargs))
+        self.metrics.add_gauge('%s_queue_depth' % (self.name,), 1)
+        if len(self.threads) < self.num_workers:
+            thread = threading.Thread(target=self.work, name='%s-%d' % (self.name, len(self.threads)))
+            thread.daemon = True
+            self.threads.append(thread)
+            thread.start()
+
+    def work(self):
+        while True:
+            _, _, function, args, kwargs = self.queue.get()
+            if function is None:
+                self.queue.task_done()
+                return
+            self.metrics.add_gauge('%s_queue_depth' % (self.name,), -1)
+            try:
+                function(*args, **kwargs)
+            except Exception:
+                with self.lock:
+                    self.errors.append(sys.exc_info())
+            finally:
+                self.queue.task_done()
+
+    def join(self):
+        '''Waits for all queued tasks, stops the workers and re-raises the first task error.'''
+        self.queue.join()
+        for _ in self.threads:
+            # Sorts after every real task, since real sizes are finite.
+            self.queue.put((float('inf'), next(self.counter), None, None, None))
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        errors, self.errors = self.errors, []
+        if errors:
+            error_type, error, traceback = errors[0]
+            raise error_type, error, traceback